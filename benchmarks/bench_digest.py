@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import digest  # noqa: E402
+import migrations  # noqa: E402
+import stats  # noqa: E402
+import users  # noqa: E402
+from database import Database  # noqa: E402
+
+# Пробный прогон рассылки итогов: сколько занимает подготовка ежедневных и
+# еженедельных итогов для N подписчиков в нескольких часовых поясах (без отправки),
+# и для сравнения — та же работа по одному запросу статистики на пользователя.
+#   python benchmarks/bench_digest.py --users 50000 --days 60
+
+ZONES = ['Europe/Moscow', 'Europe/Kaliningrad', 'Asia/Yekaterinburg', 'Asia/Novosibirsk', 'Asia/Vladivostok', None]
+
+
+async def seed(db, count, days, rnd):
+    today = date.today()
+    async with db.write() as conn:
+        await conn.executemany('INSERT INTO categories (category, type) VALUES (?, ?)',
+                               [('Еда', 'expense'), ('Транспорт', 'expense'), ('Зарплата', 'income')])
+        await conn.executemany('INSERT INTO user_id_mapping (telegram_id, simple_id) VALUES (?, ?)',
+                               [(1000 + user_id, user_id) for user_id in range(1, count + 1)])
+        await conn.executemany('INSERT INTO user_settings (user_id, timezone) VALUES (?, ?)',
+                               [(user_id, zone) for user_id in range(1, count + 1)
+                                if (zone := rnd.choice(ZONES)) is not None])
+        # Подписка оформлена давно: последние отправленные итоги — за позапрошлый день и неделю
+        await conn.executemany('INSERT INTO digest_subscriptions VALUES (?, 1, 1, ?, ?)',
+                               [(user_id, (today - timedelta(days=3)).isoformat(),
+                                 (today - timedelta(days=30)).isoformat()) for user_id in range(1, count + 1)])
+        rows = []
+        for user_id in range(1, count + 1):
+            for offset in range(days):
+                if rnd.random() < 0.6:
+                    rows.append((user_id, (today - timedelta(days=offset)).isoformat(), 'expense', rnd.randint(1, 2),
+                                 rnd.randint(100, 500000), rnd.randint(1, 5)))
+            rows.append((user_id, (today - timedelta(days=rnd.randrange(days))).isoformat(), 'income', 3,
+                         rnd.randint(1000000, 9000000), 1))
+        await conn.executemany('INSERT OR IGNORE INTO daily_totals VALUES (?, ?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+
+async def per_user(db, settings, count, day_start_hour):
+    # Как если бы итоги строились через /stats для каждого подписчика отдельно
+    async with db.read() as conn:
+        for user_id in range(1, count + 1):
+            now = datetime.now(settings.timezone(user_id))
+            await stats.load_stats(conn, user_id, stats.period_starts(now, day_start_hour))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Пробный прогон рассылки итогов')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=60, help='дней истории у каждого пользователя')
+    parser.add_argument('--batch', type=int, default=digest.DIGEST_BATCH)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'), readers=2)
+        await db.open()
+        try:
+            await migrations.apply_migrations(db)
+            started = time.perf_counter()
+            rows = await seed(db, args.users, args.days, random.Random(42))
+            print(f"Подготовлено {args.users} подписчиков, {rows} строк агрегатов за {time.perf_counter() - started:.1f} с")
+            settings = users.UserSettingsCache(db)
+            await settings.load()
+
+            async def send(telegram_id, text):
+                pass
+
+            scheduler = digest.DigestScheduler(db, send, settings.zone, batch_size=args.batch, dry_run=True)
+            started = time.perf_counter()
+            count, messages = await scheduler.run_once(datetime.now(timezone.utc))
+            seconds = time.perf_counter() - started
+            print(f"Итоги порциями по {args.batch}: пользователей {count}, сообщений {messages} за {seconds:.2f} с "
+                  f"({seconds / max(count, 1) * 1e6:.0f} мкс на пользователя)")
+            started = time.perf_counter()
+            await per_user(db, settings, args.users, 0)
+            legacy = time.perf_counter() - started
+            print(f"По запросу статистики на пользователя: {legacy:.2f} с, разница {legacy / seconds:.1f}x")
+        finally:
+            await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import migrations  # noqa: E402
+import search  # noqa: E402
+import stats  # noqa: E402
+from database import Database  # noqa: E402
+
+# Поиск /find по полнотекстовому индексу против LIKE '%...%' по описаниям на базе
+# из многих пользователей. Замеряется один тяжелый пользователь (--heavy записей)
+# и обычный, запросы — редкое слово, частое слово и префикс.
+#   python benchmarks/bench_find.py --rows 2000000 --users 2000 --heavy 200000
+
+WORDS = ['кофе', 'кофейня', 'такси', 'метро', 'обед', 'ужин', 'продукты', 'аптека', 'кино', 'подарок', 'бензин',
+         'парковка', 'интернет', 'телефон', 'книги', 'одежда', 'обувь', 'ремонт', 'спортзал', 'бассейн', 'ёлка',
+         'шоколадница', 'пятерочка', 'перекресток', 'самокат', 'каршеринг', 'стрижка', 'врач', 'хлеб', 'молоко']
+QUERIES = [['шоколадница'], ['кофе'], ['коф'], ['такси', 'метро']]
+
+
+def description(rnd):
+    words = rnd.sample(WORDS, rnd.randint(1, 3)) + [f'x{rnd.randrange(100000)}']
+    return ' '.join(words)
+
+
+async def seed(path, rows, users, heavy):
+    db = Database(path, readers=2)
+    await db.open()
+    await migrations.apply_migrations(db)
+    rnd = random.Random(42)
+    now = int(time.time())
+    async with db.write() as conn:
+        await conn.execute("INSERT INTO categories (category, type) VALUES ('Еда', 'expense'), ('Прочее', 'expense')")
+        batch = []
+        for index in range(rows):
+            # Первые heavy записей принадлежат пользователю 1, остальные — случайным
+            user_id = 1 if index < heavy else rnd.randint(2, users)
+            batch.append((user_id, 'expense', now - rnd.randint(0, 2 * 365 * 86400), 10800, rnd.randint(1, 2),
+                          rnd.randint(100, 500000), description(rnd)))
+            if len(batch) >= 50000:
+                await conn.executemany(stats.TRANSACTION_INSERT, batch)
+                batch = []
+        await conn.executemany(stats.TRANSACTION_INSERT, batch)
+    return db
+
+
+async def like_find(conn, user_id, words):
+    # Тот же ответ без индекса: подстрока в описании, регистр через lower()
+    conditions = ' AND '.join(["lower(t.description) LIKE ?"] * len(words))
+    params = [user_id] + [f'%{search.normalize(word)}%' for word in words]
+    source = 'FROM transactions t JOIN categories c ON c.id = t.category_id WHERE t.user_id = ? AND ' + conditions
+    totals = await conn.execute_fetchall(f'SELECT t.type, c.category, SUM(t.amount), COUNT(*) {source} '
+                                         f'GROUP BY t.type, c.category', params)
+    rows = await conn.execute_fetchall(f'SELECT t.id {source} ORDER BY t.ts DESC, t.id DESC LIMIT 20', params)
+    return totals, rows
+
+
+async def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), sum(total[3] for total in result[0])
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк поиска по описаниям')
+    parser.add_argument('--rows', type=int, default=500_000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--heavy', type=int, default=50_000, help='записей у тяжелого пользователя')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        started = time.perf_counter()
+        db = await seed(os.path.join(tmp, 'bench.db'), args.rows, args.users, args.heavy)
+        print(f"Подготовлено {args.rows} записей (с индексом FTS) за {time.perf_counter() - started:.1f} с")
+        try:
+            async with db.read() as conn:
+                for user_id in (1, 2):
+                    for words in QUERIES:
+                        query = search.parse_find_args(words, timezone.utc, 0)
+                        fts, found = await measure(lambda: search.find(conn, user_id, query), args.repeat)
+                        like, like_found = await measure(lambda: like_find(conn, user_id, words), args.repeat)
+                        # LIKE ищет подстроку, FTS — начало слова, поэтому числа могут отличаться
+                        print(f"Пользователь {user_id}, «{' '.join(words)}»: FTS {fts:.2f} мс ({found} записей), "
+                              f"LIKE {like:.2f} мс ({like_found} записей), ускорение {like / fts:.1f}x")
+        finally:
+            await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
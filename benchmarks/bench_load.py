@@ -0,0 +1,211 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Нагрузочный бенчмарк: синтетические Update прогоняются через dp.feed_update по
+# реальным сценариям (меню -> категория -> "500 Кофе", s, /stats, /export, /delete)
+# с заданным числом одновременных пользователей. Сессия бота остается своей, вместе с
+# очередью исходящих (outbound.py), а вместо запроса к Telegram API подставлена заглушка,
+# которая только считает исходящие вызовы. Результат — JSON с пропускной
+# способностью и p50/p95/p99 по обработчикам, чтобы сравнивать версии между собой.
+#   python benchmarks/bench_load.py --rows 1000,100000,1000000 --output load.json
+# Каждый размер базы прогоняется в отдельном процессе: бот читает DB_PATH при импорте.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_TELEGRAM_ID = 10_000
+SEED_CHUNK = 50_000
+
+
+def percentile(sorted_values, fraction):
+    # Ближайший ранг: значение, ниже которого не больше fraction всех замеров
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(timings):
+    values = sorted(timings)
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 0.50), 3),
+        'p95_ms': round(percentile(values, 0.95), 3),
+        'p99_ms': round(percentile(values, 0.99), 3),
+        'max_ms': round(values[-1], 3),
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_once(args):
+    os.environ.setdefault('API_TOKEN', '123456:BENCH')
+    os.environ['DB_PATH'] = args.db
+    sys.path.insert(0, ROOT)
+    import logging
+    import bot as B
+    import stats
+    from aiogram import types
+    logging.getLogger().setLevel(logging.WARNING)
+
+    outgoing = {}
+
+    async def stub_request(bot, method, timeout=None):
+        # Отвечает как Telegram, не выходя в сеть; считает вызовы по методам
+        name = type(method).__name__
+        outgoing[name] = outgoing.get(name, 0) + 1
+        if name in ('SendMessage', 'SendDocument', 'EditMessageText'):
+            return types.Message(message_id=1, date=datetime.now(),
+                                 chat=types.Chat(id=getattr(method, 'chat_id', 1), type='private'))
+        return True
+
+    # Подменяется только сам запрос: middleware сессии (очередь исходящих) продолжают работать
+    B.bot.session.make_request = stub_request
+
+    current_handler = {}
+
+    @B.router.message.middleware()
+    async def remember_handler(handler, event, data):
+        current_handler[event.from_user.id] = data['handler'].callback.__name__
+        return await handler(event, data)
+
+    await B.db.open()
+    try:
+        started = time.perf_counter()
+        await B.init_db()
+        await seed(B, stats, args.rows, args.users)
+        await B.warm_caches()
+        B.storage.start()
+        seed_seconds = time.perf_counter() - started
+
+        update_ids = iter(range(1, 10 ** 9))
+        timings = {}
+        errors = {}
+
+        def make_update(telegram_id, text):
+            message = types.Message(message_id=next(update_ids), date=datetime.now(),
+                                    chat=types.Chat(id=telegram_id, type='private'),
+                                    from_user=types.User(id=telegram_id, is_bot=False, first_name='bench'), text=text)
+            return types.Update(update_id=next(update_ids), message=message)
+
+        async def send(telegram_id, text):
+            update = make_update(telegram_id, text)
+            current_handler.pop(telegram_id, None)
+            began = time.perf_counter()
+            try:
+                await B.dp.feed_update(B.bot, update)
+            except Exception:
+                errors[current_handler.get(telegram_id, text)] = errors.get(current_handler.get(telegram_id, text), 0) + 1
+            elapsed = (time.perf_counter() - began) * 1000
+            timings.setdefault(current_handler.get(telegram_id, 'unhandled'), []).append(elapsed)
+
+        async def scenario(telegram_id, slots):
+            async with slots:
+                for _ in range(args.iterations):
+                    for text in ('Меню', '-', 'Еда', '500 Кофе', 's', '/stats'):
+                        await send(telegram_id, text)
+                    if args.export:
+                        await send(telegram_id, '/export')
+                    simple_id = await B.get_or_create_simple_id(telegram_id)
+                    row = await B.db.fetchone('SELECT MAX(id) FROM transactions WHERE user_id = ?', (simple_id,))
+                    for text in ('/delete', 'Удалить по ID', f'/delete {row[0]}'):
+                        await send(telegram_id, text)
+
+        slots = asyncio.Semaphore(args.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(scenario(FIRST_TELEGRAM_ID + index, slots) for index in range(args.users)))
+        seconds = time.perf_counter() - started
+        total = sum(len(values) for values in timings.values())
+        return {
+            'version': git_version(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'rows': args.rows,
+            'users': args.users,
+            'concurrency': args.concurrency,
+            'iterations': args.iterations,
+            'seed_seconds': round(seed_seconds, 2),
+            'updates': total,
+            'seconds': round(seconds, 3),
+            'throughput_per_second': round(total / seconds, 1),
+            'all': summarize([value for values in timings.values() for value in values]),
+            'handlers': {name: summarize(values) for name, values in sorted(timings.items())},
+            'errors': errors,
+            'outgoing': outgoing,
+            'health': B.health_info(),
+        }
+    finally:
+        await B.storage.close()
+        await B.db.close()
+
+
+async def seed(B, stats, rows, users):
+    # Пользователи и транзакции сразу в текущей схеме, затем пересчет дневных агрегатов
+    rnd = random.Random(42)
+    simple_ids = [await B.get_or_create_simple_id(FIRST_TELEGRAM_ID + index) for index in range(users)]
+    categories = await B.db.fetchall('SELECT id, type FROM categories')
+    now = int(time.time())
+    for offset in range(0, rows, SEED_CHUNK):
+        values = []
+        for _ in range(min(SEED_CHUNK, rows - offset)):
+            category_id, type_ = rnd.choice(categories)
+            values.append((rnd.choice(simple_ids), type_, now - rnd.randint(0, 2 * 365 * 24 * 3600), 0, category_id,
+                           rnd.randint(1000, 500000), 'bench'))
+        async with B.db.write() as conn:
+            await conn.executemany(stats.TRANSACTION_INSERT, values)
+    async with B.db.write() as conn:
+        await stats.rebuild_daily_totals(await conn.cursor(), B.DAY_START_HOUR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный бенчмарк бота')
+    parser.add_argument('--rows', default='1000,100000', help='размеры базы через запятую, например 1000,100000,1000000')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=3, help='сколько раз каждый пользователь проходит сценарий')
+    parser.add_argument('--no-export', dest='export', action='store_false', help='без /export в сценарии')
+    parser.add_argument('--output', help='файл для JSON (по умолчанию stdout)')
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.rows.split(',')]
+    if args.db:
+        args.rows = sizes[0]
+        print(json.dumps(asyncio.run(run_once(args)), ensure_ascii=False))
+        return
+
+    results = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            command = [sys.executable, os.path.abspath(__file__), '--rows', str(size), '--users', str(args.users),
+                       '--concurrency', str(args.concurrency), '--iterations', str(args.iterations),
+                       '--db', os.path.join(tmp, 'bench.db')]
+            if not args.export:
+                command.append('--no-export')
+            output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{size} транзакций: {result['throughput_per_second']} обн/с, "
+                  f"p50 {result['all']['p50_ms']} мс, p99 {result['all']['p99_ms']} мс", file=sys.stderr)
+
+    report = json.dumps({'runs': results}, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from collections import deque
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import outbound  # noqa: E402
+
+from aiogram import Bot, types  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.exceptions import TelegramRetryAfter  # noqa: E402
+
+# Очередь исходящих сообщений против заглушки Telegram API, которая сама следит
+# за лимитами и отвечает 429 с retry_after: при превышении общего предела или
+# предела чата, а также случайно с заданной вероятностью. Проверяется, что ни одно
+# сообщение не потеряно, порядок внутри чата сохранен, а ответы пользователям
+# не ждут массовую рассылку.
+#   python benchmarks/bench_outbound.py --chats 100 --replies 3 --bulk 300 --flood 0.02
+
+
+class FloodStubSession(BaseSession):
+    def __init__(self, rate, chat_interval, flood, retry_after, rnd):
+        super().__init__()
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.flood = flood
+        self.retry_after = retry_after
+        self.rnd = rnd
+        self.recent = deque()
+        self.last_by_chat = {}
+        self.delivered = {}
+        self.rejected = 0
+        self.global_violations = 0
+        self.chat_violations = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        await asyncio.sleep(0.002)
+        now = time.monotonic()
+        chat_id = method.chat_id
+        while self.recent and now - self.recent[0] > 1:
+            self.recent.popleft()
+        over_global = len(self.recent) >= self.rate
+        over_chat = now - self.last_by_chat.get(chat_id, -1e9) < self.chat_interval
+        self.global_violations += over_global
+        self.chat_violations += over_chat
+        if over_global or over_chat or self.rnd.random() < self.flood:
+            self.rejected += 1
+            raise TelegramRetryAfter(method=method, message='Too Many Requests', retry_after=self.retry_after)
+        self.recent.append(now)
+        self.last_by_chat[chat_id] = now
+        self.delivered.setdefault(chat_id, []).append(method.text)
+        return types.Message(message_id=1, date=datetime.now(), chat=types.Chat(id=chat_id, type='private'))
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк очереди исходящих сообщений')
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--replies', type=int, default=3, help='ответов на действия в каждом чате')
+    parser.add_argument('--bulk', type=int, default=300, help='сообщений массовой рассылки (по одному на чат)')
+    parser.add_argument('--rate', type=float, default=30)
+    parser.add_argument('--flood', type=float, default=0.02, help='доля случайных 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    # Заглушка строже планировщика по чату, чтобы 429 приходили и от лимитов
+    session = FloodStubSession(args.rate, chat_interval=0.5, flood=args.flood, retry_after=args.retry_after, rnd=rnd)
+    scheduler = outbound.OutboundScheduler(rate=args.rate, chat_rate=1, chat_burst=2)
+    session.middleware(scheduler)
+    bot = Bot(token='123456:BENCH', session=session)
+    latencies = {'interactive': [], 'bulk': []}
+
+    async def send(chat_id, text, kind):
+        started = time.perf_counter()
+        await bot.send_message(chat_id, text)
+        latencies[kind].append(time.perf_counter() - started)
+
+    async def digest():
+        with outbound.bulk():
+            await asyncio.gather(*(send(index % args.chats + 1, f'bulk-{index}', 'bulk') for index in range(args.bulk)))
+
+    async def user(chat_id):
+        for index in range(args.replies):
+            await send(chat_id, f'reply-{index}', 'interactive')
+            await asyncio.sleep(rnd.uniform(0.5, 2))
+
+    started = time.perf_counter()
+    bulk_task = asyncio.create_task(digest())
+    await asyncio.sleep(0.1)
+    await asyncio.gather(*(user(chat_id) for chat_id in range(1, args.chats + 1)))
+    interactive_done = time.perf_counter() - started
+    await bulk_task
+    seconds = time.perf_counter() - started
+    await scheduler.close()
+
+    expected = args.chats * args.replies + args.bulk
+    delivered = sum(len(texts) for texts in session.delivered.values())
+    out_of_order = sum(1 for texts in session.delivered.values()
+                       if [text for text in texts if text.startswith('reply')] !=
+                       sorted((text for text in texts if text.startswith('reply')), key=lambda text: int(text[6:])))
+    print(f"Доставлено {delivered} из {expected} за {seconds:.1f} с ({delivered / seconds:.1f} сообщ./с), "
+          f"ответы пользователям закончились через {interactive_done:.1f} с")
+    print(f"429 от заглушки: {session.rejected} (общий лимит: {session.global_violations}, лимит чата: {session.chat_violations}), "
+          f"повторов в очереди: {scheduler.retries}, потеряно: {scheduler.failed}, чатов с нарушенным порядком: {out_of_order}")
+    for kind, values in latencies.items():
+        if values:
+            values.sort()
+            print(f"{kind}: медиана {statistics.median(values) * 1000:.0f} мс, "
+                  f"p95 {values[int(len(values) * 0.95) - 1] * 1000:.0f} мс, макс {values[-1] * 1000:.0f} мс")
+    print(f"Очередь: {scheduler.stats()}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from bench_stats import migrate, seed
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import export  # noqa: E402
+
+# Исходная схема (REAL, строковые даты, текст категории, индексы по user_id и date)
+# против компактной (одна таблица transactions: копейки, ts + смещение, category_id,
+# покрывающий индекс): размер базы и время запросов статистики, экспорта и удаления
+# для одного пользователя.
+#   python benchmarks/bench_schema.py --rows 1000000 --users 1000
+
+LEGACY_QUERIES = {
+    'период': ('SELECT category, SUM(amount) FROM expenses WHERE user_id = ? AND date >= ? GROUP BY category',
+               lambda user_id, since, row_id: (user_id, since.strftime('%Y-%m-%d %H:%M:%S'))),
+    'экспорт': ('SELECT rowid, user_id, amount, category, description, date FROM expenses WHERE user_id = ?',
+                lambda user_id, since, row_id: (user_id,)),
+    'удаление': ('SELECT amount, category, date FROM expenses WHERE id = ? AND user_id = ?',
+                 lambda user_id, since, row_id: (row_id, user_id)),
+}
+COMPACT_QUERIES = {
+    'период': ('''SELECT category_id, SUM(amount) FROM transactions
+                  WHERE user_id = ? AND ts >= ? AND type = 'expense' GROUP BY category_id''',
+               lambda user_id, since, row_id: (user_id, int(since.timestamp()))),
+    'экспорт': ('''SELECT t.id, t.user_id, printf('%.2f', t.amount / 100.0), c.category, t.description,
+                          datetime(t.ts + t.utc_offset, 'unixepoch')
+                   FROM transactions t JOIN categories c ON c.id = t.category_id
+                   WHERE t.user_id = ? AND t.type = 'expense' ORDER BY t.ts''',
+                lambda user_id, since, row_id: (user_id,)),
+    'удаление': ('SELECT type, amount, category_id, ts, utc_offset FROM transactions WHERE id = ? AND user_id = ?',
+                 lambda user_id, since, row_id: (row_id, user_id)),
+}
+
+
+def measure(conn, sql, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def database_size(path):
+    conn = sqlite3.connect(path)
+    conn.execute('VACUUM')
+    conn.close()
+    return os.path.getsize(path)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк компактной схемы')
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        path = os.path.join(tmp, 'compact.db')
+        started = time.perf_counter()
+        await seed(legacy_path, args.rows, user_id=1, users=args.users)
+        print(f"Подготовлено {args.rows} транзакций ({args.users} польз.) за {time.perf_counter() - started:.1f} с")
+        started = time.perf_counter()
+        await migrate(legacy_path, path)
+        print(f"Миграция заняла {time.perf_counter() - started:.1f} с")
+
+        legacy_size = database_size(legacy_path)
+        size = database_size(path)
+        print(f"Размер базы: было {legacy_size / 2**20:.1f} МБ, стало {size / 2**20:.1f} МБ "
+              f"({size / legacy_size:.0%})")
+
+        legacy = sqlite3.connect(legacy_path)
+        compact = sqlite3.connect(path)
+        row_id = compact.execute("SELECT MAX(id) FROM transactions WHERE user_id = 1 AND type = 'expense'").fetchone()[0]
+        since = datetime.now() - timedelta(days=30)
+        for name, (legacy_sql, legacy_params) in LEGACY_QUERIES.items():
+            sql, params = COMPACT_QUERIES[name]
+            before = measure(legacy, legacy_sql, legacy_params(1, since, row_id), args.repeat)
+            after = measure(compact, sql, params(1, since, row_id), args.repeat)
+            plan = '; '.join(row[3] for row in compact.execute(f'EXPLAIN QUERY PLAN {sql}', params(1, since, row_id)))
+            print(f"{name}: было {before:.3f} мс, стало {after:.3f} мс (x{before / after:.1f}); план: {plan}")
+
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            export.build_csv(compact, 1)
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f"export.build_csv целиком: медиана {statistics.median(timings):.2f} мс")
+        legacy.close()
+        compact.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import aiosqlite
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import migrations  # noqa: E402
+import stats  # noqa: E402
+from database import Database  # noqa: E402
+
+# Сравнение прежней статистики (8–12 запросов к сырым таблицам) с однопроходным
+# движком по дневным агрегатам на пользователе с большим количеством транзакций.
+#   python benchmarks/bench_stats.py --rows 100000 --repeat 20
+
+EXPENSE_CATEGORIES = ['Еда', 'Транспорт', 'Развлечения', 'Коммуналка', 'Прочее']
+INCOME_CATEGORIES = ['Зарплата', 'Инвестиции', 'Подарки']
+
+
+async def seed(path, rows, user_id, users=1):
+    # База в исходной схеме (REAL, строковые даты); компактную получаем миграцией
+    now = datetime.now()
+    rnd = random.Random(42)
+    async with aiosqlite.connect(path) as conn:
+        for table in ('expenses', 'incomes'):
+            await conn.execute(f'''CREATE TABLE {table}
+                                  (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL,
+                                   category TEXT, description TEXT, date TEXT)''')
+            await conn.execute(f'CREATE INDEX idx_{table}_user_id ON {table} (user_id)')
+            await conn.execute(f'CREATE INDEX idx_{table}_date ON {table} (date)')
+        batch = {'expenses': [], 'incomes': []}
+        for _ in range(rows):
+            is_income = rnd.random() < 0.1
+            table = 'incomes' if is_income else 'expenses'
+            category = rnd.choice(INCOME_CATEGORIES if is_income else EXPENSE_CATEGORIES)
+            owner = user_id + rnd.randrange(users) if users > 1 else user_id
+            date = now - timedelta(seconds=rnd.randint(0, 2 * 365 * 24 * 3600))
+            batch[table].append((owner, round(rnd.uniform(10, 5000), 2), category, 'bench',
+                                 date.strftime('%Y-%m-%d %H:%M:%S')))
+        for table, values in batch.items():
+            await conn.executemany(f'INSERT INTO {table} (user_id, amount, category, description, date) VALUES (?, ?, ?, ?, ?)',
+                                   values)
+        await conn.commit()
+
+
+async def migrate(source, path):
+    # Копия базы, переведенная всеми миграциями бота, с заполненными агрегатами
+    shutil.copy(source, path)
+    db = Database(path, readers=1)
+    await db.open()
+    try:
+        await migrations.apply_migrations(db)
+        async with db.write() as conn:
+            await stats.ensure_daily_totals(await conn.cursor(), 0)
+    finally:
+        await db.close()
+
+
+async def legacy_stats(conn, simple_id, now, day_start_hour, detailed):
+    # Копия show_stats до появления агрегатов: по два запроса на период плюс
+    # четыре для подробного вида и квадратичное сопоставление дней и месяцев
+    day_start = now.replace(hour=day_start_hour, minute=0, second=0, microsecond=0)
+    if now.hour < day_start_hour:
+        day_start -= timedelta(days=1)
+    periods = {
+        'день': day_start,
+        'неделю': now - timedelta(days=now.weekday()),
+        'месяц': now.replace(day=1, hour=day_start_hour, minute=0, second=0, microsecond=0),
+        'год': now.replace(month=1, day=1, hour=day_start_hour, minute=0, second=0, microsecond=0)
+    }
+    response = "Статистика расходов и доходов:\n"
+    c = await conn.cursor()
+    for period_name, start_date in periods.items():
+        start_date_str = start_date.strftime('%Y-%m-%d %H:%M:%S')
+        response += f"\nЗа последний {period_name}:\n"
+        await c.execute('SELECT category, SUM(amount) FROM expenses WHERE user_id = ? AND date >= ? GROUP BY category',
+                        (simple_id, start_date_str))
+        expenses = await c.fetchall()
+        total_expenses = sum(row[1] for row in expenses) if expenses else 0
+        await c.execute('SELECT category, SUM(amount) FROM incomes WHERE user_id = ? AND date >= ? GROUP BY category',
+                        (simple_id, start_date_str))
+        incomes = await c.fetchall()
+        total_incomes = sum(row[1] for row in incomes) if incomes else 0
+        for category, amount in expenses + incomes:
+            response += f"{category}: {amount:.2f}\n"
+        response += f"Баланс: {total_incomes - total_expenses:.2f}\n"
+        if detailed and period_name in ('неделю', 'год'):
+            fmt = '%Y-%m-%d' if period_name == 'неделю' else '%Y-%m'
+            await c.execute(f'SELECT strftime("{fmt}", date) as key, SUM(amount) FROM expenses WHERE user_id = ? AND date >= ? GROUP BY key',
+                            (simple_id, start_date_str))
+            by_exp = await c.fetchall()
+            await c.execute(f'SELECT strftime("{fmt}", date) as key, SUM(amount) FROM incomes WHERE user_id = ? AND date >= ? GROUP BY key',
+                            (simple_id, start_date_str))
+            by_inc = await c.fetchall()
+            for key in sorted(set([row[0] for row in by_exp] + [row[0] for row in by_inc])):
+                key_exp = sum(row[1] for row in by_exp if row[0] == key) if any(row[0] == key for row in by_exp) else 0
+                key_inc = sum(row[1] for row in by_inc if row[0] == key) if any(row[0] == key for row in by_inc) else 0
+                response += f"{key}: {key_exp:.2f} {key_inc:.2f}\n"
+    return response
+
+
+async def engine_stats(conn, simple_id, now, day_start_hour, detailed):
+    result = await stats.load_stats(conn, simple_id, stats.period_starts(now, day_start_hour))
+    return stats.render_stats(result, detailed)
+
+
+async def measure(func, conn, repeat, detailed):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func(conn, 1, datetime.now(), 0, detailed)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк статистики')
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        path = os.path.join(tmp, 'bench.db')
+        started = time.perf_counter()
+        await seed(legacy_path, args.rows, user_id=1)
+        await migrate(legacy_path, path)
+        print(f"Подготовлено {args.rows} транзакций за {time.perf_counter() - started:.1f} с")
+        async with aiosqlite.connect(legacy_path) as legacy_conn, aiosqlite.connect(path) as conn:
+            for detailed in (False, True):
+                legacy = await measure(legacy_stats, legacy_conn, args.repeat, detailed)
+                engine = await measure(engine_stats, conn, args.repeat, detailed)
+                print(f"detailed={detailed}: прежняя медиана {legacy[0]:.2f} мс (макс {legacy[1]:.2f}), "
+                      f"движок медиана {engine[0]:.2f} мс (макс {engine[1]:.2f}), "
+                      f"ускорение x{legacy[0] / engine[0]:.1f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,24 +1,92 @@
+# Отсчет времени запуска стоит до импортов намеренно: отчет о запуске в main() включает
+# время импортов по часам, вместе с ожиданием диска
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import asyncio
+import json
 import logging
 import os
-import pandas as pd
-import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
-import aiosqlite
-import aiofiles
 from aiogram import Bot, Dispatcher, Router, types
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
+from database import Database, Maintenance
+import budgets
+import categories
+import digest
+import export
+import fsm_storage
+import history
+import importer
+import metrics
+import migrations
+import quick_entry
+import search
+import outbound
+import purge
+import stats
+import users
+import webhook
+import workers
+
+IMPORTS_SECONDS = time.perf_counter() - STARTUP_STARTED
 
 # Загрузка переменных окружения
 load_dotenv()
 API_TOKEN = os.getenv('API_TOKEN')
 DEFAULT_TIMEZONE = os.getenv('TIMEZONE', 'UTC')
 DAY_START_HOUR = int(os.getenv('DAY_START_HOUR', 0))
+DB_PATH = os.getenv('DB_PATH', 'expenses.db')
+DB_READERS = int(os.getenv('DB_READERS', 4))
+STATS_CACHE_SIZE = int(os.getenv('STATS_CACHE_SIZE', 10000))
+STATS_CACHE_TTL = int(os.getenv('STATS_CACHE_TTL', 300))
+ID_CACHE_SIZE = int(os.getenv('ID_CACHE_SIZE', 100000))
+CATEGORY_CACHE_SIZE = int(os.getenv('CATEGORY_CACHE_SIZE', 10000))
+BUDGET_CACHE_SIZE = int(os.getenv('BUDGET_CACHE_SIZE', 10000))
+# Импорт CSV: предельный размер файла (Bot API отдает ботам файлы до 20 МБ), число
+# одновременных импортов и как часто обновлять сообщение с прогрессом
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', 20 * 1024 * 1024))
+IMPORT_CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', 2))
+IMPORT_PROGRESS_INTERVAL = float(os.getenv('IMPORT_PROGRESS_INTERVAL', 2))
+# Состояния диалогов: сколько хранить брошенные, сколько держать в памяти, как часто сбрасывать в базу
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 86400))
+FSM_CACHE_TTL = int(os.getenv('FSM_CACHE_TTL', 600))
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', 1.0))
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))
+# Режим работы: polling (по умолчанию) или webhook; режим worker фронт выставляет воркерам сам
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', 8080)))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', 64))
+# Число процессов-воркеров с шардами базы (см. workers.py); 1 — всё в одном процессе
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 1))
+HEALTH_PORT = os.getenv('HEALTH_PORT')
+# Метрики Prometheus (см. metrics.py): порт не задан — сервер метрик не запускается.
+# Воркеры слушают METRICS_PORT + 1 + WORKER_INDEX
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT')
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100))
+# Пределы исходящих сообщений (см. outbound.py): общий на бота в секунду и на один чат.
+# Воркеры делят общий предел поровну
+OUTBOUND_RATE = float(os.getenv('OUTBOUND_RATE', 30))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', 1))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', 3))
+# Итоги по подписке (см. digest.py): как часто проверять, пора ли отправлять, и пробный
+# прогон — итоги только считаются и замеряются, без отправки
+DIGEST_INTERVAL = float(os.getenv('DIGEST_INTERVAL', 60))
+DIGEST_DRY_RUN = os.getenv('DIGEST_DRY_RUN', '').lower() in ('1', 'true', 'yes')
+# Обслуживание базы (incremental_vacuum, optimize, checkpoint WAL): период проверки и
+# сколько секунд без записей считать затишьем
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL', 300))
+MAINTENANCE_QUIET = float(os.getenv('MAINTENANCE_QUIET', 30))
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,14 +98,42 @@ logging.getLogger('aiosqlite').setLevel(logging.WARNING)
 logging.getLogger('asyncio').setLevel(logging.WARNING)
 
 # Инициализация бота и диспетчера
+# Общий слой доступа к базе, соединения открываются в main()
+db = Database(DB_PATH, readers=DB_READERS)
+maintenance = Maintenance(db, interval=MAINTENANCE_INTERVAL, quiet=MAINTENANCE_QUIET)
+
 bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(client=bot, fsm_storage=storage)
+# Все ответы проходят через общую очередь с учетом лимитов Telegram
+outbox = outbound.OutboundScheduler(rate=OUTBOUND_RATE / BOT_WORKERS, chat_rate=OUTBOUND_CHAT_RATE,
+                                    chat_burst=OUTBOUND_CHAT_BURST)
+bot.session.middleware(outbox)
+# Состояния FSM переживают перезапуск: хранятся в таблице fsm_states
+storage = fsm_storage.SQLiteStorage(db, state_ttl=FSM_STATE_TTL, cache_ttl=FSM_CACHE_TTL,
+                                    flush_interval=FSM_FLUSH_INTERVAL, cache_size=FSM_CACHE_SIZE)
+dp = Dispatcher(client=bot, storage=storage)
 router = Router()
+# Время обработчиков и SQL-запросов; health_info() объявлена ниже и вызывается только при отдаче метрик
+metrics_registry = metrics.MetricsRegistry(slow_query_seconds=SLOW_QUERY_MS / 1000, health=lambda: health_info())
+db.observer = metrics_registry.observe_query
+router.message.middleware(metrics.HandlerMetricsMiddleware(metrics_registry))
+router.callback_query.middleware(metrics.HandlerMetricsMiddleware(metrics_registry))
 
-# Глобальный кэш категорий и ID
-CATEGORIES = {'expense': [], 'income': []}
-ID_MAPPING_CACHE = {}
+# Кэши категорий и ID
+# Категории пользователей (общие и собственные) с готовыми клавиатурами, загружаются по требованию
+category_index = categories.CategoryIndex(db, maxsize=CATEGORY_CACHE_SIZE)
+# Лимиты по категориям и расходы за текущий месяц, чтобы предупреждать о лимите без запросов к базе
+budget_tracker = budgets.BudgetTracker(db, day_start_hour=DAY_START_HOUR, maxsize=BUDGET_CACHE_SIZE)
+# Импорт — тяжелая операция записи, одновременно идут не больше IMPORT_CONCURRENCY
+import_slots = asyncio.Semaphore(IMPORT_CONCURRENCY)
+simple_ids = users.SimpleIdAllocator(db, maxsize=ID_CACHE_SIZE)
+# Настройки пользователей (часовой пояс) целиком в памяти, запись сквозная
+user_settings = users.UserSettingsCache(db, default_timezone=DEFAULT_TIMEZONE)
+# Кэш готовых ответов статистики, сбрасывается при записи пользователя
+stats_cache = stats.StatsCache(maxsize=STATS_CACHE_SIZE, ttl=STATS_CACHE_TTL)
+# Рассылка итогов идет через ту же очередь исходящих, что и ответы, но пропускает их вперед
+digests = digest.DigestScheduler(db, send=lambda telegram_id, text: bot.send_message(telegram_id, text),
+                                 zone=user_settings.zone, default_timezone=DEFAULT_TIMEZONE,
+                                 day_start_hour=DAY_START_HOUR, interval=DIGEST_INTERVAL, dry_run=DIGEST_DRY_RUN)
 
 # Текст инструкции
 INSTRUCTION_TEXT = """### Инструкция по использованию Telegram-бота для учета расходов и доходов
@@ -93,7 +189,11 @@ INSTRUCTION_TEXT = """### Инструкция по использованию T
    - **Результат**: Доход сохраняется в базе данных, и вы получите подтверждение с деталями.  
    - **Примечание**: Сумма должна быть положительным числом.
 
-#### 3. Просмотр статистики (Статистика или /stats)
+#### 3. Быстрый ввод одной строкой
+   - **Как использовать**: Отправьте `-500 еда кофе` (расход) или `+5000 зарплата апрель` (доход): знак, сумма, категория и описание. Категорию можно написать с маленькой буквы, сократить (`-300 трансп`) или ошибиться в букве.  
+   - **Несколько записей**: Каждая строка сообщения — отдельная запись; если какая-то строка не распознана, бот ничего не запишет и покажет ошибку.
+
+#### 4. Просмотр статистики (Статистика или /stats)
    - **Описание**: Отображает статистику расходов и доходов за день, неделю, месяц и год.  
    - **Как использовать**:  
      - Нажмите кнопку **Статистика** в меню или введите команду `/stats`.  
@@ -104,32 +204,65 @@ INSTRUCTION_TEXT = """### Инструкция по использованию T
      - Баланс (доходы минус расходы).  
    - **Примечание**: Если данных за период нет, бот сообщит об этом.
 
-#### 4. Просмотр категорий (Категории или /categories)
+#### 5. Просмотр категорий (Категории или /categories)
    - **Описание**: Показывает список доступных категорий расходов и доходов.  
    - **Как использовать**: Нажмите кнопку **Категории** в меню или введите `/categories`.  
    - **Результат**: Бот выведет список категорий, разделенных на расходы (например, "Еда", "Транспорт") и доходы (например, "Зарплата", "Инвестиции").  
-   - **Примечание**: Категории предустановлены, но их можно расширить через базу данных.
+   - **Управление**: Можно добавить свои категории, переименовать их и убрать ненужные из кнопок:  
+     - `/category add - Кафе` — новая категория расхода (`+` — дохода);  
+     - `/category rename Кафе -> Кафе и рестораны` — переименовать свою категорию;  
+     - `/category archive Развлечения` — скрыть категорию из кнопок (записи и статистика сохраняются);  
+     - `/category restore Развлечения` — вернуть категорию.  
+   - **Примечание**: Кнопки категорий упорядочены по частоте использования.
 
-#### 5. Экспорт данных (Экспорт или /export)
+#### 6. Итоги по подписке (/digest)
+   - **Описание**: Бот сам присылает итоги за прошедший день и/или неделю: расходы и доходы по категориям и баланс.  
+   - **Как использовать**: `/digest день` — ежедневные, `/digest неделя` — еженедельные (в понедельник), `/digest всё` — оба, `/digest выкл` — отключить. `/digest` без параметров покажет текущую подписку.  
+   - **Примечание**: Итоги приходят в начале нового учетного дня по вашему часовому поясу; если за период не было операций, сообщение не отправляется.
+
+#### 7. Лимиты по категориям (/budget)
+   - **Описание**: Месячный лимит расходов по категории; бот предупредит, когда расходы за месяц дойдут до 80% лимита и когда превысят его.  
+   - **Как использовать**: `/budget еда 15000` — задать лимит, `/budget еда выкл` — снять. `/budget` без параметров покажет лимиты и сколько уже потрачено.  
+   - **Примечание**: Месяц считается по вашему часовому поясу; предупреждение приходит в ответ на запись расхода, по одному на каждый порог.
+
+#### 8. Экспорт данных (Экспорт или /export)
    - **Описание**: Экспортирует все ваши записи о расходах и доходах в CSV-файл.  
    - **Как использовать**: Нажмите кнопку **Экспорт** в меню или введите `/export`.  
    - **Результат**: Бот отправит CSV-файл с данными, содержащими все ваши транзакции (расходы и доходы).  
+   - **Параметры**: Можно указать период и тип записей, например `/export 2025-01-01 2025-03-31 расходы`. Добавьте `gz`, чтобы получить сжатый файл.  
    - **Примечание**: Если данных нет, бот сообщит об этом.
 
-#### 6. Удаление записей (Удалить или /delete)
+#### 9. Импорт данных (/import)
+   - **Описание**: Загружает записи из CSV-файла: выгрузки `/export` или таблицы со столбцами `user_id,amount,category,description,date`.  
+   - **Как использовать**: Введите `/import` и отправьте файл документом (или отправьте файл с подписью `/import`). Подпись `/import create` создаст недостающие категории.  
+   - **Результат**: Бот показывает ход загрузки в одном сообщении и в конце сообщает, сколько записей добавлено и какие строки пропущены.  
+   - **Примечание**: Даты без часового пояса считаются вашим местным временем. Записи из выгрузки `/export`, которые у вас уже есть (совпадает ID), не добавляются повторно.
+
+#### 10. История записей (/history)
+   - **Описание**: Показывает ваши записи по 10 штук, от новых к старым, с их ID.  
+   - **Как использовать**: Введите `/history`; листайте кнопками «« Новее» и «Старее »». Можно отфильтровать по типу, категории и периоду, например `/history расходы еда 2025-01-01 2025-03-31`.  
+   - **Удаление**: Кнопка «Удалить #ID» под страницей удаляет запись после подтверждения; статистика пересчитывается сразу.
+
+#### 11. Поиск по описаниям (/find)
+   - **Описание**: Находит записи по словам из описания и считает суммы по категориям.  
+   - **Как использовать**: `/find кофе год`, `/find такси 2025-01-01 2025-03-31`, `/find подарок доходы`. Слово можно сократить: `коф` найдет и «кофе», и «кофейня»; регистр и «ё» не важны.  
+   - **Результат**: Число найденных записей, итоги по категориям и последние 20 записей с их ID.
+
+#### 12. Удаление записей (Удалить или /delete)
    - **Описание**: Позволяет удалить конкретную запись по ID или полностью обнулить статистику.  
    - **Как использовать**:  
      1. Нажмите кнопку **Удалить** в меню или введите `/delete`.  
      2. Выберите одно из действий:  
         - **Удалить по ID**: Введите `/delete <id>` (например, `/delete 5`).  
         - **Обнулить статистику**: Подтвердите действие, чтобы удалить все ваши записи.  
-     3. Если выбрано "Удалить по ID", укажите ID записи (его можно узнать из экспортированного CSV-файла).  
+        - **По фильтру**: `/delete расходы еда 2025-01-01 2025-01-31` покажет, сколько записей подходит под тип, категорию и период (фильтры как в `/history`), и удалит их после подтверждения.  
+     3. Если выбрано "Удалить по ID", укажите ID записи (его можно узнать в `/history` или в экспортированном CSV-файле).  
    - **Результат**:  
      - Для удаления по ID: указанная запись удаляется, если она принадлежит вам.  
      - Для обнуления: все ваши расходы и доходы удаляются.  
    - **Примечание**: ID должен быть числом, и запись должна существовать.
 
-#### 7. Установка часового пояса (Часовой пояс или /settimezone)
+#### 13. Установка часового пояса (Часовой пояс или /settimezone)
    - **Описание**: Позволяет настроить часовой пояс для корректного учета времени транзакций.  
    - **Как использовать**:  
      1. Нажмите кнопку **Часовой пояс** в меню или введите `/settimezone`.  
@@ -137,7 +270,7 @@ INSTRUCTION_TEXT = """### Инструкция по использованию T
    - **Результат**: Часовой пояс сохраняется, и все новые транзакции будут записаны с учетом этого времени.  
    - **Примечание**: Если часовой пояс введен неверно, бот предложит повторить ввод. По умолчанию используется UTC.
 
-#### 8. Инструкция (Инструкция или /instruction)
+#### 14. Инструкция (Инструкция или /instruction)
    - **Описание**: Показывает эту инструкцию с описанием всех функций бота.  
    - **Как использовать**: Нажмите кнопку **Инструкция** в меню или введите `/instruction`.  
    - **Результат**: Бот отправит полный текст инструкции.
@@ -146,7 +279,7 @@ INSTRUCTION_TEXT = """### Инструкция по использованию T
 
 ### Полезные советы
 - **Формат ввода транзакций**: Всегда указывайте сумму и описание через пробел (например, `1000 Подарок`).  
-- **Проверка ID для удаления**: Чтобы узнать ID транзакций, экспортируйте данные через `/export`.  
+- **Проверка ID для удаления**: Чтобы узнать ID транзакций, откройте `/history` или экспортируйте данные через `/export`.  
 - **Часовой пояс**: Убедитесь, что вы указали правильный часовой пояс, чтобы статистика отображалась корректно.  
 - **Кнопка "Назад"**: Используйте её, чтобы отменить текущее действие и вернуться в меню.  
 - **Ошибки**: Если бот сообщает об ошибке (например, неверный формат суммы), следуйте подсказкам в ответном сообщении.
@@ -168,31 +301,9 @@ INSTRUCTION_TEXT = """### Инструкция по использованию T
 Если у вас возникнут вопросы, просто напишите боту, и он поможет разобраться!"""
 
 async def init_db():
-    async with aiosqlite.connect('expenses.db') as conn:
+    await migrations.apply_migrations(db)
+    async with db.write() as conn:
         c = await conn.cursor()
-        await c.execute('''CREATE TABLE IF NOT EXISTS expenses
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, category TEXT, description TEXT, date TEXT)''')
-        await c.execute('''CREATE TABLE IF NOT EXISTS incomes
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, category TEXT, description TEXT, date TEXT)''')
-        await c.execute('''CREATE TABLE IF NOT EXISTS categories
-                          (category TEXT PRIMARY KEY, type TEXT)''')
-        await c.execute('''CREATE TABLE IF NOT EXISTS user_settings
-                          (user_id INTEGER PRIMARY KEY, timezone TEXT)''')
-        await c.execute('''CREATE TABLE IF NOT EXISTS user_id_mapping
-                          (telegram_id INTEGER PRIMARY KEY, simple_id INTEGER)''')
-        
-        # Добавление индексов для ускорения запросов
-        await c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_id ON expenses (user_id)')
-        await c.execute('CREATE INDEX IF NOT EXISTS idx_incomes_user_id ON incomes (user_id)')
-        await c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses (date)')
-        await c.execute('CREATE INDEX IF NOT EXISTS idx_incomes_date ON incomes (date)')
-        
-        await c.execute('PRAGMA table_info(categories)')
-        columns = [info[1] for info in await c.fetchall()]
-        if 'type' not in columns:
-            await c.execute('ALTER TABLE categories ADD COLUMN type TEXT')
-            logging.info("Добавлен столбец 'type' в таблицу categories")
-        
         default_categories = [
             ('Еда', 'expense'), ('Транспорт', 'expense'), ('Развлечения', 'expense'),
             ('Коммуналка', 'expense'), ('Прочее', 'expense'),
@@ -200,84 +311,56 @@ async def init_db():
         ]
         await c.executemany('INSERT OR IGNORE INTO categories (category, type) VALUES (?, ?)', default_categories)
         
-        await c.execute('SELECT category, type FROM categories')
-        for category, type_ in await c.fetchall():
-            CATEGORIES[type_].append(category)
-        
-        await conn.commit()
+        if await stats.ensure_daily_totals(c, DAY_START_HOUR):
+            logging.info("Дневные агрегаты статистики пересчитаны")
 
-async def get_user_timezone(user_id):
-    async with aiosqlite.connect('expenses.db') as conn:
-        c = await conn.cursor()
-        await c.execute('SELECT timezone FROM user_settings WHERE user_id = ?', (user_id,))
-        result = await c.fetchone()
-        try:
-            return ZoneInfo(result[0] if result else DEFAULT_TIMEZONE)
-        except ZoneInfoNotFoundError:
-            logging.error(f"Неверный часовой пояс для user_id {user_id}, используется UTC")
-            return ZoneInfo('UTC')
+async def warm_caches():
+    warmed = await simple_ids.warm()
+    logging.info(f"В кэш ID загружено пользователей: {warmed}")
+    loaded = await user_settings.load()
+    logging.info(f"Загружено настроек пользователей: {loaded}")
+
+def get_user_timezone(user_id):
+    return user_settings.timezone(user_id)
 
 async def get_or_create_simple_id(telegram_id):
-    if telegram_id in ID_MAPPING_CACHE:
-        return ID_MAPPING_CACHE[telegram_id]
-    
-    async with aiosqlite.connect('expenses.db') as conn:
-        c = await conn.cursor()
-        await c.execute('SELECT simple_id FROM user_id_mapping WHERE telegram_id = ?', (telegram_id,))
-        result = await c.fetchone()
-        if result:
-            ID_MAPPING_CACHE[telegram_id] = result[0]
-            return result[0]
-        else:
-            logging.debug(f"Creating new simple_id for telegram_id {telegram_id}")
-            await c.execute('SELECT MAX(simple_id) FROM user_id_mapping')
-            max_id = (await c.fetchone())[0]
-            simple_id = (max_id + 1) if max_id is not None else 1
-            await c.execute('INSERT INTO user_id_mapping (telegram_id, simple_id) VALUES (?, ?)', (telegram_id, simple_id))
-            await conn.commit()
-            ID_MAPPING_CACHE[telegram_id] = simple_id
-            logging.debug(f"Inserted simple_id {simple_id} for telegram_id {telegram_id}")
-            return simple_id
-
-async def update_user_ids_in_tables():
-    async with aiosqlite.connect('expenses.db') as conn:
-        c = await conn.cursor()
-        await c.execute('SELECT DISTINCT user_id FROM expenses')
-        expense_ids = [row[0] for row in await c.fetchall()]
-        await c.execute('SELECT DISTINCT user_id FROM incomes')
-        income_ids = [row[0] for row in await c.fetchall()]
-        all_telegram_ids = set(expense_ids + income_ids)
-        
-        await c.execute('SELECT telegram_id, simple_id FROM user_id_mapping WHERE telegram_id IN ({})'.format(','.join('?' * len(all_telegram_ids))), list(all_telegram_ids))
-        id_mapping = {row[0]: row[1] for row in await c.fetchall()}
-        
-        await c.execute('SELECT MAX(simple_id) FROM user_id_mapping')
-        max_id = (await c.fetchone())[0]
-        next_simple_id = (max_id + 1) if max_id is not None else 1
-        
-        for telegram_id in all_telegram_ids:
-            if telegram_id not in id_mapping:
-                id_mapping[telegram_id] = next_simple_id
-                await c.execute('INSERT INTO user_id_mapping (telegram_id, simple_id) VALUES (?, ?)', (telegram_id, next_simple_id))
-                ID_MAPPING_CACHE[telegram_id] = next_simple_id
-                next_simple_id += 1
-        
-        for telegram_id, simple_id in id_mapping.items():
-            await c.execute('UPDATE expenses SET user_id = ? WHERE user_id = ?', (simple_id, telegram_id))
-            await c.execute('UPDATE incomes SET user_id = ? WHERE user_id = ?', (simple_id, telegram_id))
-        
-        await conn.commit()
+    return await simple_ids.get(telegram_id)
 
+# Клавиатуры не зависят от пользователя, поэтому собираются один раз
+BACK_KEYBOARD = types.ReplyKeyboardMarkup(
+    keyboard=[[types.KeyboardButton(text="Назад")]],
+    resize_keyboard=True
+)
+START_KEYBOARD = types.ReplyKeyboardMarkup(
+    keyboard=[[types.KeyboardButton(text="Меню")]],
+    resize_keyboard=True
+)
+MENU_KEYBOARD = types.ReplyKeyboardMarkup(
+    keyboard=[
+        [types.KeyboardButton(text="-"), types.KeyboardButton(text="+")],
+        [types.KeyboardButton(text="Статистика"), types.KeyboardButton(text="Категории")],
+        [types.KeyboardButton(text="Экспорт"), types.KeyboardButton(text="Удалить")],
+        [types.KeyboardButton(text="Часовой пояс"), types.KeyboardButton(text="Инструкция")]
+    ],
+    resize_keyboard=True
+)
+DELETE_KEYBOARD = types.ReplyKeyboardMarkup(
+    keyboard=[
+        [types.KeyboardButton(text="Удалить по ID"), types.KeyboardButton(text="Обнулить статистику")],
+        [types.KeyboardButton(text="Назад")]
+    ],
+    resize_keyboard=True
+)
 def get_back_keyboard():
-    return types.ReplyKeyboardMarkup(
-        keyboard=[[types.KeyboardButton(text="Назад")]],
-        resize_keyboard=True
-    )
+    return BACK_KEYBOARD
 
 class TransactionForm(StatesGroup):
     choosing_category = State()
     entering_amount = State()
 
+class ImportForm(StatesGroup):
+    waiting_file = State()
+
 class DeleteForm(StatesGroup):
     choosing_action = State()
     entering_id = State()
@@ -291,6 +374,9 @@ def is_expense_command(message: types.Message):
 def is_income_command(message: types.Message):
     return message.text and message.text.startswith('+')
 
+def is_quick_entry_command(message: types.Message):
+    return bool(message.text) and message.text.startswith(('-', '+')) and quick_entry.is_quick_entry(message.text)
+
 def is_stats_command(message: types.Message):
     return message.text and message.text.startswith('s') and len(message.text) == 1
 
@@ -298,24 +384,11 @@ def is_stats_command(message: types.Message):
 async def send_welcome(message: types.Message):
     logging.debug(f"Received /start from user {message.from_user.id}")
     await get_or_create_simple_id(message.from_user.id)
-    keyboard = types.ReplyKeyboardMarkup(
-        keyboard=[[types.KeyboardButton(text="Меню")]],
-        resize_keyboard=True
-    )
-    await message.reply("Добро пожаловать! Нажмите 'Меню' для начала работы.", reply_markup=keyboard)
+    await message.reply("Добро пожаловать! Нажмите 'Меню' для начала работы.", reply_markup=START_KEYBOARD)
 
 @router.message(lambda message: message.text == "Меню")
 async def show_menu(message: types.Message):
-    keyboard = types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="-"), types.KeyboardButton(text="+")],
-            [types.KeyboardButton(text="Статистика"), types.KeyboardButton(text="Категории")],
-            [types.KeyboardButton(text="Экспорт"), types.KeyboardButton(text="Удалить")],
-            [types.KeyboardButton(text="Часовой пояс"), types.KeyboardButton(text="Инструкция")]
-        ],
-        resize_keyboard=True
-    )
-    await message.reply("Выберите действие:", reply_markup=keyboard)
+    await message.reply("Выберите действие:", reply_markup=MENU_KEYBOARD)
 
 @router.message(lambda message: message.text == "Назад")
 async def go_back(message: types.Message, state: FSMContext):
@@ -370,11 +443,7 @@ async def process_timezone(message: types.Message, state: FSMContext):
     try:
         ZoneInfo(timezone)
         simple_id = await get_or_create_simple_id(message.from_user.id)
-        async with aiosqlite.connect('expenses.db') as conn:
-            c = await conn.cursor()
-            await c.execute('INSERT OR REPLACE INTO user_settings (user_id, timezone) VALUES (?, ?)',
-                            (simple_id, timezone))
-            await conn.commit()
+        await user_settings.update(simple_id, timezone=timezone)
         await message.reply(f"Часовой пояс установлен: {timezone}", reply_markup=get_back_keyboard())
         await state.clear()
     except ZoneInfoNotFoundError:
@@ -385,36 +454,104 @@ async def process_timezone(message: types.Message, state: FSMContext):
 
 @router.message(Command(commands=['categories']))
 async def list_categories(message: types.Message):
-    if CATEGORIES['expense'] or CATEGORIES['income']:
-        response = "Доступные категории:\nРасходы:\n" + "\n".join(f"{cat} (расход)" for cat in CATEGORIES['expense']) + \
-                   "\nДоходы:\n" + "\n".join(f"{cat} (доход)" for cat in CATEGORIES['income'])
-        await message.reply(response, reply_markup=get_back_keyboard())
-    else:
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    entry = await category_index.get(simple_id)
+    if not entry.by_name:
         await message.reply("Категории не найдены.", reply_markup=get_back_keyboard())
+        return
+    response = "Доступные категории:"
+    for type_, title, label in (('expense', "Расходы", "расход"), ('income', "Доходы", "доход")):
+        response += f"\n{title}:\n" + "\n".join(f"{category.name} ({label})" for category in entry.order[type_])
+        archived = [category.name for category in entry.by_name.values() if category.type == type_ and category.archived]
+        if archived:
+            response += f"\nВ архиве: {', '.join(archived)}"
+    response += "\n\nСвои категории: /category add - <название> (+ для дохода), " \
+                "/category rename <старое> -> <новое>, /category archive <название>, /category restore <название>"
+    await message.reply(response, reply_markup=get_back_keyboard())
+
+@router.message(Command(commands=['category']))
+async def manage_category(message: types.Message, command: CommandObject):
+    usage = ("Используйте: /category add - <название> (+ для дохода), /category rename <старое> -> <новое>, "
+             "/category archive <название>, /category restore <название>")
+    action, _, rest = (command.args or '').strip().partition(' ')
+    rest = rest.strip()
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    try:
+        if action == 'add' and rest[:1] in ('-', '+'):
+            type_ = 'expense' if rest[0] == '-' else 'income'
+            category = await category_index.add(simple_id, type_, rest[1:])
+            response = f"Категория «{category.name}» ({'расход' if type_ == 'expense' else 'доход'}) добавлена."
+        elif action == 'rename' and '->' in rest:
+            old_name, _, new_name = rest.partition('->')
+            category = await category_index.rename(simple_id, old_name, new_name)
+            # Готовые ответы статистики содержат старое название
+            stats_cache.invalidate(simple_id)
+            response = f"Категория переименована в «{category.name}»."
+        elif action in ('archive', 'restore') and rest:
+            category = await category_index.set_archived(simple_id, rest, action == 'archive')
+            response = f"Категория «{category.name}» " + ("перенесена в архив." if action == 'archive' else "возвращена.")
+        else:
+            response = usage
+    except categories.CategoryError as e:
+        response = str(e)
+    await message.reply(response, reply_markup=get_back_keyboard())
+
+@router.message(is_quick_entry_command)
+async def quick_add(message: types.Message):
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    entry = await category_index.get(simple_id)
+    entries, errors = quick_entry.parse(message.text, entry)
+    if errors:
+        response = "Ничего не записано:\n" + "\n".join(
+            f"Строка {number}: {reason}" if number else reason for number, reason in errors)
+        await message.reply(response, reply_markup=get_back_keyboard())
+        return
+    tz = get_user_timezone(simple_id)
+    now = datetime.now(tz=tz)
+    ts, utc_offset = int(now.timestamp()), int(now.utcoffset().total_seconds())
+    day = stats.accounting_day(now, DAY_START_HOUR)
+    # Лимиты загружаются до записи, иначе сумма за месяц из базы уже включала бы эти строки
+    limits = await budget_tracker.get(simple_id, tz)
+    statements = []
+    for item in entries:
+        statements.append((stats.TRANSACTION_INSERT, (simple_id, item.type, ts, utc_offset, item.category.id, item.amount,
+                                                      item.description)))
+        statements.append((stats.ROLLUP_UPSERT, (simple_id, day, item.type, item.category.id, item.amount)))
+        statements.append(category_index.record_use(entry, simple_id, item.category))
+    # Все строки сообщения — одна пачка в очереди записи
+    try:
+        await db.enqueue(*statements)
+    except Exception as e:
+        logging.error(f"Быстрый ввод пользователя {simple_id} не записан: {e}")
+        # Счетчики использования категорий уже увеличены в памяти, перечитываем их из базы
+        category_index.forget(simple_id)
+        await message.reply(f"Произошла ошибка: {str(e)}. Ничего не записано.", reply_markup=get_back_keyboard())
+        return
+    stats_cache.invalidate(simple_id)
+    alerts = {}
+    for item in entries:
+        if item.type == 'expense':
+            crossed = budget_tracker.record(limits, day, item.category.id, item.amount)
+            if crossed is not None:
+                alerts[item.category.id] = budgets.alert_text(item.category.name, *crossed)
+    lines = [f"{'Расход' if item.type == 'expense' else 'Доход'} {stats.format_amount(item.amount)} — "
+             f"{item.category.name}" + (f" ({item.description})" if item.description else "") for item in entries]
+    header = "Добавлено:" if len(entries) == 1 else f"Добавлено записей: {len(entries)}"
+    await message.reply(header + "\n" + "\n".join(lines + list(alerts.values())), reply_markup=get_back_keyboard())
 
 @router.message(is_expense_command)
 async def start_expense(message: types.Message, state: FSMContext):
     await state.update_data(action='expense')
-    categories = CATEGORIES['expense']
-    keyboard = types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text=cat) for cat in categories[i:i + 2]] for i in range(0, len(categories), 2)
-        ] + [[types.KeyboardButton(text="Назад")]],
-        resize_keyboard=True
-    )
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    keyboard = await category_index.keyboard(simple_id, 'expense')
     await state.set_state(TransactionForm.choosing_category)
     await message.reply("Выберите категорию для расхода:", reply_markup=keyboard)
 
 @router.message(is_income_command)
 async def start_income(message: types.Message, state: FSMContext):
     await state.update_data(action='income')
-    categories = CATEGORIES['income']
-    keyboard = types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text=cat) for cat in categories[i:i + 2]] for i in range(0, len(categories), 2)
-        ] + [[types.KeyboardButton(text="Назад")]],
-        resize_keyboard=True
-    )
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    keyboard = await category_index.keyboard(simple_id, 'income')
     await state.set_state(TransactionForm.choosing_category)
     await message.reply("Выберите категорию для дохода:", reply_markup=keyboard)
 
@@ -424,7 +561,9 @@ async def enter_amount(message: types.Message, state: FSMContext):
         await go_back(message, state)
         return
     category = message.text
-    if category not in CATEGORIES['expense'] and category not in CATEGORIES['income']:
+    data = await state.get_data()
+    entry = await category_index.get(await get_or_create_simple_id(message.from_user.id))
+    if entry.find(data.get('action'), category) is None:
         await message.reply("Пожалуйста, выберите категорию из предложенных.", reply_markup=get_back_keyboard())
         return
     await state.update_data(category=category)
@@ -443,9 +582,7 @@ async def save_transaction(message: types.Message, state: FSMContext):
         if len(parts) < 2:
             await message.reply("Неверный формат. Используйте: <сумма> <описание>", reply_markup=get_back_keyboard())
             return
-        amount = float(parts[0])
-        if amount <= 0:
-            raise ValueError("Сумма должна быть положительной!")
+        minor = stats.parse_amount(parts[0])
         description = parts[1]
         
         data = await state.get_data()
@@ -453,23 +590,34 @@ async def save_transaction(message: types.Message, state: FSMContext):
         category = data['category']
         telegram_id = message.from_user.id
         simple_id = await get_or_create_simple_id(telegram_id)
-        tz = await get_user_timezone(simple_id)
-        date = datetime.now(tz=tz).strftime('%Y-%m-%d %H:%M:%S')
+        tz = get_user_timezone(simple_id)
+        now = datetime.now(tz=tz)
+        entry = await category_index.get(simple_id)
+        # Архивированная за время ввода суммы категория всё ещё принимается
+        found = entry.by_name.get(category)
+        if found is None or found.type != action:
+            raise LookupError(f"категория «{category}» не найдена")
+        category_id = found.id
+        day = stats.accounting_day(now, DAY_START_HOUR)
+        limits = await budget_tracker.get(simple_id, tz) if action == 'expense' else None
         
-        async with aiosqlite.connect('expenses.db') as conn:
-            c = await conn.cursor()
-            table = 'expenses' if action == 'expense' else 'incomes'
-            await c.execute(f'INSERT INTO {table} (user_id, amount, category, description, date) VALUES (?, ?, ?, ?, ?)',
-                            (simple_id, amount, category, description, date))
-            await conn.commit()
-        action_text = "Расход" if action == 'expense' else "Доход"
-        await message.reply(
-            f"{action_text} добавлен:\nСумма: {amount}\nКатегория: {category}\nОписание: {description}",
-            reply_markup=get_back_keyboard()
+        await db.enqueue(
+            (stats.TRANSACTION_INSERT,
+             (simple_id, action, int(now.timestamp()), int(now.utcoffset().total_seconds()), category_id, minor,
+              description)),
+            (stats.ROLLUP_UPSERT, (simple_id, day, action, category_id, minor)),
+            category_index.record_use(entry, simple_id, found)
         )
+        stats_cache.invalidate(simple_id)
+        action_text = "Расход" if action == 'expense' else "Доход"
+        response = f"{action_text} добавлен:\nСумма: {stats.format_amount(minor)}\nКатегория: {category}\nОписание: {description}"
+        crossed = budget_tracker.record(limits, day, category_id, minor) if limits is not None else None
+        if crossed is not None:
+            response += "\n\n" + budgets.alert_text(category, *crossed)
+        await message.reply(response, reply_markup=get_back_keyboard())
         await state.clear()
     except ValueError as e:
-        await message.reply(f"Ошибка: {str(e)}. Убедитесь, что сумма — число.", reply_markup=get_back_keyboard())
+        await message.reply(f"Ошибка: {str(e)}. Пример: 500 Кофе", reply_markup=get_back_keyboard())
     except Exception as e:
         await message.reply(f"Произошла ошибка: {str(e)}", reply_markup=get_back_keyboard())
 
@@ -477,137 +625,343 @@ async def save_transaction(message: types.Message, state: FSMContext):
 async def show_stats(message: types.Message, detailed: bool = False):
     telegram_id = message.from_user.id
     simple_id = await get_or_create_simple_id(telegram_id)
-    tz = await get_user_timezone(simple_id)
-    now = datetime.now(tz)
-    
-    day_start = now.replace(hour=DAY_START_HOUR, minute=0, second=0, microsecond=0)
-    if now.hour < DAY_START_HOUR:
-        day_start -= timedelta(days=1)
-    periods = {
-        'день': day_start,
-        'неделю': now - timedelta(days=now.weekday()),
-        'месяц': now.replace(day=1, hour=DAY_START_HOUR, minute=0, second=0, microsecond=0),
-        'год': now.replace(month=1, day=1, hour=DAY_START_HOUR, minute=0, second=0, microsecond=0)
-    }
-    
-    response = "Статистика расходов и доходов:\n"
-    async with aiosqlite.connect('expenses.db') as conn:
-        c = await conn.cursor()
-        for period_name, start_date in periods.items():
-            start_date_str = start_date.strftime('%Y-%m-%d %H:%M:%S')
-            response += f"\nЗа последний {period_name}:\n"
-            
-            await c.execute('SELECT category, SUM(amount) FROM expenses WHERE user_id = ? AND date >= ? GROUP BY category',
-                            (simple_id, start_date_str))
-            expenses = await c.fetchall()
-            total_expenses = sum(row[1] for row in expenses) if expenses else 0
-            
-            await c.execute('SELECT category, SUM(amount) FROM incomes WHERE user_id = ? AND date >= ? GROUP BY category',
-                            (simple_id, start_date_str))
-            incomes = await c.fetchall()
-            total_incomes = sum(row[1] for row in incomes) if incomes else 0
-            
-            if expenses:
-                response += "Расходы:\n"
-                for category, amount in expenses:
-                    response += f"{category}: {amount:.2f}\n"
-            if incomes:
-                response += "Доходы:\n"
-                for category, amount in incomes:
-                    response += f"{category}: {amount:.2f}\n"
-            response += f"Итого расходы: {total_expenses:.2f}\n"
-            response += f"Итого доходы: {total_incomes:.2f}\n"
-            response += f"Баланс: {total_incomes - total_expenses:.2f}\n"
-            
-            if detailed and period_name == 'неделю':
-                await c.execute('SELECT strftime("%Y-%m-%d", date) as day, SUM(amount) FROM expenses WHERE user_id = ? AND date >= ? GROUP BY day',
-                                (simple_id, start_date_str))
-                daily_expenses = await c.fetchall()
-                await c.execute('SELECT strftime("%Y-%m-%d", date) as day, SUM(amount) FROM incomes WHERE user_id = ? AND date >= ? GROUP BY day',
-                                (simple_id, start_date_str))
-                daily_incomes = await c.fetchall()
-                if daily_expenses or daily_incomes:
-                    response += "\nПодробно по дням:\n"
-                    days = set([row[0] for row in daily_expenses] + [row[0] for row in daily_incomes])
-                    for day in sorted(days):
-                        day_exp = sum(row[1] for row in daily_expenses if row[0] == day) if any(row[0] == day for row in daily_expenses) else 0
-                        day_inc = sum(row[1] for row in daily_incomes if row[0] == day) if any(row[0] == day for row in daily_incomes) else 0
-                        response += f"{day}: Расходы {day_exp:.2f}, Доходы {day_inc:.2f}, Баланс {day_inc - day_exp:.2f}\n"
-            elif detailed and period_name == 'год':
-                await c.execute('SELECT strftime("%Y-%m", date) as month, SUM(amount) FROM expenses WHERE user_id = ? AND date >= ? GROUP BY month',
-                                (simple_id, start_date_str))
-                monthly_expenses = await c.fetchall()
-                await c.execute('SELECT strftime("%Y-%m", date) as month, SUM(amount) FROM incomes WHERE user_id = ? AND date >= ? GROUP BY month',
-                                (simple_id, start_date_str))
-                monthly_incomes = await c.fetchall()
-                if monthly_expenses or monthly_incomes:
-                    response += "\nПодробно по месяцам:\n"
-                    months = set([row[0] for row in monthly_expenses] + [row[0] for row in monthly_incomes])
-                    for month in sorted(months):
-                        month_exp = sum(row[1] for row in monthly_expenses if row[0] == month) if any(row[0] == month for row in monthly_expenses) else 0
-                        month_inc = sum(row[1] for row in monthly_incomes if row[0] == month) if any(row[0] == month for row in monthly_incomes) else 0
-                        response += f"{month}: Расходы {month_exp:.2f}, Доходы {month_inc:.2f}, Баланс {month_inc - month_exp:.2f}\n"
-    
-    if "За последний день:" in response and total_expenses == 0 and total_incomes == 0:
-        await message.reply("Нет данных для отображения статистики.", reply_markup=get_back_keyboard())
-    else:
-        await message.reply(response, reply_markup=get_back_keyboard())
+    tz = get_user_timezone(simple_id)
+    starts = stats.period_starts(datetime.now(tz), DAY_START_HOUR)
+    key = stats_cache.make_key(simple_id, starts, detailed)
+    response = stats_cache.get(key)
+    if response is None:
+        generation = stats_cache.generation(simple_id)
+        async with db.read() as conn:
+            result = await stats.load_stats(conn, simple_id, starts)
+        if result.is_empty:
+            response = "Нет данных для отображения статистики."
+        else:
+            response = stats.render_stats(result, detailed)
+        stats_cache.put(key, response, generation)
+    await message.reply(response, reply_markup=get_back_keyboard())
 
 @router.message(is_stats_command)
 async def show_stats_short(message: types.Message):
     await show_stats(message, detailed=False)
 
+@router.message(Command(commands=['digest']))
+async def manage_digest(message: types.Message, command: CommandObject):
+    # /digest [день|неделя|всё|выкл]
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    choice = (command.args or '').strip().lower()
+    options = {'день': (True, False), 'неделя': (False, True), 'всё': (True, True), 'все': (True, True),
+               'выкл': (False, False)}
+    if choice in options:
+        daily, weekly = options[choice]
+        await digests.subscribe(simple_id, get_user_timezone(simple_id), daily, weekly)
+    elif choice:
+        await message.reply("Формат: /digest [день|неделя|всё|выкл]", reply_markup=get_back_keyboard())
+        return
+    else:
+        daily, weekly = await digests.subscription(simple_id)
+    kinds = [name for name, enabled in (("ежедневные", daily), ("еженедельные", weekly)) if enabled]
+    status = f"Подписка на итоги: {' и '.join(kinds)}." if kinds else "Подписка на итоги выключена."
+    await message.reply(f"{status} Итоги приходят в начале нового дня по вашему часовому поясу "
+                        f"({DAY_START_HOUR}:00), еженедельные — в понедельник.\n"
+                        f"Изменить: /digest день, /digest неделя, /digest всё, /digest выкл",
+                        reply_markup=get_back_keyboard())
+
+@router.message(Command(commands=['budget']))
+async def manage_budget(message: types.Message, command: CommandObject):
+    # /budget — лимиты и расходы за месяц; /budget <категория> <сумма|выкл> — задать или снять лимит
+    usage = "Формат: /budget <категория> <сумма> или /budget <категория> выкл"
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    tz = get_user_timezone(simple_id)
+    entry = await category_index.get(simple_id)
+    args = (command.args or '').split()
+    if args:
+        if len(args) < 2:
+            await message.reply(usage, reply_markup=get_back_keyboard())
+            return
+        category, used = entry.match('expense', args[:-1])
+        if category is None or used != len(args) - 1:
+            await message.reply(f"Категория расходов «{' '.join(args[:-1])}» не найдена. {usage}",
+                                reply_markup=get_back_keyboard())
+            return
+        try:
+            limit = 0 if args[-1].lower() == 'выкл' else stats.parse_amount(args[-1])
+        except ValueError as e:
+            await message.reply(f"Ошибка: {e}. {usage}", reply_markup=get_back_keyboard())
+            return
+        await budget_tracker.set_limit(simple_id, category.id, limit)
+        response = (f"Лимит на месяц по категории «{category.name}»: {stats.format_amount(limit)}.\n\n" if limit
+                    else f"Лимит по категории «{category.name}» снят.\n\n")
+    else:
+        response = ""
+    names = {category.id: category.name for category in entry.by_name.values()}
+    overview = sorted(await budget_tracker.overview(simple_id, tz), key=lambda item: names.get(item[0], ''))
+    if overview:
+        response += "Лимиты на текущий месяц:\n" + "\n".join(
+            f"{names.get(category_id, category_id)}: {stats.format_amount(spent)} из {stats.format_amount(limit)} "
+            f"({spent * 100 // limit}%)" for category_id, limit, spent in overview)
+    else:
+        response += "Лимиты не заданы. Пример: /budget еда 15000"
+    await message.reply(response, reply_markup=get_back_keyboard())
+
 @router.message(Command(commands=['export']))
 async def export_csv(message: types.Message):
     telegram_id = message.from_user.id
     simple_id = await get_or_create_simple_id(telegram_id)
-    with sqlite3.connect('expenses.db') as conn:
-        df_expenses = pd.read_sql_query('SELECT * FROM expenses WHERE user_id = ?', conn, params=(simple_id,))
-        df_incomes = pd.read_sql_query('SELECT * FROM incomes WHERE user_id = ?', conn, params=(simple_id,))
-        
-        if df_expenses.empty and df_incomes.empty:
-            await message.reply("Нет данных для экспорта.", reply_markup=get_back_keyboard())
+    args = message.text.split()[1:] if message.text and message.text.startswith('/') else []
+    try:
+        options = export.parse_export_args(args, get_user_timezone(simple_id))
+    except ValueError as e:
+        await message.reply(f"Ошибка: {str(e)}. Формат: /export [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД] [расходы|доходы] [gz]",
+                            reply_markup=get_back_keyboard())
+        return
+    
+    content, count = await db.run_bulk(export.build_csv, simple_id, **options)
+    if count == 0:
+        await message.reply("Нет данных для экспорта.", reply_markup=get_back_keyboard())
+        return
+    
+    csv_file = f'транзакции_{simple_id}.csv' + ('.gz' if options['compress'] else '')
+    input_file = types.BufferedInputFile(content, filename=csv_file)
+    await message.reply_document(document=input_file, caption="Ваши расходы и доходы в CSV", reply_markup=get_back_keyboard())
+
+@router.message(Command(commands=['import']))
+async def start_import(message: types.Message, state: FSMContext, command: CommandObject = None):
+    create = command is not None and (command.args or '').strip().lower() == 'create'
+    if message.document:
+        await import_csv(message, create)
+        return
+    await state.set_state(ImportForm.waiting_file)
+    await state.update_data(create_categories=create)
+    await message.reply("Отправьте CSV-файл документом: выгрузку /export или таблицу со столбцами "
+                        "user_id,amount,category,description,date.", reply_markup=get_back_keyboard())
+
+@router.message(ImportForm.waiting_file)
+async def receive_import_file(message: types.Message, state: FSMContext):
+    if not message.document:
+        await message.reply("Нужен файл CSV, отправленный документом.", reply_markup=get_back_keyboard())
+        return
+    data = await state.get_data()
+    await state.clear()
+    await import_csv(message, data.get('create_categories', False))
+
+async def import_csv(message: types.Message, create=False):
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await message.reply(f"Файл больше {IMPORT_MAX_BYTES // 2 ** 20} МБ.", reply_markup=get_back_keyboard())
+        return
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    progress = await message.reply("Импорт: загрузка файла...")
+
+    async def show(text):
+        # Весь ход импорта — правки одного сообщения
+        await bot.edit_message_text(text, chat_id=progress.chat.id, message_id=progress.message_id)
+
+    async with import_slots:
+        try:
+            source = await bot.download(document)
+            table = await asyncio.to_thread(importer.scan, source)
+        except (importer.ImportFormatError, UnicodeDecodeError, OSError, EOFError) as e:
+            await show(f"Импорт невозможен: {e}")
             return
-        
-        dfs = []
-        if not df_expenses.empty:
-            dfs.append(df_expenses.assign(type='расход'))
-        if not df_incomes.empty:
-            dfs.append(df_incomes.assign(type='доход'))
-        
-        if dfs:
-            df_all = pd.concat(dfs, ignore_index=True)
-            df_all = df_all.rename(columns={
-                'user_id': 'ИД_пользователя',
-                'amount': 'Сумма',
-                'category': 'Категория',
-                'description': 'Описание',
-                'date': 'Дата',
-                'type': 'Тип'
-            })
-            csv_file = f'транзакции_{simple_id}.csv'
-            async with aiofiles.open(csv_file, 'w', encoding='utf-8-sig') as f:
-                await f.write('\ufeff')
-                await f.write(df_all.to_csv(index=False, sep=';'))
-            async with aiofiles.open(csv_file, 'rb') as file:
-                content = await file.read()
-                input_file = types.BufferedInputFile(content, filename=csv_file)
-                await message.reply_document(document=input_file, caption="Ваши расходы и доходы в CSV", reply_markup=get_back_keyboard())
-            os.remove(csv_file)
-        else:
-            await message.reply("Нет данных для экспорта.", reply_markup=get_back_keyboard())
+        except Exception as e:
+            logging.error(f"Импорт пользователя {simple_id}: не удалось загрузить файл: {e}")
+            await show(f"Импорт прерван: не удалось загрузить файл ({e}). Ничего не записано.")
+            return
+        entry = await category_index.get(simple_id)
+        missing = sorted((type_, name) for type_, name in table.categories
+                         if (entry.by_name.get(name) is None or entry.by_name[name].type != type_))
+        if missing and create:
+            for type_, name in list(missing):
+                try:
+                    await category_index.add(simple_id, type_, name)
+                    missing.remove((type_, name))
+                except categories.CategoryError as e:
+                    logging.info(f"Импорт: категория «{name}» не создана: {e}")
+        if missing:
+            names = ', '.join(f"{name} ({'расход' if type_ == 'expense' else 'доход'})" for type_, name in missing)
+            await show(f"В файле есть неизвестные категории: {names}. Добавьте их через "
+                       f"/category add или отправьте файл с подписью /import create. Ничего не записано.")
+            return
+        # Архивные категории тоже принимаются: записи из прошлого могут ссылаться на них
+        category_ids = {(category.type, category.name): category.id for category in entry.by_name.values()}
+        # Повторно загруженная выгрузка: записи, которые у пользователя уже есть, пропускаются
+        existing_ids = set()
+        if table.ids:
+            rows = await db.fetchall(importer.EXISTING_IDS, (simple_id, json.dumps(sorted(table.ids))))
+            existing_ids = {row[0] for row in rows}
+        chunks = importer.parse_chunks(table, simple_id, category_ids, get_user_timezone(simple_id), DAY_START_HOUR,
+                                       existing_ids)
+        processed = imported = skipped = duplicates = 0
+        errors = []
+        shown_at = time.monotonic()
+        try:
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                # Каждая порция — своя транзакция: операции, агрегаты и частоты категорий вместе
+                async with db.write() as conn:
+                    await conn.executemany(stats.TRANSACTION_INSERT, chunk.rows)
+                    await conn.executemany(stats.ROLLUP_ADD, chunk.rollups)
+                    await conn.executemany(categories.USAGE_ADD, chunk.usage)
+                processed += chunk.processed
+                imported += len(chunk.rows)
+                skipped += chunk.skipped
+                duplicates += chunk.duplicates
+                errors.extend(chunk.errors)
+                if time.monotonic() - shown_at >= IMPORT_PROGRESS_INTERVAL:
+                    shown_at = time.monotonic()
+                    await show(f"Импорт: обработано {processed} из {table.total} строк, "
+                               f"добавлено {imported}")
+        except Exception as e:
+            logging.error(f"Импорт пользователя {simple_id} прерван: {e}")
+            await show(f"Импорт прерван: {e}. Записано строк: {imported}.")
+            return
+        finally:
+            if imported:
+                stats_cache.invalidate(simple_id)
+                category_index.forget(simple_id)
+                budget_tracker.forget(simple_id)
+    logging.info(f"Импорт пользователя {simple_id}: формат {table.format}, добавлено {imported}, пропущено {skipped}, "
+                 f"повторов {duplicates}")
+    response = f"Импорт завершен: добавлено {imported}, пропущено {skipped}."
+    if duplicates:
+        response += f" Уже были записаны раньше (по ID из выгрузки): {duplicates}."
+    if errors:
+        response += "\n" + "\n".join(f"Строка {line}: {reason}" for line, reason in errors[:importer.MAX_REPORTED_ERRORS])
+    await show(response)
+
+async def remove_transaction(simple_id, transaction_id):
+    # Удаляет запись вместе с её вкладом в дневные итоги; возвращает тип удаленной записи или None
+    async with db.write() as conn:
+        rows = await conn.execute_fetchall(
+            'DELETE FROM transactions WHERE id = ? AND user_id = ? RETURNING type, amount, category_id, ts, utc_offset',
+            (transaction_id, simple_id))
+        if not rows:
+            return None
+        deleted_from, amount, category_id, ts, utc_offset = rows[0]
+        await stats.subtract_from_rollup(conn, simple_id, deleted_from, amount, category_id, ts, utc_offset,
+                                         DAY_START_HOUR)
+    stats_cache.invalidate(simple_id)
+    if deleted_from == 'expense':
+        budget_tracker.subtract(simple_id, stats.accounting_day_of(ts, utc_offset, DAY_START_HOUR), category_id, amount)
+    return deleted_from
+
+@router.message(Command(commands=['history']))
+async def show_history(message: types.Message, command: CommandObject):
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    entry = await category_index.get(simple_id)
+    tz = get_user_timezone(simple_id)
+    try:
+        page = history.parse_history_args(command.args.split() if command.args else [], tz, entry)
+    except ValueError as e:
+        await message.reply(f"Ошибка: {str(e)}. Формат: /history [расходы|доходы] [категория] [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД]",
+                            reply_markup=get_back_keyboard())
+        return
+    text, keyboard = await render_history(simple_id, page, tz, entry)
+    await message.reply(text, reply_markup=keyboard or get_back_keyboard())
+
+@router.message(Command(commands=['find']))
+async def find_transactions(message: types.Message, command: CommandObject):
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    tz = get_user_timezone(simple_id)
+    try:
+        query = search.parse_find_args(command.args.split() if command.args else [], tz, DAY_START_HOUR)
+    except ValueError as e:
+        await message.reply(f"Ошибка: {str(e)}. Формат: /find <слова> [день|неделя|месяц|год] "
+                            f"[ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД] [расходы|доходы]", reply_markup=get_back_keyboard())
+        return
+    async with db.read() as conn:
+        totals, rows = await search.find(conn, simple_id, query)
+    await message.reply(search.render_found(query, totals, rows, tz), reply_markup=get_back_keyboard())
+
+async def render_history(simple_id, page, tz, entry):
+    async with db.read() as conn:
+        rows, newer, older = await history.load_page(conn, simple_id, page)
+    category_name = next((category.name for category in entry.by_name.values() if category.id == page.category), None)
+    return history.render_page(page, rows, newer, older, tz, category_name)
+
+@router.callback_query(history.HistoryPage.filter())
+async def browse_history(callback: types.CallbackQuery, callback_data: history.HistoryPage):
+    if callback_data.action in ('f', 'n'):
+        await purge_confirmed(callback, callback_data)
+        return
+    simple_id = await get_or_create_simple_id(callback.from_user.id)
+    tz = get_user_timezone(simple_id)
+    notice = None
+    if callback_data.action == 'a':
+        rows = await db.fetchall(
+            'SELECT t.id, t.type, t.ts, t.utc_offset, t.amount, c.category, t.description FROM transactions t '
+            'JOIN categories c ON c.id = t.category_id WHERE t.id = ? AND t.user_id = ?', (callback_data.id, simple_id))
+        if rows:
+            text, keyboard = history.render_confirm(callback_data, rows[0])
+            await edit_history(callback, text, keyboard)
+            await callback.answer()
+            return
+        notice = f"Запись с ID {callback_data.id} уже удалена."
+    elif callback_data.action == 'd':
+        deleted_from = await remove_transaction(simple_id, callback_data.id)
+        notice = f"Запись с ID {callback_data.id} " + ("удалена." if deleted_from else "уже удалена.")
+    # После удаления список продолжается с места удаленной записи (dir '='), выше остается кнопка «Новее»
+    page = callback_data.model_copy(update={'action': 'p'})
+    text, keyboard = await render_history(simple_id, page, tz, await category_index.get(simple_id))
+    await edit_history(callback, text, keyboard)
+    await callback.answer(notice)
+
+async def edit_history(callback, text, keyboard):
+    try:
+        await bot.edit_message_text(text, chat_id=callback.message.chat.id, message_id=callback.message.message_id,
+                                    reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        # Повторное нажатие на ту же кнопку: текст страницы не изменился
+        if 'message is not modified' not in str(e):
+            raise
 
 @router.message(Command(commands=['delete']))
-async def start_delete(message: types.Message, state: FSMContext):
-    keyboard = types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="Удалить по ID"), types.KeyboardButton(text="Обнулить статистику")],
-            [types.KeyboardButton(text="Назад")]
-        ],
-        resize_keyboard=True
-    )
+async def start_delete(message: types.Message, state: FSMContext, command: CommandObject = None):
+    # /delete <id> удаляет сразу, в каком бы шаге диалога ни был пользователь
+    if command is not None and command.args:
+        if command.args.strip().isdigit():
+            await delete_transaction(message, state)
+        else:
+            await delete_filtered(message, state, command.args.split())
+        return
     await state.set_state(DeleteForm.choosing_action)
-    await message.reply("Выберите действие:", reply_markup=keyboard)
+    await message.reply("Выберите действие:", reply_markup=DELETE_KEYBOARD)
+
+async def delete_filtered(message: types.Message, state: FSMContext, args):
+    # /delete [расходы|доходы] [категория] [с] [по] — те же фильтры, что у /history
+    await state.clear()
+    simple_id = await get_or_create_simple_id(message.from_user.id)
+    try:
+        page = history.parse_history_args(args, get_user_timezone(simple_id), await category_index.get(simple_id))
+    except ValueError as e:
+        await message.reply(f"Ошибка: {str(e)}. Формат: /delete <id> или "
+                            f"/delete [расходы|доходы] [категория] [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД]",
+                            reply_markup=get_back_keyboard())
+        return
+    count, max_id = await purge.count_matching(db, simple_id, **purge_filters(page))
+    if not count:
+        await message.reply("Подходящих записей не найдено.", reply_markup=get_back_keyboard())
+        return
+    entry = await category_index.get(simple_id)
+    category_name = next((category.name for category in entry.by_name.values() if category.id == page.category), None)
+    text, keyboard = history.render_purge_confirm(page, count, max_id, get_user_timezone(simple_id), category_name)
+    await message.reply(text, reply_markup=keyboard)
+
+def purge_filters(page):
+    return {'type_': history.TYPE_BY_CODE.get(page.type), 'category_id': page.category, 'ts_from': page.since,
+            'ts_to': page.until}
+
+async def purge_confirmed(callback: types.CallbackQuery, callback_data: history.HistoryPage):
+    simple_id = await get_or_create_simple_id(callback.from_user.id)
+    if callback_data.action == 'f':
+        deleted = await purge.purge(db, simple_id, DAY_START_HOUR, max_id=callback_data.id,
+                                    **purge_filters(callback_data))
+        stats_cache.invalidate(simple_id)
+        budget_tracker.forget(simple_id)
+        text = f"Удалено записей: {deleted}." if deleted else "Подходящих записей уже нет."
+    else:
+        text = "Удаление отменено."
+    await edit_history(callback, text, None)
+    await callback.answer()
 
 @router.message(DeleteForm.choosing_action)
 async def process_delete_action(message: types.Message, state: FSMContext):
@@ -616,13 +970,11 @@ async def process_delete_action(message: types.Message, state: FSMContext):
     simple_id = await get_or_create_simple_id(telegram_id)
     if action == "Удалить по ID":
         await state.set_state(DeleteForm.entering_id)
-        await message.reply("Введите /delete <id> для удаления записи.", reply_markup=get_back_keyboard())
+        await message.reply("Введите ID записи или /delete <id> для удаления.", reply_markup=get_back_keyboard())
     elif action == "Обнулить статистику":
-        async with aiosqlite.connect('expenses.db') as conn:
-            c = await conn.cursor()
-            await c.execute('DELETE FROM expenses WHERE user_id = ?', (simple_id,))
-            await c.execute('DELETE FROM incomes WHERE user_id = ?', (simple_id,))
-            await conn.commit()
+        await purge.purge(db, simple_id, DAY_START_HOUR)
+        stats_cache.invalidate(simple_id)
+        budget_tracker.forget(simple_id)
         await message.reply("Вся ваша статистика обнулена.", reply_markup=get_back_keyboard())
         await state.clear()
     elif action == "Назад":
@@ -634,32 +986,25 @@ async def process_delete_action(message: types.Message, state: FSMContext):
 async def delete_transaction(message: types.Message, state: FSMContext):
     try:
         parts = message.text.split()
-        if len(parts) != 2 or parts[0] != "/delete":
+        if parts and parts[0].startswith('/delete'):
+            parts = parts[1:]
+        if len(parts) != 1:
             await message.reply("Неверный формат. Используйте: /delete <id>", reply_markup=get_back_keyboard())
             return
-        transaction_id = int(parts[1])
+        transaction_id = int(parts[0])
         
         telegram_id = message.from_user.id
         simple_id = await get_or_create_simple_id(telegram_id)
         
-        async with aiosqlite.connect('expenses.db') as conn:
-            c = await conn.cursor()
-            await c.execute('DELETE FROM expenses WHERE id = ? AND user_id = ?', (transaction_id, simple_id))
-            if c.rowcount > 0:
-                await conn.commit()
-                await message.reply(f"Запись с ID {transaction_id} удалена из расходов.", reply_markup=get_back_keyboard())
-                await state.clear()
-                return
-            
-            await c.execute('DELETE FROM incomes WHERE id = ? AND user_id = ?', (transaction_id, simple_id))
-            if c.rowcount > 0:
-                await conn.commit()
-                await message.reply(f"Запись с ID {transaction_id} удалена из доходов.", reply_markup=get_back_keyboard())
-                await state.clear()
-                return
-            
-            await message.reply(f"Запись с ID {transaction_id} не найдена.", reply_markup=get_back_keyboard())
+        deleted_from = await remove_transaction(simple_id, transaction_id)
+        if deleted_from is not None:
+            place = "расходов" if deleted_from == 'expense' else "доходов"
+            await message.reply(f"Запись с ID {transaction_id} удалена из {place}.", reply_markup=get_back_keyboard())
             await state.clear()
+            return
+        
+        await message.reply(f"Запись с ID {transaction_id} не найдена.", reply_markup=get_back_keyboard())
+        await state.clear()
     except ValueError:
         await message.reply("ID должен быть числом.", reply_markup=get_back_keyboard())
     except Exception as e:
@@ -669,10 +1014,64 @@ async def delete_transaction(message: types.Message, state: FSMContext):
 
 dp.include_router(router)
 
+def health_info():
+    return {
+        'write_queue': db.write_queue.stats(),
+        'stats_cache': stats_cache.stats(),
+        'id_cache': simple_ids.stats(),
+        'user_settings': user_settings.stats(),
+        'fsm_storage': storage.stats(),
+        'categories': category_index.stats(),
+        'budgets': budget_tracker.stats(),
+        'outbound': outbox.stats(),
+        'maintenance': maintenance.stats(),
+        'digests': digests.stats(),
+    }
+
 async def main():
-    await init_db()
-    await update_user_ids_in_tables()
-    await dp.start_polling(bot)
+    if BOT_WORKERS > 1 and BOT_MODE != 'worker':
+        # Фронт не открывает базу: данные лежат в шардах у воркеров
+        await workers.run_front(dp, bot, BOT_WORKERS, DB_PATH, mode=BOT_MODE, host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                                path=WEBHOOK_PATH, url=WEBHOOK_URL, secret=WEBHOOK_SECRET,
+                                health_port=int(HEALTH_PORT) if HEALTH_PORT else None)
+        return
+    metrics_runner = None
+    await db.open()
+    try:
+        started = time.perf_counter()
+        await init_db()
+        migrations_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        await warm_caches()
+        storage.start()
+        maintenance.start()
+        digests.start()
+        metrics_registry.start()
+        if METRICS_PORT:
+            port = int(METRICS_PORT) + (1 + int(os.getenv('WORKER_INDEX', 0)) if BOT_MODE == 'worker' else 0)
+            metrics_runner = await metrics.start_server(metrics_registry, host=METRICS_HOST, port=port)
+        warmup_seconds = time.perf_counter() - started
+        logging.info(f"Запуск: импорты {IMPORTS_SECONDS:.2f} с, миграции {migrations_seconds:.2f} с, "
+                     f"прогрев кэшей {warmup_seconds:.2f} с")
+        if BOT_MODE == 'worker':
+            await workers.run_worker(dp, bot, concurrency=WEBHOOK_CONCURRENCY, health=health_info)
+        elif BOT_MODE == 'webhook':
+            await webhook.run_webhook(dp, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                                      url=WEBHOOK_URL, secret=WEBHOOK_SECRET, concurrency=WEBHOOK_CONCURRENCY,
+                                      health=health_info)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        logging.info(f"Кэш статистики: {stats_cache.stats()}")
+        logging.info(f"Кэш ID: {simple_ids.stats()}")
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await metrics_registry.stop()
+        await digests.stop()
+        await outbox.close()
+        await maintenance.stop()
+        await storage.close()
+        await db.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
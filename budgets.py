@@ -0,0 +1,116 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import stats
+from lru import SingleFlightLRU
+
+# Месячные лимиты расходов по категориям (/budget). Для недавно активных
+# пользователей в памяти (LRU) лежат лимиты и расходы с начала текущего учетного
+# месяца по категориям: суммы один раз читаются из daily_totals и дальше меняются
+# вместе с записью и удалением операций, поэтому проверка лимита после расхода —
+# сравнение двух чисел без запроса к базе. Месяц берется из учетного дня операции
+# (часовой пояс пользователя и DAY_START_HOUR), как в daily_totals; первая операция
+# нового месяца обнуляет суммы. У пользователей без лимитов суммы не загружаются.
+ALERT_THRESHOLDS = (80, 100)
+
+LOAD_LIMITS = 'SELECT category_id, amount FROM budgets WHERE user_id = ?'
+LOAD_MONTH_SPENT = '''SELECT category_id, SUM(amount) FROM daily_totals
+                      WHERE user_id = ? AND type = 'expense' AND day >= ? GROUP BY category_id'''
+LIMIT_UPSERT = '''INSERT INTO budgets (user_id, category_id, amount) VALUES (?, ?, ?)
+                  ON CONFLICT (user_id, category_id) DO UPDATE SET amount = excluded.amount'''
+
+
+@dataclass
+class UserBudgets:
+    # limits и spent: category_id -> копейки; month — 'ГГГГ-ММ', к которому относится spent
+    limits: dict = field(default_factory=dict)
+    month: str = ''
+    spent: dict = field(default_factory=dict)
+
+
+def alert_text(category, threshold, spent, limit):
+    if threshold >= 100:
+        return (f"Лимит по категории «{category}» превышен: потрачено {stats.format_amount(spent)} "
+                f"из {stats.format_amount(limit)} за месяц.")
+    return (f"Внимание: по категории «{category}» потрачено {stats.format_amount(spent)} "
+            f"из {stats.format_amount(limit)} ({spent * 100 // limit}% месячного лимита).")
+
+
+class BudgetTracker:
+    # Лимиты и суммы по пользователям в SingleFlightLRU
+    def __init__(self, db, day_start_hour=0, maxsize=10000):
+        self.db = db
+        self.day_start_hour = day_start_hour
+        self.maxsize = maxsize
+        self._cache = SingleFlightLRU(self._load, maxsize)
+        self.alerts = 0
+
+    def current_month(self, tz):
+        return stats.accounting_day(datetime.now(tz), self.day_start_hour)[:7]
+
+    async def get(self, user_id, tz):
+        return await self._cache.get(user_id, tz)
+
+    async def _load(self, user_id, tz):
+        entry = UserBudgets(limits=dict(await self.db.fetchall(LOAD_LIMITS, (user_id,))))
+        if entry.limits:
+            entry.month = self.current_month(tz)
+            entry.spent = dict(await self.db.fetchall(LOAD_MONTH_SPENT, (user_id, entry.month + '-01')))
+        return entry
+
+    def forget(self, user_id):
+        # После массовых изменений (импорт, удаление по фильтру) суммы перечитываются при следующем обращении
+        self._cache.pop(user_id)
+
+    def record(self, entry, day, category_id, amount):
+        # Учитывает расход после записи в базу; entry нужно получить через get() до записи,
+        # иначе загруженная сумма уже будет содержать этот расход. Возвращает
+        # (порог в процентах, потрачено, лимит) для старшего пройденного этим расходом порога или None
+        if not entry.limits:
+            return None
+        month = day[:7]
+        if month != entry.month:
+            if month < entry.month:
+                return None
+            entry.month, entry.spent = month, {}
+        before = entry.spent.get(category_id, 0)
+        after = entry.spent[category_id] = before + amount
+        limit = entry.limits.get(category_id)
+        if limit is None:
+            return None
+        crossed = [threshold for threshold in ALERT_THRESHOLDS if before * 100 < limit * threshold <= after * 100]
+        if not crossed:
+            return None
+        self.alerts += 1
+        return crossed[-1], after, limit
+
+    def subtract(self, user_id, day, category_id, amount):
+        entry = self._cache.peek(user_id)
+        if entry is not None and entry.limits and day[:7] == entry.month and category_id in entry.spent:
+            entry.spent[category_id] -= amount
+
+    async def set_limit(self, user_id, category_id, amount):
+        # amount 0 снимает лимит
+        if amount:
+            await self.db.execute(LIMIT_UPSERT, (user_id, category_id, amount))
+        else:
+            await self.db.execute('DELETE FROM budgets WHERE user_id = ? AND category_id = ?', (user_id, category_id))
+        # Первый лимит требует загрузки сумм за месяц, проще перечитать пользователя целиком
+        self.forget(user_id)
+
+    async def overview(self, user_id, tz):
+        # [(category_id, лимит, потрачено с начала месяца)]
+        entry = await self.get(user_id, tz)
+        month = self.current_month(tz)
+        if entry.limits and entry.month != month:
+            entry.month, entry.spent = month, {}
+        return [(category_id, limit, entry.spent.get(category_id, 0)) for category_id, limit in entry.limits.items()]
+
+    def stats(self):
+        lookups = self._cache.hits + self._cache.misses
+        return {
+            'size': len(self._cache),
+            'maxsize': self.maxsize,
+            'hit_rate': self._cache.hits / lookups if lookups else 0.0,
+            'alerts': self.alerts,
+        }
@@ -0,0 +1,215 @@
+import difflib
+from dataclasses import dataclass, field
+
+from aiogram import types
+
+from lru import SingleFlightLRU
+
+# Категории пользователя — общие (categories.user_id IS NULL) плюс собственные
+# (user_id = simple_id). Архивирование и счетчик использований хранятся в
+# user_categories отдельно для каждого пользователя, поэтому общую категорию
+# можно скрыть у себя, не трогая остальных. В памяти держится индекс только для
+# недавно активных пользователей (LRU): словарь имя -> категория для проверки
+# ввода и готовые клавиатуры, которые пересобираются только при смене версии
+# (добавление, переименование, архив или изменение порядка по частоте).
+MAX_NAME_LENGTH = 32
+BACK_BUTTON = "Назад"
+# Тексты, которые перехватываются обработчиками раньше выбора категории
+RESERVED_NAMES = {BACK_BUTTON, "Меню", "s", "Статистика", "Категории", "Экспорт", "Удалить", "Часовой пояс",
+                  "Инструкция", "Удалить по ID", "Обнулить статистику"}
+RESERVED_PREFIXES = ('-', '+', '/')
+# Насколько похожим должно быть слово, чтобы считаться опечаткой в названии категории
+FUZZY_CUTOFF = 0.8
+
+LOAD_USER_CATEGORIES = '''SELECT c.id, c.user_id, c.category, c.type, IFNULL(u.archived, 0), IFNULL(u.uses, 0)
+                          FROM categories c
+                          LEFT JOIN user_categories u ON u.user_id = ? AND u.category_id = c.id
+                          WHERE IFNULL(c.user_id, 0) IN (0, ?)'''
+USAGE_UPSERT = '''INSERT INTO user_categories (user_id, category_id, uses) VALUES (?, ?, 1)
+                  ON CONFLICT (user_id, category_id) DO UPDATE SET uses = uses + 1'''
+USAGE_ADD = '''INSERT INTO user_categories (user_id, category_id, uses) VALUES (?, ?, ?)
+               ON CONFLICT (user_id, category_id) DO UPDATE SET uses = uses + excluded.uses'''
+ARCHIVE_UPSERT = '''INSERT INTO user_categories (user_id, category_id, archived) VALUES (?, ?, ?)
+                    ON CONFLICT (user_id, category_id) DO UPDATE SET archived = excluded.archived'''
+
+
+class CategoryError(ValueError):
+    pass
+
+
+@dataclass
+class Category:
+    id: int
+    name: str
+    type: str
+    own: bool
+    archived: bool = False
+    uses: int = 0
+
+
+@dataclass
+class UserCategories:
+    by_name: dict = field(default_factory=dict)
+    # Активные категории каждого типа по убыванию частоты использования
+    order: dict = field(default_factory=lambda: {'expense': [], 'income': []})
+    version: int = 0
+    keyboards: dict = field(default_factory=dict)
+    # Активные категории по названию в нижнем регистре, для быстрого ввода
+    lowered: dict = field(default_factory=dict)
+
+    def find(self, type_, name):
+        category = self.by_name.get(name)
+        if category is None or category.type != type_ or category.archived:
+            return None
+        return category
+
+    def reorder(self):
+        for type_ in self.order:
+            self.order[type_] = sorted((category for category in self.by_name.values()
+                                        if category.type == type_ and not category.archived),
+                                       key=lambda category: (-category.uses, category.id))
+            self.lowered[type_] = {category.name.lower(): category for category in self.order[type_]}
+        self.version += 1
+
+    def match(self, type_, words):
+        # Категория по началу текста: самый длинный набор первых слов, совпадающий с
+        # названием без учета регистра; иначе единственная категория, начинающаяся с
+        # первого слова; иначе ближайшая по написанию. Возвращает (категория, сколько слов заняла)
+        names = self.lowered.get(type_, {})
+        for count in range(min(len(words), MAX_NAME_LENGTH // 2), 0, -1):
+            category = names.get(' '.join(words[:count]).lower())
+            if category is not None:
+                return category, count
+        if not words:
+            return None, 0
+        first = words[0].lower()
+        candidates = [category for name, category in names.items() if name.startswith(first)]
+        if len(candidates) == 1:
+            return candidates[0], 1
+        close = difflib.get_close_matches(first, names, n=1, cutoff=FUZZY_CUTOFF)
+        if close:
+            return names[close[0]], 1
+        return None, 0
+
+
+def build_category_keyboard(names):
+    return types.ReplyKeyboardMarkup(
+        keyboard=[
+            [types.KeyboardButton(text=name) for name in names[i:i + 2]] for i in range(0, len(names), 2)
+        ] + [[types.KeyboardButton(text=BACK_BUTTON)]],
+        resize_keyboard=True
+    )
+
+
+def check_name(name):
+    name = ' '.join(name.split())
+    if not name:
+        raise CategoryError("Название категории не может быть пустым")
+    if len(name) > MAX_NAME_LENGTH:
+        raise CategoryError(f"Название категории длиннее {MAX_NAME_LENGTH} символов")
+    if name in RESERVED_NAMES or name.startswith(RESERVED_PREFIXES):
+        raise CategoryError(f"Название «{name}» занято кнопкой или командой бота")
+    return name
+
+
+class CategoryIndex:
+    # Индекс категорий по пользователям с вытеснением LRU; параллельные промахи по
+    # одному пользователю схлопываются в одну загрузку
+    def __init__(self, db, maxsize=10000):
+        self.db = db
+        self.maxsize = maxsize
+        self._cache = SingleFlightLRU(self._load, maxsize)
+        self.keyboards_built = 0
+
+    async def get(self, user_id):
+        return await self._cache.get(user_id)
+
+    async def _load(self, user_id):
+        entry = UserCategories()
+        for category_id, owner, name, type_, archived, uses in await self.db.fetchall(LOAD_USER_CATEGORIES,
+                                                                                       (user_id, user_id)):
+            entry.by_name[name] = Category(category_id, name, type_, own=owner is not None, archived=bool(archived),
+                                           uses=uses)
+        entry.reorder()
+        return entry
+
+    async def keyboard(self, user_id, type_):
+        entry = await self.get(user_id)
+        cached = entry.keyboards.get(type_)
+        if cached is None or cached[0] != entry.version:
+            cached = entry.keyboards[type_] = (entry.version, build_category_keyboard(
+                [category.name for category in entry.order[type_]]))
+            self.keyboards_built += 1
+        return cached[1]
+
+    def forget(self, user_id):
+        # После массовых изменений (импорт) пользователь перечитывается из базы при следующем обращении
+        self._cache.pop(user_id)
+
+    def record_use(self, entry, user_id, category):
+        # Возвращает запрос для очереди записи; порядок (и версия клавиатуры) меняется,
+        # только если категория обогнала соседнюю
+        category.uses += 1
+        order = entry.order[category.type]
+        if category in order:
+            index = order.index(category)
+            if index > 0 and order[index - 1].uses < category.uses:
+                entry.reorder()
+        return USAGE_UPSERT, (user_id, category.id)
+
+    async def add(self, user_id, type_, name):
+        entry = await self.get(user_id)
+        name = check_name(name)
+        existing = entry.by_name.get(name)
+        if existing is not None:
+            if existing.archived and existing.type == type_:
+                await self.set_archived(user_id, name, False)
+                return existing
+            raise CategoryError(f"Категория «{name}» уже есть")
+        async with self.db.write() as conn:
+            rows = await conn.execute_fetchall('INSERT INTO categories (user_id, category, type) VALUES (?, ?, ?) '
+                                               'RETURNING id', (user_id, name, type_))
+        category = entry.by_name[name] = Category(rows[0][0], name, type_, own=True)
+        entry.reorder()
+        return category
+
+    async def rename(self, user_id, old_name, new_name):
+        entry = await self.get(user_id)
+        category = entry.by_name.get(' '.join(old_name.split()))
+        if category is None:
+            raise CategoryError(f"Категория «{old_name}» не найдена")
+        if not category.own:
+            raise CategoryError(f"«{category.name}» — общая категория, её можно только архивировать. "
+                                f"Добавьте свою категорию с новым названием")
+        new_name = check_name(new_name)
+        if new_name in entry.by_name:
+            raise CategoryError(f"Категория «{new_name}» уже есть")
+        await self.db.execute('UPDATE categories SET category = ? WHERE id = ? AND user_id = ?',
+                              (new_name, category.id, user_id))
+        del entry.by_name[category.name]
+        category.name = new_name
+        entry.by_name[new_name] = category
+        entry.reorder()
+        return category
+
+    async def set_archived(self, user_id, name, archived):
+        entry = await self.get(user_id)
+        category = entry.by_name.get(' '.join(name.split()))
+        if category is None:
+            raise CategoryError(f"Категория «{name}» не найдена")
+        await self.db.execute(ARCHIVE_UPSERT, (user_id, category.id, int(archived)))
+        category.archived = archived
+        entry.reorder()
+        return category
+
+    def stats(self):
+        lookups = self._cache.hits + self._cache.misses
+        return {
+            'size': len(self._cache),
+            'maxsize': self.maxsize,
+            'hits': self._cache.hits,
+            'misses': self._cache.misses,
+            'hit_rate': self._cache.hits / lookups if lookups else 0.0,
+            'evictions': self._cache.evictions,
+            'keyboards_built': self.keyboards_built,
+        }
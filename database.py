@@ -0,0 +1,380 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+from aiosqlite.context import Result
+
+# Настройки, применяемые к каждому соединению
+CONNECTION_PRAGMAS = (
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',
+)
+# Размер LRU-кэша подготовленных выражений в модуле sqlite3 (на соединение)
+STATEMENT_CACHE_SIZE = 256
+# Групповая фиксация: максимальный размер пачки и время ожидания попутчиков
+WRITE_BATCH_SIZE = 256
+WRITE_BATCH_DELAY = 0.005
+# Сколько тяжелых чтений (экспорт) может выполняться одновременно
+BULK_SLOTS = 2
+# Обслуживание: как часто проверять, сколько секунд без записей считать затишьем
+# и сколько свободных страниц возвращать системе за один шаг incremental_vacuum
+MAINTENANCE_INTERVAL = 300
+MAINTENANCE_QUIET = 30
+VACUUM_STEP_PAGES = 1000
+
+
+class WriteQueue:
+    # Очередь отложенной записи: обработчики кладут в неё свои INSERT-ы и ждут future,
+    # а одна задача-писатель сбрасывает накопившееся пачками через executemany в одной
+    # транзакции. Future завершается только после COMMIT, поэтому подтверждение
+    # пользователю уходит, когда данные уже в базе. Подходит только для коммутативных
+    # записей (вставки, upsert-ы), так как выражения внутри пачки группируются по SQL.
+    def __init__(self, db, batch_size=WRITE_BATCH_SIZE, delay=WRITE_BATCH_DELAY):
+        self.db = db
+        self.batch_size = batch_size
+        self.delay = delay
+        self._queue = None
+        self._task = None
+        self.batches = 0
+        self.rows = 0
+        self.max_batch = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+        logging.info(f"Очередь записи остановлена: {self.stats()}")
+
+    async def submit(self, *statements):
+        # statements: пары (sql, params), которые должны попасть в одну транзакцию
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((statements, future))
+        return await future
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'avg_batch': self.rows / self.batches if self.batches else 0.0,
+            'max_batch': self.max_batch,
+            'avg_flush_ms': self.flush_seconds * 1000 / self.batches if self.batches else 0.0,
+            'max_flush_ms': self.max_flush_seconds * 1000,
+            'pending': self._queue.qsize() if self._queue else 0,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.delay
+            while len(batch) < self.batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        started = time.perf_counter()
+        grouped = {}
+        for statements, _ in batch:
+            for sql, params in statements:
+                grouped.setdefault(sql, []).append(params)
+        try:
+            async with self.db.write() as conn:
+                for sql, rows in grouped.items():
+                    await conn.executemany(sql, rows)
+        except Exception as e:
+            # Одна плохая запись не должна ронять всю пачку: повторяем поштучно
+            logging.error(f"Ошибка групповой записи ({len(batch)} шт.), повтор поштучно: {e}")
+            for statements, future in batch:
+                try:
+                    async with self.db.write() as conn:
+                        for sql, params in statements:
+                            await conn.execute(sql, params)
+                except Exception as item_error:
+                    if not future.done():
+                        future.set_exception(item_error)
+                else:
+                    if not future.done():
+                        future.set_result(None)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.rows += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self.flush_seconds += elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        logging.debug(f"Сброшена пачка из {len(batch)} записей за {elapsed * 1000:.1f} мс")
+
+
+class Maintenance:
+    # Фоновое обслуживание базы в затишье (нет записей MAINTENANCE_QUIET секунд):
+    # incremental_vacuum возвращает освободившиеся после удалений страницы
+    # небольшими шагами, отпуская писателя между ними; затем PRAGMA optimize и
+    # пассивный checkpoint WAL, который не ждет читателей.
+    def __init__(self, db, interval=MAINTENANCE_INTERVAL, quiet=MAINTENANCE_QUIET, step_pages=VACUUM_STEP_PAGES):
+        self.db = db
+        self.interval = interval
+        self.quiet = quiet
+        self.step_pages = step_pages
+        self._task = None
+        self.runs = 0
+        self.skipped = 0
+        self.pages_freed = 0
+        self.checkpointed = 0
+        self.last_seconds = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if time.monotonic() - self.db.last_write < self.quiet:
+                self.skipped += 1
+                continue
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"Ошибка обслуживания базы: {e}")
+
+    async def run_once(self):
+        started = time.perf_counter()
+        freed = 0
+        while True:
+            async with self.db.write() as conn:
+                free = (await conn.execute_fetchall('PRAGMA freelist_count'))[0][0]
+                if not free:
+                    break
+                # execute() модуля sqlite3 делает один шаг выражения, то есть освобождает одну
+                # страницу; executescript выполняет PRAGMA до конца
+                await conn.executescript(f'PRAGMA incremental_vacuum({self.step_pages})')
+                freed += min(free, self.step_pages)
+            # Между шагами писателя забирают ожидающие записи; если они были, затишье кончилось
+            await asyncio.sleep(0)
+            if self.db.write_busy or free <= self.step_pages:
+                break
+        async with self.db.write() as conn:
+            await conn.execute_fetchall('PRAGMA optimize')
+        async with self.db.write() as conn:
+            busy, wal_frames, checkpointed = (await conn.execute_fetchall('PRAGMA wal_checkpoint(PASSIVE)'))[0]
+        self.runs += 1
+        self.pages_freed += freed
+        self.checkpointed += max(checkpointed, 0)
+        self.last_seconds = time.perf_counter() - started
+        logging.info(f"Обслуживание базы: освобождено страниц {freed}, checkpoint {checkpointed}/{wal_frames} "
+                     f"кадров WAL за {self.last_seconds * 1000:.0f} мс")
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'pages_freed': self.pages_freed,
+            'checkpointed_frames': self.checkpointed,
+            'last_ms': self.last_seconds * 1000,
+        }
+
+
+class TimedConnection:
+    # Обертка над соединением aiosqlite, которая сообщает время каждого запроса в
+    # observer(sql, seconds). Остальные атрибуты соединения передаются как есть.
+    def __init__(self, conn, observer):
+        self._conn = conn
+        self._observer = observer
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def _timed(self, sql, coro):
+        started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self._observer(sql, time.perf_counter() - started)
+
+    def execute(self, sql, parameters=None):
+        return Result(self._timed(sql, self._conn.execute(sql, parameters)))
+
+    def executemany(self, sql, parameters):
+        return Result(self._timed(sql, self._conn.executemany(sql, parameters)))
+
+    async def execute_fetchall(self, sql, parameters=None):
+        return await self._timed(sql, self._conn.execute_fetchall(sql, parameters))
+
+
+class Database:
+    # Одно соединение-писатель (все записи сериализуются через него) и небольшой
+    # пул соединений только для чтения. В режиме WAL читатели не блокируют писателя.
+    def __init__(self, path, readers=4):
+        self.path = path
+        self.readers = readers
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._pool = None
+        self._bulk_slots = asyncio.Semaphore(BULK_SLOTS)
+        self.write_queue = WriteQueue(self)
+        # Время последней транзакции записи (time.monotonic), по нему Maintenance ищет затишье
+        self.last_write = 0.0
+        # observer(sql, seconds) получает время каждого запроса (метрики); None — без замеров
+        self.observer = None
+
+    async def _connect(self, query_only=False):
+        conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        pragmas = CONNECTION_PRAGMAS + (('PRAGMA query_only=ON',) if query_only else ())
+        try:
+            for pragma in pragmas:
+                await conn.execute_fetchall(pragma)
+        except Exception:
+            await conn.close()
+            raise
+        return conn
+
+    async def open(self):
+        self._writer = await self._connect()
+        self._pool = asyncio.Queue()
+        try:
+            await self._ensure_incremental_vacuum()
+            await self._writer.execute_fetchall('PRAGMA journal_mode=WAL')
+            for _ in range(self.readers):
+                self._pool.put_nowait(await self._connect(query_only=True))
+        except Exception:
+            while not self._pool.empty():
+                await self._pool.get_nowait().close()
+            await self._writer.close()
+            self._writer = None
+            raise
+        self.write_queue.start()
+        logging.info(f"База данных {self.path} открыта: 1 писатель, {self.readers} читателей")
+
+    async def _ensure_incremental_vacuum(self):
+        # Новая база получает режим сразу; существующую один раз переписывает VACUUM
+        if (await self._writer.execute_fetchall('PRAGMA auto_vacuum'))[0][0] == 2:
+            return
+        await self._writer.execute_fetchall('PRAGMA auto_vacuum=INCREMENTAL')
+        if (await self._writer.execute_fetchall('PRAGMA auto_vacuum'))[0][0] == 2:
+            return
+        started = time.perf_counter()
+        await self._writer.execute_fetchall('VACUUM')
+        logging.info(f"База {self.path} переведена в auto_vacuum=INCREMENTAL за {time.perf_counter() - started:.2f} с")
+
+    async def close(self):
+        if self._writer is None:
+            return
+        # Сначала сбрасываем очередь записи, затем дожидаемся возврата всех читателей
+        # и завершения текущей записи
+        await self.write_queue.stop()
+        for _ in range(self.readers):
+            conn = await self._pool.get()
+            await conn.close()
+        async with self._write_lock:
+            await self._writer.execute_fetchall('PRAGMA optimize')
+            await self._writer.close()
+            self._writer = None
+        logging.info(f"База данных {self.path} закрыта")
+
+    @property
+    def write_busy(self):
+        # Писатель занят или его уже ждут
+        return self._write_lock.locked()
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._pool.get()
+        try:
+            yield conn if self.observer is None else TimedConnection(conn, self.observer)
+        finally:
+            self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        # Транзакция на соединении-писателе: commit при успехе, rollback при ошибке
+        async with self._write_lock:
+            try:
+                yield self._writer if self.observer is None else TimedConnection(self._writer, self.observer)
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            finally:
+                self.last_write = time.monotonic()
+
+    async def fetchone(self, sql, params=()):
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        async with self.read() as conn:
+            return await conn.execute_fetchall(sql, params)
+
+    async def run_bulk(self, fn, *args, **kwargs):
+        # Тяжелое чтение целиком выполняется в рабочем потоке на собственном соединении
+        # только для чтения: не занимает пул читателей и не блокирует цикл событий.
+        # fn получает sqlite3.Connection первым аргументом.
+        async with self._bulk_slots:
+            started = time.perf_counter()
+            try:
+                return await asyncio.to_thread(self._run_bulk, fn, args, kwargs)
+            finally:
+                if self.observer is not None:
+                    self.observer(f'bulk:{fn.__module__}.{fn.__name__}', time.perf_counter() - started)
+
+    def _run_bulk(self, fn, args, kwargs):
+        conn = sqlite3.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        try:
+            for pragma in CONNECTION_PRAGMAS + ('PRAGMA query_only=ON',):
+                conn.execute(pragma)
+            return fn(conn, *args, **kwargs)
+        finally:
+            conn.close()
+
+    async def enqueue(self, *statements):
+        # Запись через групповую фиксацию; возвращается после COMMIT
+        await self.write_queue.submit(*statements)
+
+    async def execute(self, sql, params=()):
+        async with self.write() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return cursor.rowcount
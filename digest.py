@@ -0,0 +1,231 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from aiogram.exceptions import TelegramForbiddenError
+
+import outbound
+import stats
+
+# Ежедневные и еженедельные итоги по подписке (/digest). Раз в DIGEST_INTERVAL
+# планировщик делит подписчиков на группы по часовому поясу: пояса, у которых
+# сейчас одинаковые последний завершенный учетный день и неделя, попадают в одну
+# группу. Для каждой группы подписчики выбираются порциями по DIGEST_BATCH, итоги
+# всей порции считаются одним запросом к daily_totals, а сообщения уходят через
+# общую очередь исходящих с низким приоритетом (outbound.bulk()).
+# Перед отправкой порция помечается отправленной (daily_sent / weekly_sent), поэтому
+# после перезапуска уже помеченное не повторяется, а пропущенное во время простоя
+# уходит при первой проверке: при сбое посреди порции часть итогов теряется, но
+# дважды ничего не отправляется.
+DIGEST_INTERVAL = 60
+DIGEST_BATCH = 500
+KINDS = ('daily', 'weekly')
+
+DUE_SUBSCRIBERS = '''SELECT s.user_id, m.telegram_id,
+                            s.daily AND IFNULL(s.daily_sent, '') < :daily,
+                            s.weekly AND IFNULL(s.weekly_sent, '') < :weekly
+                     FROM digest_subscriptions s
+                     JOIN user_id_mapping m ON m.simple_id = s.user_id
+                     LEFT JOIN user_settings u ON u.user_id = s.user_id
+                     WHERE s.user_id > :after
+                       AND IFNULL(u.timezone, :default) IN (SELECT value FROM json_each(:zones))
+                       AND ((s.daily AND IFNULL(s.daily_sent, '') < :daily)
+                            OR (s.weekly AND IFNULL(s.weekly_sent, '') < :weekly))
+                     ORDER BY s.user_id LIMIT :limit'''
+# Итоги всех пользователей порции за период одним запросом по первичному ключу агрегатов
+BATCH_TOTALS = '''SELECT t.user_id, t.type, c.category, SUM(t.amount) FROM daily_totals t
+                  JOIN categories c ON c.id = t.category_id
+                  WHERE t.user_id IN (SELECT value FROM json_each(?)) AND t.day >= ? AND t.day < ?
+                  GROUP BY t.user_id, t.type, c.category'''
+SUBSCRIPTION_UPSERT = '''INSERT INTO digest_subscriptions (user_id, daily, weekly, daily_sent, weekly_sent)
+                         VALUES (?, ?, ?, ?, ?)
+                         ON CONFLICT (user_id) DO UPDATE SET daily = excluded.daily, weekly = excluded.weekly,
+                             daily_sent = MAX(IFNULL(daily_sent, ''), excluded.daily_sent),
+                             weekly_sent = MAX(IFNULL(weekly_sent, ''), excluded.weekly_sent)'''
+
+
+def period_keys(now, day_start_hour):
+    # Начала последнего завершенного учетного дня и недели (локальное время пользователя)
+    starts = stats.period_starts(now, day_start_hour)
+    today, week_start = date.fromisoformat(starts['день']), date.fromisoformat(starts['неделю'])
+    return {'daily': (today - timedelta(days=1)).isoformat(), 'weekly': (week_start - timedelta(days=7)).isoformat()}
+
+
+def period_end(kind, start):
+    return (date.fromisoformat(start) + timedelta(days=1 if kind == 'daily' else 7)).isoformat()
+
+
+def render_totals(title, totals):
+    text = f"{title}\n"
+    if totals.expenses:
+        text += "Расходы:\n" + "".join(f"{category}: {stats.format_amount(amount)}\n"
+                                       for category, amount in sorted(totals.expenses.items()))
+    if totals.incomes:
+        text += "Доходы:\n" + "".join(f"{category}: {stats.format_amount(amount)}\n"
+                                      for category, amount in sorted(totals.incomes.items()))
+    text += f"Итого расходы: {stats.format_amount(totals.total_expenses)}\n"
+    text += f"Итого доходы: {stats.format_amount(totals.total_incomes)}\n"
+    return text + f"Баланс: {stats.format_amount(totals.balance)}\n"
+
+
+def period_title(kind, start):
+    first = date.fromisoformat(start)
+    if kind == 'daily':
+        return f"Итоги за {first.strftime('%d.%m.%Y')}:"
+    return f"Итоги недели {first.strftime('%d.%m')}–{(first + timedelta(days=6)).strftime('%d.%m.%Y')}:"
+
+
+class DigestScheduler:
+    # send(telegram_id, text) отправляет сообщение; zone(name) возвращает ZoneInfo
+    # (users.UserSettingsCache.zone). dry_run: итоги считаются и замеряются, но не
+    # отправляются и не помечаются
+    def __init__(self, db, send, zone, default_timezone='UTC', day_start_hour=0, interval=DIGEST_INTERVAL,
+                 batch_size=DIGEST_BATCH, dry_run=False):
+        self.db = db
+        self.send = send
+        self.zone = zone
+        self.default_timezone = default_timezone
+        self.day_start_hour = day_start_hour
+        self.interval = interval
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self._task = None
+        self.runs = 0
+        self.users = 0
+        self.sent = 0
+        self.empty = 0
+        self.failed = 0
+        self.unsubscribed = 0
+        self.last_seconds = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"Ошибка рассылки итогов: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def subscribe(self, user_id, tz, daily, weekly):
+        # Первые итоги — за период, который завершится после подписки, а не за уже прошедший
+        keys = period_keys(datetime.now(tz), self.day_start_hour)
+        await self.db.execute(SUBSCRIPTION_UPSERT, (user_id, int(daily), int(weekly), keys['daily'], keys['weekly']))
+
+    async def subscription(self, user_id):
+        row = await self.db.fetchone('SELECT daily, weekly FROM digest_subscriptions WHERE user_id = ?', (user_id,))
+        return (bool(row[0]), bool(row[1])) if row else (False, False)
+
+    async def buckets(self, now=None):
+        # Пояса подписчиков, сгруппированные по текущим границам периодов
+        now = now or datetime.now(timezone.utc)
+        rows = await self.db.fetchall('''SELECT DISTINCT IFNULL(u.timezone, ?) FROM digest_subscriptions s
+                                         LEFT JOIN user_settings u ON u.user_id = s.user_id
+                                         WHERE s.daily OR s.weekly''', (self.default_timezone,))
+        groups = {}
+        for (name,) in rows:
+            keys = period_keys(now.astimezone(self.zone(name)), self.day_start_hour)
+            groups.setdefault((keys['daily'], keys['weekly']), []).append(name)
+        return [({'daily': daily, 'weekly': weekly}, zones) for (daily, weekly), zones in groups.items()]
+
+    async def run_once(self, now=None):
+        started = time.perf_counter()
+        users = messages = 0
+        for keys, zones in await self.buckets(now):
+            after = 0
+            while True:
+                due = await self.db.fetchall(DUE_SUBSCRIBERS, {
+                    'daily': keys['daily'], 'weekly': keys['weekly'], 'after': after,
+                    'default': self.default_timezone, 'zones': json.dumps(zones), 'limit': self.batch_size})
+                if not due:
+                    break
+                after = due[-1][0]
+                digests = await self.build_batch(due, keys)
+                users += len(due)
+                messages += len(digests)
+                if not self.dry_run:
+                    await self.claim(due, keys)
+                    await self.deliver(digests)
+                if len(due) < self.batch_size:
+                    break
+        self.runs += 1
+        self.users += users
+        self.last_seconds = time.perf_counter() - started
+        if users:
+            logging.info(f"Итоги{' (пробный прогон)' if self.dry_run else ''}: пользователей {users}, "
+                         f"сообщений {messages}, {self.last_seconds:.2f} с")
+        return users, messages
+
+    async def build_batch(self, due, keys):
+        # Возвращает [(user_id, telegram_id, текст)]; пользователи без операций за период пропускаются
+        user_ids = json.dumps([user_id for user_id, *_ in due])
+        totals = {}
+        async with self.db.read() as conn:
+            for kind in KINDS:
+                if not any(row[2 + KINDS.index(kind)] for row in due):
+                    continue
+                rows = await conn.execute_fetchall(BATCH_TOTALS, (user_ids, keys[kind], period_end(kind, keys[kind])))
+                for user_id, type_, category, amount in rows:
+                    period = totals.setdefault((user_id, kind), stats.PeriodTotals())
+                    target = period.expenses if type_ == 'expense' else period.incomes
+                    target[category] = amount
+        digests = []
+        for user_id, telegram_id, daily_due, weekly_due in due:
+            parts = [render_totals(period_title(kind, keys[kind]), totals[(user_id, kind)])
+                     for kind, is_due in zip(KINDS, (daily_due, weekly_due))
+                     if is_due and (user_id, kind) in totals]
+            if parts:
+                digests.append((user_id, telegram_id, "\n".join(parts)))
+            else:
+                self.empty += 1
+        return digests
+
+    async def claim(self, due, keys):
+        async with self.db.write() as conn:
+            for index, kind in enumerate(KINDS):
+                await conn.executemany(f'UPDATE digest_subscriptions SET {kind}_sent = ? WHERE user_id = ?',
+                                       [(keys[kind], row[0]) for row in due if row[2 + index]])
+
+    async def deliver(self, digests):
+        with outbound.bulk():
+            results = await asyncio.gather(*(self.send(telegram_id, text) for _, telegram_id, text in digests),
+                                           return_exceptions=True)
+        blocked = []
+        for (user_id, telegram_id, _), result in zip(digests, results):
+            if isinstance(result, TelegramForbiddenError):
+                blocked.append(user_id)
+            elif isinstance(result, Exception):
+                self.failed += 1
+                logging.error(f"Не удалось отправить итоги пользователю {telegram_id}: {result}")
+            else:
+                self.sent += 1
+        if blocked:
+            # Пользователь заблокировал бота: подписку снимаем, чтобы не стучаться каждый день
+            await self.db.execute('''UPDATE digest_subscriptions SET daily = 0, weekly = 0
+                                     WHERE user_id IN (SELECT value FROM json_each(?))''', (json.dumps(blocked),))
+            self.unsubscribed += len(blocked)
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'users': self.users,
+            'sent': self.sent,
+            'empty': self.empty,
+            'failed': self.failed,
+            'unsubscribed': self.unsubscribed,
+            'last_ms': self.last_seconds * 1000,
+        }
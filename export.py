@@ -0,0 +1,80 @@
+import csv
+import gzip
+import io
+from datetime import datetime, timedelta
+
+# Потоковая выгрузка транзакций в CSV. Функция build_csv синхронная и вызывается
+# в рабочем потоке (Database.run_bulk): строки читаются курсором порциями и сразу
+# пишутся в буфер в памяти, без DataFrame и временных файлов.
+EXPORT_HEADER = ['id', 'ИД_пользователя', 'Сумма', 'Категория', 'Описание', 'Дата', 'Тип']
+EXPORT_TYPE_WORDS = {'расходы': 'expense', 'доходы': 'income'}
+EXPORT_CHUNK_SIZE = 1000
+
+
+def parse_export_args(args, tz):
+    # /export [с] [по] [расходы|доходы] [gz]; даты в формате ГГГГ-ММ-ДД по поясу пользователя
+    options = {'types': ('expense', 'income'), 'ts_from': None, 'ts_to': None, 'compress': False}
+    dates = []
+    for arg in args:
+        word = arg.lower()
+        if word in EXPORT_TYPE_WORDS:
+            options['types'] = (EXPORT_TYPE_WORDS[word],)
+        elif word in ('gz', 'gzip'):
+            options['compress'] = True
+        else:
+            try:
+                dates.append(datetime.strptime(arg, '%Y-%m-%d'))
+            except ValueError:
+                raise ValueError(f"непонятный параметр '{arg}'")
+    if len(dates) > 2:
+        raise ValueError("укажите не больше двух дат")
+    if dates:
+        options['ts_from'] = int(dates[0].replace(tzinfo=tz).timestamp())
+    if len(dates) == 2:
+        if dates[1] < dates[0]:
+            raise ValueError("конечная дата раньше начальной")
+        options['ts_to'] = int((dates[1] + timedelta(days=1)).replace(tzinfo=tz).timestamp())
+    return options
+
+
+def build_csv(conn, user_id, types=('expense', 'income'), ts_from=None, ts_to=None, compress=False,
+              chunk_size=EXPORT_CHUNK_SIZE):
+    buffer = io.BytesIO()
+    raw = gzip.GzipFile(fileobj=buffer, mode='wb') if compress else buffer
+    # utf-8-sig сам пишет BOM в начало потока, чтобы Excel распознал кодировку
+    text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text, delimiter=';', lineterminator='\n')
+    writer.writerow(EXPORT_HEADER)
+
+    conditions = ['t.user_id = ?']
+    params = [user_id]
+    if len(types) == 1:
+        conditions.append('t.type = ?')
+        params.append(types[0])
+    if ts_from is not None:
+        conditions.append('t.ts >= ?')
+        params.append(ts_from)
+    if ts_to is not None:
+        conditions.append('t.ts < ?')
+        params.append(ts_to)
+    where = ' AND '.join(conditions)
+
+    count = 0
+    # Сумма, локальное время и тип форматируются прямо в запросе, строки пишутся как есть
+    cursor = conn.execute(f'''SELECT t.id, t.user_id, printf('%.2f', t.amount / 100.0), c.category, t.description,
+                                     datetime(t.ts + t.utc_offset, 'unixepoch'),
+                                     CASE t.type WHEN 'expense' THEN 'расход' ELSE 'доход' END
+                              FROM transactions t JOIN categories c ON c.id = t.category_id
+                              WHERE {where} ORDER BY t.ts''', params)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        writer.writerows(rows)
+        count += len(rows)
+
+    text.flush()
+    text.detach()
+    if compress:
+        raw.close()
+    return buffer.getvalue(), count
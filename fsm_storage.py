@@ -0,0 +1,172 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+# Хранилище состояний FSM в SQLite вместо MemoryStorage. Чтение и запись идут через
+# горячий кэш в памяти, изменённые ключи сбрасываются в таблицу fsm_states пачкой
+# раз в flush_interval. Пустые состояния из таблицы удаляются, брошенные диалоги
+# удаляются по state_ttl, а простаивающие записи вытесняются из памяти по cache_ttl
+# и сверх cache_size — давно не использованные (LRU). Несохраненные записи не
+# вытесняются до ближайшего сброса.
+# Кэш рассчитан на то, что обновления одного пользователя обрабатывает один процесс.
+FSM_UPSERT = '''INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data,
+                                                updated_at = excluded.updated_at'''
+FSM_DELETE = 'DELETE FROM fsm_states WHERE key = ?'
+
+
+@dataclass
+class FSMRecord:
+    state: str = None
+    data: dict = field(default_factory=dict)
+    updated_at: int = 0
+    touched: float = 0.0
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, db, state_ttl=86400, cache_ttl=600, flush_interval=1.0, key_builder=None, cache_size=10000):
+        self.db = db
+        self.state_ttl = state_ttl
+        self.cache_ttl = min(cache_ttl, state_ttl)
+        self.flush_interval = flush_interval
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._task = None
+        self.loads = 0
+        self.flushes = 0
+        self.evictions = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _record(self, key):
+        name = self.key_builder.build(key)
+        record = self._cache.get(name)
+        if record is None:
+            row = await self.db.fetchone('SELECT state, data, updated_at FROM fsm_states WHERE key = ? AND updated_at >= ?',
+                                         (name, int(time.time()) - self.state_ttl))
+            self.loads += 1
+            # Пока шло чтение, запись могла появиться из другого обработчика
+            record = self._cache.get(name)
+            if record is None:
+                record = FSMRecord(state=row[0], data=json.loads(row[1]), updated_at=row[2]) if row else FSMRecord()
+                self._cache[name] = record
+                self._trim(keep=name)
+        self._cache.move_to_end(name)
+        record.touched = time.monotonic()
+        return name, record
+
+    def _trim(self, keep=None):
+        # keep — запись, которую обработчик сейчас получит
+        excess = len(self._cache) - self.cache_size
+        if excess <= 0:
+            return
+        victims = []
+        for name in self._cache:
+            if name not in self._dirty and name != keep:
+                victims.append(name)
+                if len(victims) == excess:
+                    break
+        for name in victims:
+            del self._cache[name]
+            self.evictions += 1
+
+    def _mark_dirty(self, name, record):
+        record.updated_at = int(time.time())
+        self._dirty.add(name)
+
+    async def set_state(self, key, state=None):
+        name, record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(name, record)
+
+    async def get_state(self, key):
+        _, record = await self._record(key)
+        return record.state
+
+    async def set_data(self, key, data):
+        name, record = await self._record(key)
+        record.data = dict(data)
+        self._mark_dirty(name, record)
+
+    async def get_data(self, key):
+        _, record = await self._record(key)
+        return dict(record.data)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        names, self._dirty = self._dirty, set()
+        upserts = []
+        deletes = []
+        for name in names:
+            record = self._cache.get(name)
+            if record is None or (record.state is None and not record.data):
+                deletes.append((name,))
+            else:
+                upserts.append((name, record.state, json.dumps(record.data, ensure_ascii=False), record.updated_at))
+        try:
+            async with self.db.write() as conn:
+                if upserts:
+                    await conn.executemany(FSM_UPSERT, upserts)
+                if deletes:
+                    await conn.executemany(FSM_DELETE, deletes)
+        except Exception as e:
+            logging.error(f"Не удалось сохранить состояния FSM ({len(names)} шт.): {e}")
+            self._dirty |= names
+            return
+        self.flushes += 1
+        self._trim()
+
+    async def sweep(self):
+        # Вытесняем из памяти простаивающие записи и удаляем из базы брошенные диалоги
+        idle_before = time.monotonic() - self.cache_ttl
+        for name in [name for name, record in self._cache.items()
+                     if record.touched < idle_before and name not in self._dirty]:
+            del self._cache[name]
+            self.evictions += 1
+        return await self.db.execute('DELETE FROM fsm_states WHERE updated_at < ?',
+                                     (int(time.time()) - self.state_ttl,))
+
+    async def _run(self):
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_sweep >= min(self.cache_ttl, 60):
+                    expired = await self.sweep()
+                    if expired:
+                        logging.info(f"Удалено брошенных состояний FSM: {expired}")
+                    last_sweep = time.monotonic()
+            except Exception as e:
+                logging.error(f"Ошибка обслуживания хранилища FSM: {e}")
+
+    def stats(self):
+        return {
+            'cached': len(self._cache),
+            'cache_size': self.cache_size,
+            'dirty': len(self._dirty),
+            'loads': self.loads,
+            'flushes': self.flushes,
+            'evictions': self.evictions,
+        }
+
+    async def close(self):
+        # Вызывается диспетчером при остановке и ещё раз из main(), поэтому идемпотентно
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,166 @@
+import re
+from datetime import datetime, timezone
+
+from aiogram import types
+from aiogram.filters.callback_data import CallbackData
+
+import export
+import stats
+
+# История операций по страницам (/history). Страница выбирается по ключу
+# (ts, id), а не через OFFSET: запрос идет по индексу (user_id, ts, id) от
+# курсора, поэтому сотая страница стоит столько же, сколько первая. Фильтры и
+# курсор целиком лежат в callback_data кнопок (до 64 байт), состояние на
+# сервере не хранится.
+PAGE_SIZE = 10
+DELETE_BUTTONS_PER_ROW = 5
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+TYPE_CODES = {'expense': 'e', 'income': 'i'}
+TYPE_BY_CODE = {code: type_ for type_, code in TYPE_CODES.items()}
+# Сравнение курсора: '<' — страница старше курсора, '>' — новее, '=' — начиная с самого курсора
+CURSOR_CONDITIONS = {'<': '(t.ts, t.id) < (?, ?)', '>': '(t.ts, t.id) > (?, ?)', '=': '(t.ts, t.id) <= (?, ?)'}
+
+
+class HistoryPage(CallbackData, prefix='h'):
+    # action: p — показать страницу, a — спросить об удалении записи id, d — удалить её,
+    # f — удалить все записи по фильтрам с id не больше id (/delete с фильтрами), n — отменить это удаление
+    action: str
+    dir: str = ''
+    type: str = ''
+    category: int = 0
+    since: int = 0
+    until: int = 0
+    ts: int = 0
+    id: int = 0
+
+
+def parse_history_args(args, tz, entry):
+    # /history [расходы|доходы] [категория] [с] [по]; остальное разбирается как в /export
+    options = [arg for arg in args if arg.lower() in export.EXPORT_TYPE_WORDS or DATE_PATTERN.fullmatch(arg)]
+    words = [arg for arg in args if arg not in options]
+    parsed = export.parse_export_args(options, tz)
+    page = HistoryPage(action='p', since=parsed['ts_from'] or 0, until=parsed['ts_to'] or 0)
+    if len(parsed['types']) == 1:
+        page.type = TYPE_CODES[parsed['types'][0]]
+    if words:
+        for type_ in parsed['types']:
+            category, used = entry.match(type_, words)
+            if category is not None and used == len(words):
+                page.category = category.id
+                page.type = TYPE_CODES[category.type]
+                break
+        else:
+            raise ValueError(f"нет категории «{' '.join(words)}»")
+    return page
+
+
+def filters_sql(user_id, page):
+    conditions = ['t.user_id = ?']
+    params = [user_id]
+    if page.type:
+        conditions.append('t.type = ?')
+        params.append(TYPE_BY_CODE[page.type])
+    if page.category:
+        conditions.append('t.category_id = ?')
+        params.append(page.category)
+    if page.since:
+        conditions.append('t.ts >= ?')
+        params.append(page.since)
+    if page.until:
+        conditions.append('t.ts < ?')
+        params.append(page.until)
+    return conditions, params
+
+
+async def load_page(conn, user_id, page, size=PAGE_SIZE):
+    # Возвращает (строки от новых к старым, есть ли новее, есть ли старее)
+    conditions, params = filters_sql(user_id, page)
+    direction = page.dir if page.ts else ''
+    if direction:
+        conditions.append(CURSOR_CONDITIONS[direction])
+        params += [page.ts, page.id]
+    order = 'ASC' if direction == '>' else 'DESC'
+    rows = await conn.execute_fetchall(
+        f'''SELECT t.id, t.type, t.ts, t.utc_offset, t.amount, c.category, t.description
+            FROM transactions t JOIN categories c ON c.id = t.category_id
+            WHERE {' AND '.join(conditions)} ORDER BY t.ts {order}, t.id {order} LIMIT ?''', params + [size + 1])
+    more = len(rows) > size
+    rows = rows[:size]
+    if direction == '>':
+        rows.reverse()
+    if not rows:
+        return rows, False, False
+    # С другой стороны страницы достаточно проверить одну строку
+    conditions, params = filters_sql(user_id, page)
+    if direction == '>':
+        newer, older = more, await exists(conn, conditions, params, '<', rows[-1])
+    else:
+        newer, older = await exists(conn, conditions, params, '>', rows[0]), more
+    return rows, newer, older
+
+
+async def exists(conn, conditions, params, direction, row):
+    found = await conn.execute_fetchall(
+        f'''SELECT 1 FROM transactions t WHERE {' AND '.join(conditions + [CURSOR_CONDITIONS[direction]])} LIMIT 1''',
+        params + [row[2], row[0]])
+    return bool(found)
+
+
+def format_row(row):
+    transaction_id, type_, ts, utc_offset, amount, category, description = row
+    moment = datetime.fromtimestamp(ts + utc_offset, timezone.utc).strftime('%d.%m.%Y %H:%M')
+    sign = '-' if type_ == 'expense' else '+'
+    return f"#{transaction_id} {moment} {sign}{stats.format_amount(amount)} {category}" + \
+        (f" — {description}" if description else "")
+
+
+def describe_filters(page, tz, category_name=None):
+    parts = []
+    if page.type:
+        parts.append('расходы' if page.type == 'e' else 'доходы')
+    if category_name:
+        parts.append(category_name)
+    if page.since:
+        parts.append(f"с {datetime.fromtimestamp(page.since, tz).strftime('%Y-%m-%d')}")
+    if page.until:
+        # until — начало следующего дня после последней даты периода
+        parts.append(f"по {datetime.fromtimestamp(page.until - 1, tz).strftime('%Y-%m-%d')}")
+    return f" ({', '.join(parts)})" if parts else ""
+
+
+def render_page(page, rows, newer, older, tz, category_name=None):
+    if not rows:
+        return "Записей не найдено" + describe_filters(page, tz, category_name) + ".", None
+    text = "История" + describe_filters(page, tz, category_name) + ":\n" + "\n".join(format_row(row) for row in rows)
+    buttons = [types.InlineKeyboardButton(text=f"Удалить #{row[0]}", callback_data=page.model_copy(
+        update={'action': 'a', 'dir': '=', 'ts': row[2], 'id': row[0]}).pack()) for row in rows]
+    keyboard = [buttons[i:i + DELETE_BUTTONS_PER_ROW] for i in range(0, len(buttons), DELETE_BUTTONS_PER_ROW)]
+    navigation = []
+    if newer:
+        navigation.append(types.InlineKeyboardButton(text="« Новее", callback_data=page.model_copy(
+            update={'action': 'p', 'dir': '>', 'ts': rows[0][2], 'id': rows[0][0]}).pack()))
+    if older:
+        navigation.append(types.InlineKeyboardButton(text="Старее »", callback_data=page.model_copy(
+            update={'action': 'p', 'dir': '<', 'ts': rows[-1][2], 'id': rows[-1][0]}).pack()))
+    if navigation:
+        keyboard.append(navigation)
+    return text, types.InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def render_confirm(page, row):
+    keyboard = [[
+        types.InlineKeyboardButton(text="Да, удалить", callback_data=page.model_copy(update={'action': 'd'}).pack()),
+        types.InlineKeyboardButton(text="Отмена", callback_data=page.model_copy(update={'action': 'p'}).pack()),
+    ]]
+    return f"Удалить запись?\n{format_row(row)}", types.InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def render_purge_confirm(page, count, max_id, tz, category_name=None):
+    # Удаляются только записи, посчитанные в вопросе: добавленные позже имеют больший id
+    keyboard = [[
+        types.InlineKeyboardButton(text="Да, удалить", callback_data=page.model_copy(
+            update={'action': 'f', 'id': max_id}).pack()),
+        types.InlineKeyboardButton(text="Отмена", callback_data=page.model_copy(update={'action': 'n'}).pack()),
+    ]]
+    return (f"Удалить записей: {count}{describe_filters(page, tz, category_name)}? Это нельзя отменить.",
+            types.InlineKeyboardMarkup(inline_keyboard=keyboard))
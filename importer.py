@@ -0,0 +1,228 @@
+import csv
+import gzip
+import io
+import itertools
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import stats
+
+# Разбор CSV для /import. Поддерживаются два формата: выгрузка /export (';',
+# BOM, русские заголовки, столбец «Тип») и старый expenses_*.csv
+# (user_id,amount,category,description,date — только расходы). user_id из файла
+# не используется: всё записывается текущему пользователю. id из выгрузки нужен,
+# чтобы не записать повторно уже существующие у пользователя записи (EXISTING_IDS).
+# Функции синхронные и вызываются в рабочем потоке; файл читается потоком из
+# скачанного BytesIO, не превращаясь целиком в строку: scan() один раз проходит его
+# и собирает категории, id и число строк, parse_chunks() проходит второй раз и отдает
+# готовые к executemany порции вместе с дневными агрегатами и счетчиками
+# использования категорий.
+IMPORT_CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 10
+FORMATS = {
+    'export': {'id': 'id', 'amount': 'Сумма', 'category': 'Категория', 'description': 'Описание', 'date': 'Дата', 'type': 'Тип'},
+    'expenses': {'amount': 'amount', 'category': 'category', 'description': 'description', 'date': 'date'},
+}
+TYPE_WORDS = {'расход': 'expense', 'доход': 'income', 'expense': 'expense', 'income': 'income'}
+DATE_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y')
+# Таблицы, сохраненные из Excel в Windows, бывают в cp1251
+ENCODINGS = ('utf-8-sig', 'cp1251')
+OPTIONAL_COLUMNS = ('id', 'type')
+# Какие из id файла уже принадлежат пользователю (параметры: user_id, JSON-список id)
+EXISTING_IDS = 'SELECT id FROM transactions WHERE user_id = ? AND id IN (SELECT value FROM json_each(?))'
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+@dataclass
+class Table:
+    # source — скачанный файл (двоичный, с seek), возможно сжатый gzip
+    source: object
+    encoding: str
+    delimiter: str
+    format: str
+    columns: dict
+    total: int = 0
+    # (тип, название) всех категорий, встречающихся в файле
+    categories: set = field(default_factory=set)
+    # id записей из выгрузки /export
+    ids: set = field(default_factory=set)
+
+
+@dataclass
+class Chunk:
+    rows: list
+    rollups: list
+    usage: list
+    processed: int
+    skipped: int
+    duplicates: int
+    errors: list
+
+
+def open_text(source, encoding):
+    # Текстовый поток поверх файла с начала; после чтения его нужно отсоединить
+    # (detach), иначе при сборке мусора он закроет и сам файл
+    source.seek(0)
+    raw = source
+    if source.read(2) == b'\x1f\x8b':
+        source.seek(0)
+        raw = gzip.GzipFile(fileobj=source)
+    else:
+        source.seek(0)
+    return io.TextIOWrapper(raw, encoding=encoding, newline='')
+
+
+def read_rows(text, delimiter=None):
+    # Возвращает (разделитель, csv.reader); разделитель определяется по заголовку
+    first_line = text.readline()
+    if delimiter is None:
+        delimiter = ';' if ';' in first_line else ','
+    return delimiter, csv.reader(itertools.chain([first_line], text), delimiter=delimiter)
+
+
+def scan(source):
+    for encoding in ENCODINGS:
+        text = open_text(source, encoding)
+        try:
+            return scan_text(source, encoding, text)
+        except UnicodeDecodeError:
+            if encoding == ENCODINGS[-1]:
+                raise
+        finally:
+            text.detach()
+
+
+def scan_text(source, encoding, text):
+    delimiter, reader = read_rows(text)
+    header = [name.strip() for name in next(reader, [])]
+    for name, columns in FORMATS.items():
+        required = [column for key, column in columns.items() if key not in OPTIONAL_COLUMNS]
+        if all(column in header for column in required):
+            indexes = {key: header.index(column) for key, column in columns.items() if column in header}
+            break
+    else:
+        raise ImportFormatError("не похоже на выгрузку /export или expenses_*.csv: "
+                                f"нет нужных столбцов в заголовке ({', '.join(header) or 'пусто'})")
+    table = Table(source=source, encoding=encoding, delimiter=delimiter, format=name, columns=indexes)
+    for row in reader:
+        if not row:
+            continue
+        table.total += 1
+        type_ = row_type(table, row)
+        category = cell(row, indexes['category'])
+        if type_ and category:
+            table.categories.add((type_, category))
+        row_id = row_id_of(table, row)
+        if row_id is not None:
+            table.ids.add(row_id)
+    return table
+
+
+def cell(row, index):
+    return row[index].strip() if index < len(row) else ''
+
+
+def row_id_of(table, row):
+    if 'id' not in table.columns:
+        return None
+    value = cell(row, table.columns['id'])
+    return int(value) if value.isdigit() else None
+
+
+def row_type(table, row):
+    if 'type' not in table.columns:
+        return 'expense'
+    return TYPE_WORDS.get(cell(row, table.columns['type']).lower())
+
+
+def parse_date(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError(f"неверная дата «{value}»")
+
+
+def parse_row(table, row, category_ids, zone):
+    type_ = row_type(table, row)
+    if type_ is None:
+        raise ValueError(f"неизвестный тип «{cell(row, table.columns['type'])}»")
+    raw_amount = cell(row, table.columns['amount'])
+    try:
+        amount = stats.parse_amount(raw_amount)
+    except ValueError as e:
+        raise ValueError(f"{e}: «{raw_amount}»")
+    category = cell(row, table.columns['category'])
+    category_id = category_ids.get((type_, category))
+    if category_id is None:
+        raise ValueError(f"нет категории «{category}»")
+    moment = parse_date(cell(row, table.columns['date']))
+    if moment.tzinfo is None:
+        # Даты без смещения — локальное время пользователя, как в выгрузке
+        moment = moment.replace(tzinfo=zone)
+    ts, utc_offset = int(moment.timestamp()), int(moment.utcoffset().total_seconds())
+    return type_, ts, utc_offset, category_id, amount, cell(row, table.columns['description']) or None
+
+
+def parse_chunks(table, user_id, category_ids, zone, day_start_hour, existing_ids=frozenset(),
+                 chunk_size=IMPORT_CHUNK_SIZE):
+    # existing_ids: id записей, которые у пользователя уже есть (повторная загрузка выгрузки)
+    text = open_text(table.source, table.encoding)
+    try:
+        yield from parse_text(text, table, user_id, category_ids, zone, day_start_hour, existing_ids, chunk_size)
+    finally:
+        text.detach()
+
+
+def parse_text(text, table, user_id, category_ids, zone, day_start_hour, existing_ids, chunk_size):
+    _, reader = read_rows(text, table.delimiter)
+    next(reader, None)
+    processed = 0
+    rows, rollups, usage, errors = [], {}, {}, []
+    skipped = duplicates = 0
+    for row in reader:
+        if not row:
+            continue
+        processed += 1
+        if existing_ids and row_id_of(table, row) in existing_ids:
+            duplicates += 1
+            continue
+        try:
+            type_, ts, utc_offset, category_id, amount, description = parse_row(table, row, category_ids, zone)
+        except ValueError as e:
+            skipped += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append((reader.line_num, str(e)))
+            continue
+        rows.append((user_id, type_, ts, utc_offset, category_id, amount, description))
+        totals = rollups.setdefault((stats.accounting_day_of(ts, utc_offset, day_start_hour), type_, category_id), [0, 0])
+        totals[0] += amount
+        totals[1] += 1
+        usage[category_id] = usage.get(category_id, 0) + 1
+        if len(rows) >= chunk_size:
+            yield build_chunk(user_id, rows, rollups, usage, processed, skipped, duplicates, errors)
+            rows, rollups, usage, errors = [], {}, {}, []
+            processed = skipped = duplicates = 0
+    if processed:
+        yield build_chunk(user_id, rows, rollups, usage, processed, skipped, duplicates, errors)
+
+
+def build_chunk(user_id, rows, rollups, usage, processed, skipped, duplicates, errors):
+    return Chunk(
+        rows=rows,
+        rollups=[(user_id, day, type_, category_id, amount, count)
+                 for (day, type_, category_id), (amount, count) in rollups.items()],
+        usage=[(user_id, category_id, count) for category_id, count in usage.items()],
+        processed=processed,
+        skipped=skipped,
+        duplicates=duplicates,
+        errors=errors,
+    )
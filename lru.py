@@ -0,0 +1,66 @@
+import asyncio
+from collections import OrderedDict
+
+
+class SingleFlightLRU:
+    # Кэш с вытеснением LRU и загрузкой по промаху: loader(key, *args) вызывается
+    # один раз на ключ, параллельные промахи по тому же ключу ждут ту же загрузку
+    # (single-flight). Значение None не кэшируется. pop() во время загрузки отвязывает
+    # её от ключа: ждущие получат результат, но в кэш он не попадет, а следующий get()
+    # начнет новую загрузку.
+    def __init__(self, loader, maxsize):
+        self.loader = loader
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def peek(self, key):
+        # Без загрузки, без учета в статистике и без сдвига в очереди вытеснения
+        return self._entries.get(key)
+
+    async def get(self, key, *args):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, *args))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.coalesced += 1
+        # shield: отмена одного ожидающего не отменяет общую загрузку
+        return await asyncio.shield(task)
+
+    async def _load(self, key, *args):
+        value = await self.loader(key, *args)
+        if self._inflight.get(key) is asyncio.current_task():
+            self.put(key, value)
+        return value
+
+    def _finish(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def put(self, key, value):
+        if value is None:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+        self._inflight.pop(key, None)
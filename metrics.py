@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import re
+import time
+from functools import lru_cache
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+# Метрики в формате Prometheus: гистограммы времени по обработчикам и по видам
+# SQL-запросов, счетчики ошибок и медленных запросов, задержка цикла событий и
+# все числовые поля health_info() как gauge. Отдаются по GET /metrics на
+# METRICS_HOST:METRICS_PORT.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SHAPE_LENGTH = 160
+LOOP_LAG_INTERVAL = 0.5
+
+
+@lru_cache(maxsize=1024)
+def query_shape(sql):
+    # Параметры всегда передаются через ?, поэтому вид запроса — его текст без лишних пробелов
+    shape = ' '.join(sql.split())
+    return shape if len(shape) <= SHAPE_LENGTH else shape[:SHAPE_LENGTH - 3] + '...'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metric_name(*parts):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', '_'.join(str(part) for part in parts))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def render(self, name, label, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label}="{escape_label(value)}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label}="{escape_label(value)}",le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{label}="{escape_label(value)}"}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{label}="{escape_label(value)}"}} {self.count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, slow_query_seconds=0.1, health=None):
+        self.slow_query_seconds = slow_query_seconds
+        self.health = health
+        self.handlers = {}
+        self.handler_errors = {}
+        self.queries = {}
+        self.slow_queries = 0
+        self.loop_lag = 0.0
+        self.max_loop_lag = 0.0
+        self._lag_task = None
+
+    def observe_handler(self, handler, seconds, failed=False):
+        histogram = self.handlers.get(handler)
+        if histogram is None:
+            histogram = self.handlers[handler] = Histogram()
+        histogram.observe(seconds)
+        if failed:
+            self.handler_errors[handler] = self.handler_errors.get(handler, 0) + 1
+
+    def observe_query(self, sql, seconds):
+        shape = query_shape(sql)
+        histogram = self.queries.get(shape)
+        if histogram is None:
+            histogram = self.queries[shape] = Histogram()
+        histogram.observe(seconds)
+        if seconds >= self.slow_query_seconds:
+            self.slow_queries += 1
+            logging.warning(f"Медленный запрос {seconds * 1000:.1f} мс: {shape}")
+
+    def start(self):
+        self._lag_task = asyncio.create_task(self._watch_loop_lag())
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            try:
+                await self._lag_task
+            except asyncio.CancelledError:
+                pass
+            self._lag_task = None
+
+    async def _watch_loop_lag(self):
+        # Насколько позже запланированного просыпается sleep: время, на которое
+        # синхронный код задерживает все остальные обработчики
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+            self.max_loop_lag = max(self.max_loop_lag, self.loop_lag)
+
+    def render(self):
+        lines = [
+            '# HELP bot_handler_seconds Время обработки обновления по обработчикам',
+            '# TYPE bot_handler_seconds histogram',
+        ]
+        for handler, histogram in sorted(self.handlers.items()):
+            lines.extend(histogram.render('bot_handler_seconds', 'handler', handler))
+        lines += ['# HELP bot_handler_errors_total Исключения, вышедшие из обработчика',
+                  '# TYPE bot_handler_errors_total counter']
+        for handler, count in sorted(self.handler_errors.items()):
+            lines.append(f'bot_handler_errors_total{{handler="{escape_label(handler)}"}} {count}')
+        lines += ['# HELP bot_db_query_seconds Время SQL-запросов по виду запроса',
+                  '# TYPE bot_db_query_seconds histogram']
+        for shape, histogram in sorted(self.queries.items()):
+            lines.extend(histogram.render('bot_db_query_seconds', 'query', shape))
+        lines += ['# HELP bot_db_slow_queries_total Запросы дольше порога SLOW_QUERY_MS',
+                  '# TYPE bot_db_slow_queries_total counter',
+                  f'bot_db_slow_queries_total {self.slow_queries}',
+                  '# TYPE bot_event_loop_lag_seconds gauge',
+                  f'bot_event_loop_lag_seconds {self.loop_lag:.6f}',
+                  '# TYPE bot_event_loop_lag_max_seconds gauge',
+                  f'bot_event_loop_lag_max_seconds {self.max_loop_lag:.6f}',
+                  '# TYPE bot_asyncio_tasks gauge',
+                  f'bot_asyncio_tasks {len(asyncio.all_tasks())}']
+        if self.health is not None:
+            # Глубины очередей и размеры кэшей: все числовые поля health_info()
+            for section, values in self.health().items():
+                for key, value in values.items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        name = metric_name('bot', section, key)
+                        lines += [f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренняя middleware роутера: к этому моменту фильтры уже выбрали обработчик
+    def __init__(self, registry):
+        self.registry = registry
+
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await handler(event, data)
+            failed = False
+            return result
+        finally:
+            self.registry.observe_handler(name, time.perf_counter() - started, failed)
+
+
+async def start_server(registry, host='127.0.0.1', port=9100):
+    async def handle_metrics(request):
+        return web.Response(body=registry.render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, handle_signals=False, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики: http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,360 @@
+import logging
+import os
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Версионированные миграции схемы. Каждая выполняется ровно один раз, в своей
+# транзакции, и записывается в schema_version. Новые миграции добавляются в конец
+# списка MIGRATIONS со следующим номером; старые не меняются. Поэтому миграции не
+# вызывают код остальных модулей: всё, что им нужно, лежит здесь в том виде, в каком
+# было на момент их появления.
+MIGRATION_CHUNK = 10000
+# Раздельные таблицы расходов и доходов до миграции 8 (теперь это представления)
+LEGACY_TABLES = {'expense': 'expenses', 'income': 'incomes'}
+# Куда попадают старые записи без категории
+FALLBACK_CATEGORIES = {'expense': 'Прочее', 'income': 'Прочие доходы'}
+# Граница INTEGER в SQLite
+MAX_INTEGER = 2 ** 63 - 1
+
+
+async def create_base_schema(c):
+    await c.execute('''CREATE TABLE IF NOT EXISTS expenses
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, category TEXT, description TEXT, date TEXT)''')
+    await c.execute('''CREATE TABLE IF NOT EXISTS incomes
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, category TEXT, description TEXT, date TEXT)''')
+    await c.execute('''CREATE TABLE IF NOT EXISTS categories
+                      (category TEXT PRIMARY KEY, type TEXT)''')
+    await c.execute('''CREATE TABLE IF NOT EXISTS user_settings
+                      (user_id INTEGER PRIMARY KEY, timezone TEXT)''')
+    await c.execute('''CREATE TABLE IF NOT EXISTS user_id_mapping
+                      (telegram_id INTEGER PRIMARY KEY, simple_id INTEGER)''')
+    await c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_id ON expenses (user_id)')
+    await c.execute('CREATE INDEX IF NOT EXISTS idx_incomes_user_id ON incomes (user_id)')
+    await c.execute('CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses (date)')
+    await c.execute('CREATE INDEX IF NOT EXISTS idx_incomes_date ON incomes (date)')
+
+
+async def add_categories_type(c):
+    await c.execute('PRAGMA table_info(categories)')
+    columns = [info[1] for info in await c.fetchall()]
+    if 'type' not in columns:
+        await c.execute('ALTER TABLE categories ADD COLUMN type TEXT')
+        logging.info("Добавлен столбец 'type' в таблицу categories")
+
+
+async def remap_telegram_ids(c):
+    # Перевод user_id из telegram_id в simple_id. Раньше это выполнялось при каждом
+    # запуске и заново переназначало уже переведенные записи, поэтому здесь трогаем
+    # только те user_id, которые ещё не являются чьим-либо simple_id.
+    await c.execute('SELECT telegram_id, simple_id FROM user_id_mapping')
+    id_mapping = dict(await c.fetchall())
+    simple_ids = set(id_mapping.values())
+    await c.execute('SELECT user_id FROM expenses UNION SELECT user_id FROM incomes')
+    telegram_ids = [row[0] for row in await c.fetchall() if row[0] not in simple_ids]
+
+    next_simple_id = max(simple_ids, default=0) + 1
+    for telegram_id in telegram_ids:
+        if telegram_id not in id_mapping:
+            id_mapping[telegram_id] = next_simple_id
+            await c.execute('INSERT INTO user_id_mapping (telegram_id, simple_id) VALUES (?, ?)',
+                            (telegram_id, next_simple_id))
+            next_simple_id += 1
+        await c.execute('UPDATE expenses SET user_id = ? WHERE user_id = ?', (id_mapping[telegram_id], telegram_id))
+        await c.execute('UPDATE incomes SET user_id = ? WHERE user_id = ?', (id_mapping[telegram_id], telegram_id))
+    if telegram_ids:
+        logging.info(f"Переведено в simple_id пользователей: {len(telegram_ids)}")
+
+
+async def create_rollup_tables(c):
+    await c.execute('''CREATE TABLE IF NOT EXISTS daily_totals
+                      (user_id INTEGER, day TEXT, type TEXT, category_id INTEGER, amount INTEGER, count INTEGER,
+                       PRIMARY KEY (user_id, day, type, category_id)) WITHOUT ROWID''')
+    await c.execute('''CREATE TABLE IF NOT EXISTS app_meta
+                      (key TEXT PRIMARY KEY, value TEXT)''')
+
+
+async def create_daily_totals(c):
+    await create_rollup_tables(c)
+    # Агрегаты заполняются заново при следующей проверке stats.ensure_daily_totals
+    await c.execute("DELETE FROM app_meta WHERE key = 'daily_totals_day_start_hour'")
+
+
+async def autoincrement_simple_ids(c):
+    # simple_id выдается базой (AUTOINCREMENT), telegram_id уникален. Если старая
+    # гонка MAX(simple_id)+1 успела выдать один id двоим, второй получает новый id.
+    await c.execute('''CREATE TABLE user_id_mapping_new
+                      (simple_id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id INTEGER NOT NULL UNIQUE)''')
+    await c.execute('''INSERT OR IGNORE INTO user_id_mapping_new (simple_id, telegram_id)
+                       SELECT simple_id, telegram_id FROM user_id_mapping
+                       WHERE simple_id IS NOT NULL ORDER BY rowid''')
+    await c.execute('''INSERT INTO user_id_mapping_new (telegram_id)
+                       SELECT telegram_id FROM user_id_mapping
+                       WHERE telegram_id NOT IN (SELECT telegram_id FROM user_id_mapping_new)''')
+    if c.rowcount > 0:
+        logging.warning(f"Повторяющиеся simple_id: выдано новых id {c.rowcount}")
+    await c.execute('DROP TABLE user_id_mapping')
+    await c.execute('ALTER TABLE user_id_mapping_new RENAME TO user_id_mapping')
+
+
+async def create_fsm_states(c):
+    await c.execute('''CREATE TABLE IF NOT EXISTS fsm_states
+                      (key TEXT PRIMARY KEY, state TEXT, data TEXT, updated_at INTEGER NOT NULL)''')
+    await c.execute('CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)')
+
+
+def migration_zone(name):
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo('UTC')
+
+
+async def fallback_category(c, category_ids, type_):
+    # Запасная категория создается, только если нашлись записи без категории
+    name = FALLBACK_CATEGORIES[type_]
+    if name not in category_ids:
+        await c.execute('INSERT OR IGNORE INTO categories (category, type) VALUES (?, ?)', (name, type_))
+        await c.execute('SELECT id FROM categories WHERE category = ?', (name,))
+        category_ids[name] = (await c.fetchone())[0]
+    return name
+
+
+def legacy_values(date, amount, zone):
+    # Старая строка: локальное время 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' в поясе zone и сумма в рублях ->
+    # (ts UTC, смещение в секундах, сумма в копейках); ValueError, если перенести нельзя
+    try:
+        moment = datetime.fromisoformat(date).replace(tzinfo=zone)
+        minor = int(round(amount * 100))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError
+    if abs(minor) > MAX_INTEGER:
+        raise ValueError
+    return int(moment.timestamp()), int(moment.utcoffset().total_seconds()), minor
+
+
+async def reject_legacy_row(c, table, row):
+    # Строки, которые нельзя перенести (нет или испорчены дата, сумма, пользователь),
+    # не останавливают миграцию, а откладываются как есть для ручного разбора
+    await c.execute('''CREATE TABLE IF NOT EXISTS migration_rejected
+                      (source TEXT, rowid INTEGER, user_id, amount, category, description, date)''')
+    await c.execute('INSERT INTO migration_rejected VALUES (?, ?, ?, ?, ?, ?, ?)', (table, *row))
+
+
+async def compact_transactions(c):
+    # Компактная схема: категории получают целочисленный id, суммы переводятся в
+    # копейки, строка даты — в секунды UTC плюс смещение. Старые даты записаны в
+    # локальном времени без смещения, поэтому берется текущий пояс пользователя.
+    await c.execute('''CREATE TABLE categories_new
+                      (id INTEGER PRIMARY KEY, category TEXT NOT NULL UNIQUE, type TEXT)''')
+    await c.execute('INSERT INTO categories_new (category, type) SELECT category, type FROM categories ORDER BY rowid')
+    await c.execute('DROP TABLE categories')
+    await c.execute('ALTER TABLE categories_new RENAME TO categories')
+    for type_, table in LEGACY_TABLES.items():
+        await c.execute(f'''INSERT OR IGNORE INTO categories (category, type)
+                            SELECT DISTINCT category, ? FROM {table} WHERE category IS NOT NULL''', (type_,))
+    await c.execute('SELECT category, id FROM categories')
+    category_ids = dict(await c.fetchall())
+    await c.execute('SELECT user_id, timezone FROM user_settings WHERE timezone IS NOT NULL')
+    zones = {user_id: migration_zone(name) for user_id, name in await c.fetchall()}
+    default_zone = migration_zone(os.getenv('TIMEZONE', 'UTC'))
+
+    for type_, table in LEGACY_TABLES.items():
+        await c.execute(f'''CREATE TABLE {table}_new
+                            (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, ts INTEGER NOT NULL,
+                             utc_offset INTEGER NOT NULL, category_id INTEGER NOT NULL REFERENCES categories (id),
+                             amount INTEGER NOT NULL, description TEXT)''')
+        await c.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,))
+        row = await c.fetchone()
+        sequence = row[0] if row else 0
+        # rowid, а не id: в старых базах столбца id нет вовсе
+        last_rowid = 0
+        uncategorized = 0
+        rejected = 0
+        while True:
+            await c.execute(f'''SELECT rowid, user_id, amount, category, description, date FROM {table}
+                                WHERE rowid > ? ORDER BY rowid LIMIT ?''', (last_rowid, MIGRATION_CHUNK))
+            rows = await c.fetchall()
+            if not rows:
+                break
+            values = []
+            for row in rows:
+                rowid, user_id, amount, category, description, date = row
+                try:
+                    if user_id is None:
+                        raise ValueError
+                    ts, utc_offset, minor = legacy_values(date, amount, zones.get(user_id, default_zone))
+                except ValueError:
+                    await reject_legacy_row(c, table, row)
+                    rejected += 1
+                    continue
+                if category not in category_ids:
+                    category = await fallback_category(c, category_ids, type_)
+                    uncategorized += 1
+                values.append((rowid, user_id, ts, utc_offset, category_ids[category], minor, description))
+            await c.executemany(f'''INSERT INTO {table}_new (id, user_id, ts, utc_offset, category_id, amount, description)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?)''', values)
+            last_rowid = rows[-1][0]
+        if uncategorized:
+            logging.warning(f"{table}: записей без категории {uncategorized}, перенесены в «{FALLBACK_CATEGORIES[type_]}»")
+        if rejected:
+            logging.warning(f"{table}: записей с неверной датой, суммой или пользователем {rejected}, "
+                            f"не перенесены и сохранены в migration_rejected")
+        await c.execute(f'DROP TABLE {table}')
+        await c.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+        # Удаленные id не должны выдаваться повторно
+        await c.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (sequence, table))
+        # Покрывающий индекс: выборки пользователя за период читаются только из индекса
+        await c.execute(f'CREATE INDEX idx_{table}_user_ts ON {table} (user_id, ts, category_id, amount)')
+
+    await c.execute('DROP TABLE IF EXISTS daily_totals')
+    await create_rollup_tables(c)
+    await c.execute("DELETE FROM app_meta WHERE key = 'daily_totals_day_start_hour'")
+
+
+async def unify_transactions(c):
+    # Расходы и доходы в одной таблице с типом. id расходов сохраняются; доход
+    # сохраняет свой id, если такого id нет среди расходов, иначе получает новый.
+    await c.execute('''CREATE TABLE transactions
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                       type TEXT NOT NULL CHECK (type IN ('expense', 'income')), ts INTEGER NOT NULL,
+                       utc_offset INTEGER NOT NULL, category_id INTEGER NOT NULL REFERENCES categories (id),
+                       amount INTEGER NOT NULL, description TEXT)''')
+    columns = 'user_id, ts, utc_offset, category_id, amount, description'
+    await c.execute(f'''INSERT INTO transactions (id, type, {columns})
+                        SELECT id, 'expense', {columns} FROM expenses ORDER BY id''')
+    await c.execute(f'''INSERT INTO transactions (id, type, {columns})
+                        SELECT id, 'income', {columns} FROM incomes
+                        WHERE id NOT IN (SELECT id FROM expenses) ORDER BY id''')
+    # Новые id не должны совпадать с удаленными id из обеих старых таблиц
+    await c.execute("SELECT MAX(seq) FROM sqlite_sequence WHERE name IN ('transactions', 'expenses', 'incomes')")
+    sequence = (await c.fetchone())[0]
+    if sequence is not None:
+        await c.execute("DELETE FROM sqlite_sequence WHERE name = 'transactions'")
+        await c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('transactions', ?)", (sequence,))
+    await c.execute(f'''INSERT INTO transactions (type, {columns})
+                        SELECT 'income', {columns} FROM incomes
+                        WHERE id IN (SELECT id FROM expenses) ORDER BY id''')
+    if c.rowcount > 0:
+        logging.warning(f"Совпадающие id доходов и расходов: доходам выдано новых id {c.rowcount}")
+    await c.execute('DROP TABLE expenses')
+    await c.execute('DROP TABLE incomes')
+    await c.execute('CREATE INDEX idx_transactions_user_ts ON transactions (user_id, ts, type, category_id, amount)')
+    # Представления для старых ручных запросов к expenses и incomes (только чтение)
+    for type_, table in LEGACY_TABLES.items():
+        await c.execute(f"""CREATE VIEW {table} AS
+                            SELECT id, user_id, ts, utc_offset, category_id, amount, description
+                            FROM transactions WHERE type = '{type_}'""")
+
+
+async def user_categories(c):
+    # Собственные категории пользователей: categories.user_id (NULL — общая), имя
+    # уникально в пределах владельца. Архив и частота использования — в user_categories,
+    # частота сразу заполняется по истории операций.
+    await c.execute('''CREATE TABLE categories_new
+                      (id INTEGER PRIMARY KEY, user_id INTEGER, category TEXT NOT NULL, type TEXT)''')
+    await c.execute('INSERT INTO categories_new (id, category, type) SELECT id, category, type FROM categories')
+    await c.execute('DROP TABLE categories')
+    await c.execute('ALTER TABLE categories_new RENAME TO categories')
+    await c.execute('CREATE UNIQUE INDEX idx_categories_owner ON categories (IFNULL(user_id, 0), category)')
+    await c.execute('''CREATE TABLE user_categories
+                      (user_id INTEGER NOT NULL, category_id INTEGER NOT NULL REFERENCES categories (id),
+                       archived INTEGER NOT NULL DEFAULT 0, uses INTEGER NOT NULL DEFAULT 0,
+                       PRIMARY KEY (user_id, category_id)) WITHOUT ROWID''')
+    await c.execute('''INSERT INTO user_categories (user_id, category_id, uses)
+                       SELECT user_id, category_id, COUNT(*) FROM transactions GROUP BY user_id, category_id''')
+
+
+async def history_index(c):
+    # Постраничная история (/history) идет по ключу (ts, id) внутри пользователя
+    await c.execute('CREATE INDEX idx_transactions_user_ts_id ON transactions (user_id, ts, id)')
+
+
+async def transactions_fts(c):
+    # Полнотекстовый индекс описаний для /find (см. search.py). Таблица без копии
+    # текста (content=''): строки читаются из transactions по rowid, а индекс
+    # поддерживают триггеры. user_id проиндексирован как слово, чтобы MATCH сразу
+    # сужал поиск до записей пользователя, а не обходил совпадения всех. В индекс
+    # попадает описание с «ё», замененной на «е»; при удалении FTS5 нужно передать
+    # ровно те же значения, поэтому замена одинаковая. Фразовые запросы не нужны,
+    # поэтому позиции слов не хранятся (detail=column).
+    normalized = "replace(replace({}.description, 'ё', 'е'), 'Ё', 'Е')"
+    await c.execute('''CREATE VIRTUAL TABLE transactions_fts USING fts5
+                      (user_id, description, content='', detail=column,
+                       tokenize='unicode61 remove_diacritics 2', prefix='2 3')''')
+    await c.execute(f'''CREATE TRIGGER transactions_fts_insert AFTER INSERT ON transactions
+                       WHEN new.description IS NOT NULL BEGIN
+                           INSERT INTO transactions_fts (rowid, user_id, description)
+                           VALUES (new.id, new.user_id, {normalized.format('new')});
+                       END''')
+    await c.execute(f'''CREATE TRIGGER transactions_fts_delete AFTER DELETE ON transactions
+                       WHEN old.description IS NOT NULL BEGIN
+                           INSERT INTO transactions_fts (transactions_fts, rowid, user_id, description)
+                           VALUES ('delete', old.id, old.user_id, {normalized.format('old')});
+                       END''')
+    await c.execute(f'''CREATE TRIGGER transactions_fts_update AFTER UPDATE OF user_id, description ON transactions
+                       BEGIN
+                           INSERT INTO transactions_fts (transactions_fts, rowid, user_id, description)
+                           SELECT 'delete', old.id, old.user_id, {normalized.format('old')}
+                           WHERE old.description IS NOT NULL;
+                           INSERT INTO transactions_fts (rowid, user_id, description)
+                           SELECT new.id, new.user_id, {normalized.format('new')} WHERE new.description IS NOT NULL;
+                       END''')
+    await c.execute(f'''INSERT INTO transactions_fts (rowid, user_id, description)
+                        SELECT id, user_id, {normalized.format('transactions')} FROM transactions
+                        WHERE description IS NOT NULL''')
+
+
+async def digest_subscriptions(c):
+    # Подписка на итоги (digest.py); *_sent — начало последнего периода, за который итоги уже отправлены
+    await c.execute('''CREATE TABLE digest_subscriptions
+                      (user_id INTEGER PRIMARY KEY, daily INTEGER NOT NULL DEFAULT 0,
+                       weekly INTEGER NOT NULL DEFAULT 0, daily_sent TEXT, weekly_sent TEXT)''')
+
+
+async def create_budgets(c):
+    # Месячные лимиты расходов по категориям (budgets.py), суммы в копейках
+    await c.execute('''CREATE TABLE budgets
+                      (user_id INTEGER NOT NULL, category_id INTEGER NOT NULL, amount INTEGER NOT NULL,
+                       PRIMARY KEY (user_id, category_id)) WITHOUT ROWID''')
+
+
+MIGRATIONS = [
+    (1, 'base_schema', create_base_schema),
+    (2, 'categories_type', add_categories_type),
+    (3, 'remap_telegram_ids', remap_telegram_ids),
+    (4, 'daily_totals', create_daily_totals),
+    (5, 'autoincrement_simple_ids', autoincrement_simple_ids),
+    (6, 'fsm_states', create_fsm_states),
+    (7, 'compact_transactions', compact_transactions),
+    (8, 'unify_transactions', unify_transactions),
+    (9, 'user_categories', user_categories),
+    (10, 'history_index', history_index),
+    (11, 'transactions_fts', transactions_fts),
+    (12, 'digest_subscriptions', digest_subscriptions),
+    (13, 'budgets', create_budgets),
+]
+
+
+async def apply_migrations(db):
+    async with db.write() as conn:
+        await conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                             (version INTEGER PRIMARY KEY, name TEXT, applied_at TEXT)''')
+        rows = await conn.execute_fetchall('SELECT MAX(version) FROM schema_version')
+    current = rows[0][0] or 0
+
+    applied = 0
+    for version, name, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        started = time.perf_counter()
+        async with db.write() as conn:
+            # Явный BEGIN, чтобы DDL и DML миграции откатывались вместе
+            await conn.execute('BEGIN IMMEDIATE')
+            c = await conn.cursor()
+            await migration(c)
+            await c.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, datetime('now'))",
+                            (version, name))
+        applied += 1
+        logging.info(f"Применена миграция {version} ({name}) за {time.perf_counter() - started:.3f} с")
+    return applied
@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+# Очередь исходящих запросов к Telegram: middleware сессии бота пропускает каждый
+# запрос с chat_id (отправка и редактирование сообщений, документы) через общий
+# token bucket и bucket своего чата. Ответы на действия пользователя идут раньше
+# массовых рассылок (см. bulk()), а 429 с retry_after не доходит до обработчика:
+# чат ставится на паузу, запрос повторяется. Запросы без chat_id (getUpdates,
+# setWebhook, answerCallbackQuery) идут мимо очереди.
+INTERACTIVE = 0
+BULK = 1
+MAX_RETRIES = 5
+IDLE_CHATS_LIMIT = 10000
+
+_priority = ContextVar('outbound_priority', default=INTERACTIVE)
+
+
+@contextmanager
+def bulk():
+    # Всё, что отправляется внутри блока, пропускает вперед ответы пользователям
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        # Сколько ждать до свободного токена (0 — можно отправлять сейчас)
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def idle(self, now):
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    # rate — общий предел бота в сообщениях в секунду (без всплесков: за любую секунду
+    # уходит не больше rate + 1), chat_rate/chat_burst — предел одного чата
+    def __init__(self, rate=30, chat_rate=1, chat_burst=3, max_retries=MAX_RETRIES):
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(rate, 1)
+        self._chats = {}
+        # Ожидающие: (приоритет, порядковый номер, chat_id, future); порядок внутри
+        # приоритета — порядок поступления, поэтому сообщения одного чата не обгоняют друг друга
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._pump_task = None
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        priority = _priority.get()
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(chat_id, priority)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retries += 1
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+                logging.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой в чат {chat_id} "
+                                f"({type(method).__name__}, попытка {attempt + 1})")
+                self._chat_bucket(chat_id).block(time.monotonic(), e.retry_after)
+                continue
+            self.sent += 1
+            return response
+
+    async def acquire(self, chat_id, priority=INTERACTIVE):
+        started = time.monotonic()
+        if not self._waiters and self._try_take(chat_id, started):
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((priority, next(self._seq), chat_id, future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Отмененный отправитель не должен держать токен, который ему уже выдали
+            if future.done() and not future.cancelled():
+                self._global.tokens += 1
+                self._chat_bucket(chat_id).tokens += 1
+            raise
+        waited = time.monotonic() - started
+        self.waited += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= IDLE_CHATS_LIMIT:
+                now = time.monotonic()
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _try_take(self, chat_id, now):
+        chat = self._chat_bucket(chat_id)
+        if self._global.delay(now) > 0 or chat.delay(now) > 0:
+            return False
+        self._global.take()
+        chat.take()
+        return True
+
+    async def _pump(self):
+        while self._waiters:
+            self._wakeup.clear()
+            now = time.monotonic()
+            wake = None
+            self._waiters.sort(key=lambda waiter: waiter[:2])
+            remaining = []
+            for index, waiter in enumerate(self._waiters):
+                priority, _, chat_id, future = waiter
+                if future.done():
+                    continue
+                global_wait = self._global.delay(now)
+                if global_wait > 0:
+                    wake = global_wait
+                    remaining.extend(self._waiters[index:])
+                    break
+                chat_wait = self._chat_bucket(chat_id).delay(now)
+                if chat_wait > 0:
+                    # Чат ждет своей очереди или retry_after, остальные чаты идут дальше
+                    wake = chat_wait if wake is None else min(wake, chat_wait)
+                    remaining.append(waiter)
+                    continue
+                self._global.take()
+                self._chat_bucket(chat_id).take()
+                future.set_result(None)
+            self._waiters = [waiter for waiter in remaining if not waiter[3].done()]
+            if not self._waiters:
+                break
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wake)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+            self._pump_task = None
+        for *_, future in self._waiters:
+            future.cancel()
+        self._waiters = []
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'retries': self.retries,
+            'failed': self.failed,
+            'queued': len(self._waiters),
+            'bulk_queued': sum(1 for waiter in self._waiters if waiter[0] == BULK),
+            'chats': len(self._chats),
+            'avg_wait_ms': self.waited / self.sent * 1000 if self.sent else 0,
+            'max_wait_ms': self.max_wait * 1000,
+        }
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+
+import stats
+
+# Массовое удаление записей пользователя (обнуление статистики, /delete с
+# фильтрами). Записи удаляются порциями по PURGE_CHUNK_SIZE: каждая порция —
+# один DELETE ... RETURNING в своей короткой транзакции вместе с вычитанием из
+# дневных итогов, поэтому агрегаты согласованы после каждого COMMIT, а между
+# порциями писатель освобождается для вставок других пользователей. Удаляются
+# только записи, существовавшие на момент начала (id <= max_id): добавленное во
+# время удаления остается.
+PURGE_CHUNK_SIZE = 2000
+# Пауза между порциями, чтобы очередь записи успела сбросить накопившееся
+PURGE_PAUSE = 0.01
+
+
+def purge_conditions(user_id, type_=None, category_id=None, ts_from=None, ts_to=None):
+    conditions = ['user_id = ?']
+    params = [user_id]
+    if type_:
+        conditions.append('type = ?')
+        params.append(type_)
+    if category_id:
+        conditions.append('category_id = ?')
+        params.append(category_id)
+    if ts_from:
+        conditions.append('ts >= ?')
+        params.append(ts_from)
+    if ts_to:
+        conditions.append('ts < ?')
+        params.append(ts_to)
+    return ' AND '.join(conditions), params
+
+
+async def count_matching(db, user_id, **filters):
+    # Возвращает (число записей, наибольший id) для подтверждения перед purge
+    where, params = purge_conditions(user_id, **filters)
+    rows = await db.fetchall(f'SELECT COUNT(*), MAX(id) FROM transactions WHERE {where}', params)
+    return rows[0]
+
+
+async def purge(db, user_id, day_start_hour, chunk_size=PURGE_CHUNK_SIZE, pause=PURGE_PAUSE, max_id=None, **filters):
+    # filters: type_, category_id, ts_from, ts_to (см. purge_conditions); max_id ограничивает удаление
+    # записями, показанными пользователю при подтверждении. Возвращает число удаленных записей
+    where, params = purge_conditions(user_id, **filters)
+    if max_id is None:
+        rows = await db.fetchall(f'SELECT MAX(id) FROM transactions WHERE {where}', params)
+        max_id = rows[0][0]
+        if max_id is None:
+            return 0
+    started = time.perf_counter()
+    deleted = chunks = 0
+    while True:
+        async with db.write() as conn:
+            removed = await conn.execute_fetchall(
+                f'''DELETE FROM transactions WHERE id IN
+                        (SELECT id FROM transactions WHERE {where} AND id <= ? LIMIT ?)
+                    RETURNING type, amount, category_id, ts, utc_offset''', params + [max_id, chunk_size])
+            if removed:
+                await subtract_chunk(conn, user_id, removed, day_start_hour)
+        deleted += len(removed)
+        chunks += 1
+        if len(removed) < chunk_size:
+            break
+        await asyncio.sleep(pause)
+    logging.info(f"Пользователь {user_id}: удалено записей {deleted} за {chunks} порц. "
+                 f"({time.perf_counter() - started:.2f} с)")
+    return deleted
+
+
+async def subtract_chunk(conn, user_id, removed, day_start_hour):
+    totals = {}
+    for type_, amount, category_id, ts, utc_offset in removed:
+        key = (stats.accounting_day_of(ts, utc_offset, day_start_hour), type_, category_id)
+        total = totals.setdefault(key, [0, 0])
+        total[0] += amount
+        total[1] += 1
+    await conn.executemany(stats.ROLLUP_REMOVE, [(amount, count, user_id, day, type_, category_id)
+                                                 for (day, type_, category_id), (amount, count) in totals.items()])
+    await conn.executemany(stats.ROLLUP_PRUNE, [(user_id, day, type_, category_id)
+                                                for day, type_, category_id in totals])
@@ -0,0 +1,58 @@
+import re
+from dataclasses import dataclass
+
+import stats
+
+# Быстрый ввод одной строкой: «-500 еда кофе», «+5000 зарплата апрель». Знак —
+# тип операции, дальше сумма, категория (можно сокращать и ошибаться в букве, см.
+# categories.UserCategories.match) и необязательное описание. Несколько строк в
+# одном сообщении записываются одной пачкой; если хоть одна строка не разобрана,
+# не записывается ничего.
+LINE_PATTERN = re.compile(r'([+-])\s*(\d+(?:[.,]\d{1,2})?)(?:\s+(.+))?')
+# Быстрым вводом считается только сообщение, начинающееся со знака и числа
+START_PATTERN = re.compile(r'[+-]\s*\d')
+MAX_LINES = 50
+TYPES = {'-': 'expense', '+': 'income'}
+
+
+@dataclass
+class QuickEntry:
+    type: str
+    amount: int
+    category: object
+    description: str
+
+
+def is_quick_entry(text):
+    # Остальное («-», «+ зарплата», «-abc») открывает обычный диалог выбора категории
+    return bool(text) and START_PATTERN.match(text) is not None
+
+
+def parse(text, entry):
+    entries = []
+    errors = []
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if len(lines) > MAX_LINES:
+        return [], [(0, f"не больше {MAX_LINES} строк за раз")]
+    for number, line in enumerate(lines, start=1):
+        match = LINE_PATTERN.fullmatch(line)
+        if match is None:
+            errors.append((number, f"«{line}»: ожидается «-500 еда кофе» или «+5000 зарплата»"))
+            continue
+        sign, raw_amount, rest = match.groups()
+        try:
+            amount = stats.parse_amount(raw_amount)
+        except ValueError as e:
+            errors.append((number, f"«{line}»: {e}"))
+            continue
+        words = rest.split() if rest else []
+        if not words:
+            errors.append((number, f"«{line}»: укажите категорию"))
+            continue
+        category, used = entry.match(TYPES[sign], words)
+        if category is None:
+            errors.append((number, f"«{line}»: нет подходящей категории для «{words[0]}»"))
+            continue
+        entries.append(QuickEntry(type=TYPES[sign], amount=amount, category=category,
+                                  description=' '.join(words[used:]) or None))
+    return entries, errors
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import migrations
+from database import Database
+from workers import shard_of, shard_path
+
+# Раскладка существующей базы по шардам для многопроцессного режима (BOT_WORKERS=N):
+#   python reshard.py expenses.db --shards 4
+# Исходная база открывается только на чтение и не меняется: ее снимок копируется во
+# временный файл рядом с ней, и миграциями (как при запуске бота) до текущей схемы
+# доводится копия. Для каждой шарды создается файл expenses.shard-<i>-of-<N>.db с той же
+# схемой; туда копируются категории, служебные данные и всё, что принадлежит
+# пользователям с shard_of(telegram_id, N) == i, с прежними id. Состояния FSM не переносятся.
+SHARED_TABLES = ('categories', 'app_meta', 'sqlite_sequence')
+USER_TABLES = ('user_settings', 'transactions', 'daily_totals', 'user_categories', 'digest_subscriptions', 'budgets')
+
+
+async def prepare(path):
+    db = Database(path, readers=1)
+    await db.open()
+    try:
+        await migrations.apply_migrations(db)
+    finally:
+        await db.close()
+
+
+def snapshot(path):
+    # Согласованная копия базы через backup API (вместе с незавершенным WAL);
+    # исходный файл открывается в режиме только для чтения
+    fd, copy = tempfile.mkstemp(suffix='.db', prefix='reshard-', dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    source = sqlite3.connect(Path(path).resolve().as_uri() + '?mode=ro', uri=True)
+    target = sqlite3.connect(copy)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return copy
+
+
+def remove_db(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def copy_shard(source, target, index, count):
+    conn = sqlite3.connect(target)
+    conn.create_function('shard_of', 2, shard_of, deterministic=True)
+    conn.execute('ATTACH DATABASE ? AS src', (source,))
+    copied = {}
+    with conn:
+        for table in SHARED_TABLES:
+            conn.execute(f'DELETE FROM {table}')
+            conn.execute(f'INSERT INTO {table} SELECT * FROM src.{table}')
+        conn.execute('''INSERT INTO user_id_mapping (simple_id, telegram_id)
+                        SELECT simple_id, telegram_id FROM src.user_id_mapping WHERE shard_of(telegram_id, ?) = ?''',
+                     (count, index))
+        copied['user_id_mapping'] = conn.execute('SELECT changes()').fetchone()[0]
+        for table in USER_TABLES:
+            conn.execute(f'INSERT INTO {table} SELECT * FROM src.{table} WHERE user_id IN (SELECT simple_id FROM user_id_mapping)')
+            copied[table] = conn.execute('SELECT changes()').fetchone()[0]
+    conn.execute('DETACH DATABASE src')
+    conn.close()
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Раскладка базы бота по шардам')
+    parser.add_argument('source', nargs='?', default=os.getenv('DB_PATH', 'expenses.db'))
+    parser.add_argument('--shards', type=int, required=True)
+    parser.add_argument('--force', action='store_true', help='перезаписать существующие файлы шард')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    targets = [shard_path(args.source, index, args.shards) for index in range(args.shards)]
+    existing = [target for target in targets if os.path.exists(target)]
+    if existing and not args.force:
+        parser.error(f"шарды уже существуют: {', '.join(existing)} (используйте --force)")
+    for target in existing:
+        remove_db(target)
+
+    source = snapshot(args.source)
+    try:
+        asyncio.run(prepare(source))
+        with sqlite3.connect(source) as conn:
+            orphans = conn.execute('''SELECT COUNT(*) FROM transactions
+                                      WHERE user_id NOT IN (SELECT simple_id FROM user_id_mapping)''').fetchone()[0]
+        if orphans:
+            logging.warning(f"Записей без пользователя в user_id_mapping: {orphans}, они не попадут ни в одну шарду")
+
+        for index, target in enumerate(targets):
+            asyncio.run(prepare(target))
+            copied = copy_shard(source, target, index, args.shards)
+            logging.info(f"Шарда {index}: {target}, скопировано {copied}")
+    finally:
+        remove_db(source)
+    logging.info(f"Готово. Запуск: BOT_WORKERS={args.shards} DB_PATH={args.source} python bot.py")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import re
+from datetime import datetime
+
+import export
+import history
+import stats
+
+# Поиск по описаниям (/find). Описания лежат в полнотекстовом индексе
+# transactions_fts (FTS5, миграция 11) вместе с user_id: MATCH по слову
+# пользователя и словам запроса находит его записи по индексу, а не
+# сканированием LIKE '%...%', затем они соединяются с transactions по rowid и
+# фильтруются по типу и периоду. Токенизатор unicode61 сам приводит
+# кириллицу к нижнему регистру, «ё» заменяется на «е» и в индексе, и в запросе.
+# Каждое слово ищется как префикс: «коф» найдет «кофе» и «кофейня», поэтому
+# падежные окончания не мешают.
+FIND_LIMIT = 20
+MAX_WORDS = 8
+WORD_PATTERN = re.compile(r'\w+')
+PERIOD_WORDS = {'сегодня': 'день', 'день': 'день', 'неделя': 'неделю', 'неделю': 'неделю', 'месяц': 'месяц',
+                'год': 'год'}
+PERIOD_LABELS = {'день': 'сегодня', 'неделю': 'за неделю', 'месяц': 'за месяц', 'год': 'за год'}
+
+
+def normalize(text):
+    return text.lower().replace('ё', 'е')
+
+
+def match_expression(words):
+    tokens = WORD_PATTERN.findall(normalize(' '.join(words)))
+    if not tokens:
+        raise ValueError("укажите слова для поиска")
+    if len(tokens) > MAX_WORDS:
+        raise ValueError(f"не больше {MAX_WORDS} слов")
+    # Кавычки делают из слова строку FTS5, а не оператор (AND, NOT, NEAR)
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def parse_find_args(args, tz, day_start_hour, now=None):
+    # /find <слова> [день|неделя|месяц|год] [с] [по] [расходы|доходы]
+    options = [arg for arg in args if arg.lower() in export.EXPORT_TYPE_WORDS or history.DATE_PATTERN.fullmatch(arg)]
+    period = next((PERIOD_WORDS[arg.lower()] for arg in args if arg.lower() in PERIOD_WORDS), None)
+    words = [arg for arg in args if arg not in options and arg.lower() not in PERIOD_WORDS]
+    parsed = export.parse_export_args(options, tz)
+    query = {'match': match_expression(words), 'words': ' '.join(words), 'types': parsed['types'],
+             'ts_from': parsed['ts_from'], 'ts_to': parsed['ts_to'], 'period': None}
+    if period is not None:
+        if parsed['ts_from'] is not None:
+            raise ValueError("укажите либо период словом, либо даты")
+        start = stats.period_starts(now or datetime.now(tz), day_start_hour)[period]
+        query['ts_from'] = int(datetime.fromisoformat(start).replace(hour=day_start_hour, tzinfo=tz).timestamp())
+        query['period'] = PERIOD_LABELS[period]
+    return query
+
+
+def find_conditions(user_id, query):
+    conditions = ['transactions_fts MATCH ?', 't.user_id = ?',
+                  f"t.type IN ({', '.join('?' * len(query['types']))})"]
+    params = [f'user_id : "{user_id}" AND description : ({query["match"]})', user_id, *query['types']]
+    if query['ts_from'] is not None:
+        conditions.append('t.ts >= ?')
+        params.append(query['ts_from'])
+    if query['ts_to'] is not None:
+        conditions.append('t.ts < ?')
+        params.append(query['ts_to'])
+    return ' AND '.join(conditions), params
+
+
+async def find(conn, user_id, query, limit=FIND_LIMIT):
+    # Возвращает (итоги по (тип, категория) с суммой и числом записей, последние limit записей)
+    where, params = find_conditions(user_id, query)
+    # CROSS JOIN фиксирует порядок: сначала MATCH по индексу, потом записи по rowid. Иначе
+    # планировщик может пройти все записи пользователя и выполнять MATCH для каждой
+    source = '''FROM transactions_fts CROSS JOIN transactions t ON t.id = transactions_fts.rowid
+                JOIN categories c ON c.id = t.category_id'''
+    totals = await conn.execute_fetchall(
+        f'''SELECT t.type, c.category, SUM(t.amount), COUNT(*) {source} WHERE {where}
+            GROUP BY t.type, c.category ORDER BY t.type, SUM(t.amount) DESC''', params)
+    rows = await conn.execute_fetchall(
+        f'''SELECT t.id, t.type, t.ts, t.utc_offset, t.amount, c.category, t.description {source} WHERE {where}
+            ORDER BY t.ts DESC, t.id DESC LIMIT ?''', params + [limit])
+    return totals, rows
+
+
+def describe_query(query, tz):
+    parts = []
+    if query['period']:
+        parts.append(query['period'])
+    if query['ts_from'] is not None and not query['period']:
+        parts.append(f"с {datetime.fromtimestamp(query['ts_from'], tz).strftime('%Y-%m-%d')}")
+    if query['ts_to'] is not None:
+        parts.append(f"по {datetime.fromtimestamp(query['ts_to'] - 1, tz).strftime('%Y-%m-%d')}")
+    return f"«{query['words']}»" + (f" ({', '.join(parts)})" if parts else "")
+
+
+def render_found(query, totals, rows, tz):
+    title = describe_query(query, tz)
+    if not totals:
+        return f"По запросу {title} ничего не найдено."
+    count = sum(total[3] for total in totals)
+    text = f"Найдено записей по запросу {title}: {count}\n"
+    for type_, label in (('expense', "Расходы"), ('income', "Доходы")):
+        lines = [f"  {category}: {stats.format_amount(amount)} ({found})"
+                 for total_type, category, amount, found in totals if total_type == type_]
+        if lines:
+            amount = sum(total[2] for total in totals if total[0] == type_)
+            text += f"\n{label}: {stats.format_amount(amount)}\n" + "\n".join(lines) + "\n"
+    text += f"\nПоследние {len(rows)}:\n" if count > len(rows) else "\nЗаписи:\n"
+    return text + "\n".join(history.format_row(row) for row in rows)
@@ -0,0 +1,282 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+# Дневные агрегаты: одна строка на (пользователь, учетный день, тип, категория).
+# Учетный день начинается в DAY_START_HOUR по локальному времени пользователя,
+# поэтому статистика за любой период читается без сканирования сырых записей.
+# Суммы везде хранятся целыми копейками, время операции — секундами UTC (ts) плюс
+# смещение пользователя в момент записи (utc_offset), категория — ссылкой на categories.
+# Расходы и доходы лежат в одной таблице transactions и различаются столбцом type.
+TRANSACTION_INSERT = '''INSERT INTO transactions (user_id, type, ts, utc_offset, category_id, amount, description)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)'''
+
+ROLLUP_UPSERT = '''INSERT INTO daily_totals (user_id, day, type, category_id, amount, count) VALUES (?, ?, ?, ?, ?, 1)
+                   ON CONFLICT (user_id, day, type, category_id)
+                   DO UPDATE SET amount = amount + excluded.amount, count = count + 1'''
+# Пачка операций за день одной строкой (импорт)
+ROLLUP_ADD = '''INSERT INTO daily_totals (user_id, day, type, category_id, amount, count) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, day, type, category_id)
+                DO UPDATE SET amount = amount + excluded.amount, count = count + excluded.count'''
+ROLLUP_SUBTRACT = '''UPDATE daily_totals SET amount = amount - ?, count = count - 1
+                     WHERE user_id = ? AND day = ? AND type = ? AND category_id = ?'''
+# Обратная операция к ROLLUP_ADD (массовое удаление)
+ROLLUP_REMOVE = '''UPDATE daily_totals SET amount = amount - ?, count = count - ?
+                   WHERE user_id = ? AND day = ? AND type = ? AND category_id = ?'''
+ROLLUP_PRUNE = '''DELETE FROM daily_totals
+                  WHERE user_id = ? AND day = ? AND type = ? AND category_id = ? AND count <= 0'''
+
+# Все данные для статистики за год читаются одним запросом по первичному ключу агрегатов
+STATS_QUERY = '''SELECT t.day, t.type, c.category, t.amount FROM daily_totals t
+                 JOIN categories c ON c.id = t.category_id
+                 WHERE t.user_id = ? AND t.day >= ?'''
+
+
+# Наибольшая сумма одной операции в копейках (1 млрд): суммы за годы остаются далеко внутри INTEGER SQLite
+MAX_AMOUNT = 100_000_000_000
+
+
+def to_minor(amount):
+    return int(round(amount * 100))
+
+
+def parse_amount(text):
+    # Сумма из ввода пользователя -> копейки; ValueError, если это не число, не больше нуля или больше MAX_AMOUNT
+    try:
+        amount = float(text.replace(' ', '').replace(',', '.'))
+    except ValueError:
+        raise ValueError("сумма должна быть числом")
+    if not abs(amount) * 100 <= MAX_AMOUNT:
+        raise ValueError(f"сумма должна быть не больше {format_amount(MAX_AMOUNT)}")
+    minor = to_minor(amount)
+    if minor <= 0:
+        raise ValueError("сумма должна быть положительной")
+    return minor
+
+
+def format_amount(minor):
+    return f"{minor / 100:.2f}"
+
+
+def accounting_day(moment, day_start_hour):
+    return (moment - timedelta(hours=day_start_hour)).strftime('%Y-%m-%d')
+
+
+def accounting_day_of(ts, utc_offset, day_start_hour):
+    return accounting_day(datetime.fromtimestamp(ts + utc_offset, timezone.utc), day_start_hour)
+
+
+@dataclass
+class PeriodTotals:
+    expenses: dict = field(default_factory=dict)
+    incomes: dict = field(default_factory=dict)
+
+    @property
+    def total_expenses(self):
+        return sum(self.expenses.values())
+
+    @property
+    def total_incomes(self):
+        return sum(self.incomes.values())
+
+    @property
+    def balance(self):
+        return self.total_incomes - self.total_expenses
+
+
+@dataclass
+class StatsResult:
+    # periods: название периода -> PeriodTotals в порядке день, неделя, месяц, год;
+    # daily и monthly: ключ -> [расходы, доходы] для подробного вида; суммы в копейках
+    periods: dict
+    daily: dict = field(default_factory=dict)
+    monthly: dict = field(default_factory=dict)
+
+    @property
+    def is_empty(self):
+        year = self.periods['год']
+        return not year.expenses and not year.incomes
+
+
+def period_starts(now, day_start_hour):
+    today = (now - timedelta(hours=day_start_hour)).date()
+    return {
+        'день': today.isoformat(),
+        'неделю': (today - timedelta(days=today.weekday())).isoformat(),
+        'месяц': today.replace(day=1).isoformat(),
+        'год': today.replace(month=1, day=1).isoformat(),
+    }
+
+
+async def subtract_from_rollup(conn, user_id, type_, amount, category_id, ts, utc_offset, day_start_hour):
+    day = accounting_day_of(ts, utc_offset, day_start_hour)
+    await conn.execute(ROLLUP_SUBTRACT, (amount, user_id, day, type_, category_id))
+    await conn.execute(ROLLUP_PRUNE, (user_id, day, type_, category_id))
+
+
+async def rebuild_daily_totals(c, day_start_hour):
+    # Полный пересчет агрегатов по сырым таблицам (однократное заполнение)
+    await c.execute('DELETE FROM daily_totals')
+    await c.execute('''INSERT INTO daily_totals (user_id, day, type, category_id, amount, count)
+                       SELECT user_id, date(ts + utc_offset - ?, 'unixepoch') AS day, type, category_id,
+                              SUM(amount), COUNT(*)
+                       FROM transactions GROUP BY user_id, day, type, category_id''',
+                    (day_start_hour * 3600,))
+    await c.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES ('daily_totals_day_start_hour', ?)",
+                    (str(day_start_hour),))
+
+
+async def ensure_daily_totals(c, day_start_hour):
+    # Заполняем агрегаты, если они ещё не посчитаны или поменялось начало учетного дня
+    await c.execute("SELECT value FROM app_meta WHERE key = 'daily_totals_day_start_hour'")
+    row = await c.fetchone()
+    if row is None or row[0] != str(day_start_hour):
+        await rebuild_daily_totals(c, day_start_hour)
+        return True
+    return False
+
+
+def compute_stats(rows, starts):
+    # Один проход по строкам агрегатов: каждая строка попадает во все периоды,
+    # которые её покрывают, и сразу в разбивку по дням недели и месяцам года
+    bounds = list(starts.items())
+    periods = {name: PeriodTotals() for name, _ in bounds}
+    week_start = starts['неделю']
+    daily = {}
+    monthly = {}
+    for day, type_, category, amount in rows:
+        index = 0 if type_ == 'expense' else 1
+        for name, start in bounds:
+            if day >= start:
+                totals = periods[name].expenses if index == 0 else periods[name].incomes
+                totals[category] = totals.get(category, 0) + amount
+        if day >= week_start:
+            daily.setdefault(day, [0, 0])[index] += amount
+        monthly.setdefault(day[:7], [0, 0])[index] += amount
+    for totals in periods.values():
+        totals.expenses = dict(sorted(totals.expenses.items()))
+        totals.incomes = dict(sorted(totals.incomes.items()))
+    return StatsResult(periods=periods, daily=dict(sorted(daily.items())), monthly=dict(sorted(monthly.items())))
+
+
+async def load_stats(conn, user_id, starts):
+    rows = await conn.execute_fetchall(STATS_QUERY, (user_id, starts['год']))
+    return compute_stats(rows, starts)
+
+
+def render_stats(result, detailed=False):
+    response = "Статистика расходов и доходов:\n"
+    for period_name, totals in result.periods.items():
+        response += f"\nЗа последний {period_name}:\n"
+        if totals.expenses:
+            response += "Расходы:\n"
+            for category, amount in totals.expenses.items():
+                response += f"{category}: {format_amount(amount)}\n"
+        if totals.incomes:
+            response += "Доходы:\n"
+            for category, amount in totals.incomes.items():
+                response += f"{category}: {format_amount(amount)}\n"
+        response += f"Итого расходы: {format_amount(totals.total_expenses)}\n"
+        response += f"Итого доходы: {format_amount(totals.total_incomes)}\n"
+        response += f"Баланс: {format_amount(totals.balance)}\n"
+
+        if detailed and period_name == 'неделю' and result.daily:
+            response += "\nПодробно по дням:\n"
+            for day, (day_exp, day_inc) in result.daily.items():
+                response += f"{day}: Расходы {format_amount(day_exp)}, Доходы {format_amount(day_inc)}, Баланс {format_amount(day_inc - day_exp)}\n"
+        elif detailed and period_name == 'год' and result.monthly:
+            response += "\nПодробно по месяцам:\n"
+            for month, (month_exp, month_inc) in result.monthly.items():
+                response += f"{month}: Расходы {format_amount(month_exp)}, Доходы {format_amount(month_inc)}, Баланс {format_amount(month_inc - month_exp)}\n"
+    return response
+
+
+class StatsCache:
+    # LRU-кэш готовых ответов статистики с TTL. Ключ: (simple_id, границы периодов,
+    # подробный вид), поэтому смена учетного дня или часового пояса дает новый ключ.
+    # Запись пользователя сбрасывает его записи и увеличивает поколение, чтобы результат,
+    # посчитанный до записи, не попал в кэш после неё. Поколения берутся из общего
+    # счетчика и хранятся для maxsize последних сброшенных пользователей; у остальных
+    # поколение — наибольшее из вытесненных, поэтому оно никогда не уменьшается.
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._user_keys = {}
+        self._generations = OrderedDict()
+        self._generation_counter = 0
+        self._generation_floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(user_id, starts, detailed):
+        return user_id, tuple(starts.values()), detailed
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def generation(self, user_id):
+        return self._generations.get(user_id, self._generation_floor)
+
+    def put(self, key, value, generation):
+        user_id = key[0]
+        if generation != self.generation(user_id):
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        self._user_keys.setdefault(user_id, set()).add(key)
+        while len(self._entries) > self.maxsize:
+            old_key, _ = self._entries.popitem(last=False)
+            self._forget_user_key(old_key)
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        self._generation_counter += 1
+        self._generations[user_id] = self._generation_counter
+        self._generations.move_to_end(user_id)
+        while len(self._generations) > self.maxsize:
+            _, self._generation_floor = self._generations.popitem(last=False)
+        for key in self._user_keys.pop(user_id, ()):
+            del self._entries[key]
+            self.invalidations += 1
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._forget_user_key(key)
+
+    def _forget_user_key(self, key):
+        keys = self._user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
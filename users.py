@@ -0,0 +1,130 @@
+import logging
+from dataclasses import dataclass, field
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from lru import SingleFlightLRU
+
+# Новый simple_id выдает сама база: AUTOINCREMENT + UNIQUE(telegram_id) и один
+# INSERT ... RETURNING. Пустой UPDATE при конфликте нужен, чтобы RETURNING вернул
+# уже существующий id, если его успел создать другой обработчик.
+ALLOCATE_SIMPLE_ID = '''INSERT INTO user_id_mapping (telegram_id) VALUES (?)
+                        ON CONFLICT (telegram_id) DO UPDATE SET telegram_id = excluded.telegram_id
+                        RETURNING simple_id'''
+
+
+class SimpleIdAllocator:
+    # Кэш telegram_id -> simple_id с вытеснением LRU. Прогревается пачкой из
+    # user_id_mapping при старте; параллельные промахи по одному telegram_id
+    # схлопываются в один запрос к базе (single-flight).
+    def __init__(self, db, maxsize=100000):
+        self.db = db
+        self.maxsize = maxsize
+        self._cache = SingleFlightLRU(self._load, maxsize)
+        self.allocated = 0
+
+    async def warm(self):
+        rows = await self.db.fetchall('SELECT telegram_id, simple_id FROM user_id_mapping ORDER BY simple_id DESC LIMIT ?',
+                                      (self.maxsize,))
+        # Самые новые пользователи оказываются в конце, то есть вытесняются последними
+        for telegram_id, simple_id in reversed(rows):
+            self._cache.put(telegram_id, simple_id)
+        return len(rows)
+
+    async def get(self, telegram_id):
+        return await self._cache.get(telegram_id)
+
+    async def _load(self, telegram_id):
+        row = await self.db.fetchone('SELECT simple_id FROM user_id_mapping WHERE telegram_id = ?', (telegram_id,))
+        if row:
+            simple_id = row[0]
+        else:
+            async with self.db.write() as conn:
+                rows = await conn.execute_fetchall(ALLOCATE_SIMPLE_ID, (telegram_id,))
+            simple_id = rows[0][0]
+            self.allocated += 1
+            logging.debug(f"Inserted simple_id {simple_id} for telegram_id {telegram_id}")
+        return simple_id
+
+    def stats(self):
+        lookups = self._cache.hits + self._cache.misses
+        return {
+            'size': len(self._cache),
+            'maxsize': self.maxsize,
+            'hits': self._cache.hits,
+            'misses': self._cache.misses,
+            'hit_rate': self._cache.hits / lookups if lookups else 0.0,
+            'evictions': self._cache.evictions,
+            'coalesced': self._cache.coalesced,
+            'allocated': self.allocated,
+        }
+
+
+@dataclass
+class UserSettings:
+    # timezone: готовый ZoneInfo (общий для всех пользователей с этим поясом);
+    # values: все столбцы user_settings, кроме user_id, как они лежат в базе
+    timezone: ZoneInfo
+    values: dict = field(default_factory=dict)
+
+
+class UserSettingsCache:
+    # Все строки user_settings загружаются при старте одним запросом и обновляются
+    # сквозной записью, поэтому на горячем пути настройки читаются без обращения к базе.
+    # Новые настройки (начало дня, валюта) добавляются столбцом в user_settings и
+    # подхватываются тем же запросом.
+    def __init__(self, db, default_timezone='UTC'):
+        self.db = db
+        self._zones = {}
+        self._settings = {}
+        self._columns = []
+        self.default = UserSettings(timezone=self.zone(default_timezone))
+
+    def zone(self, name):
+        zone = self._zones.get(name)
+        if zone is None:
+            try:
+                zone = ZoneInfo(name)
+            except (ZoneInfoNotFoundError, ValueError):
+                logging.error(f"Неверный часовой пояс {name}, используется UTC")
+                zone = ZoneInfo('UTC')
+            self._zones[name] = zone
+        return zone
+
+    async def load(self):
+        async with self.db.read() as conn:
+            async with conn.execute('SELECT * FROM user_settings') as cursor:
+                columns = [column[0] for column in cursor.description]
+                rows = await cursor.fetchall()
+        self._columns = [column for column in columns if column != 'user_id']
+        self._settings = {}
+        for row in rows:
+            values = dict(zip(columns, row))
+            self._settings[values.pop('user_id')] = self._build(values)
+        return len(rows)
+
+    def _build(self, values):
+        name = values.get('timezone')
+        return UserSettings(timezone=self.zone(name) if name else self.default.timezone, values=values)
+
+    def get(self, user_id):
+        return self._settings.get(user_id, self.default)
+
+    def timezone(self, user_id):
+        return self.get(user_id).timezone
+
+    async def update(self, user_id, **values):
+        unknown = set(values) - set(self._columns)
+        if unknown:
+            raise ValueError(f"Неизвестные настройки: {', '.join(sorted(unknown))}")
+        columns = ', '.join(values)
+        placeholders = ', '.join('?' * len(values))
+        assignments = ', '.join(f'{column} = excluded.{column}' for column in values)
+        await self.db.execute(f'INSERT INTO user_settings (user_id, {columns}) VALUES (?, {placeholders}) '
+                              f'ON CONFLICT (user_id) DO UPDATE SET {assignments}',
+                              (user_id, *values.values()))
+        merged = dict(self.get(user_id).values)
+        merged.update(values)
+        self._settings[user_id] = self._build(merged)
+
+    def stats(self):
+        return {'users': len(self._settings), 'zones': len(self._zones)}
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import signal
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+# Режим вебхука: обновления принимает встроенный aiohttp-сервер. Telegram сразу
+# получает ответ 200, а обновление обрабатывается в фоне, но не больше заданного
+# числа одновременно. Обновления одного пользователя обрабатываются строго по
+# очереди, чтобы шаги диалогов FSM не перемешивались. Локально режим проверяется
+# отправкой сохраненного Update:
+#   curl -X POST localhost:8080/webhook -H 'Content-Type: application/json' \
+#        -H 'X-Telegram-Bot-Api-Secret-Token: <WEBHOOK_SECRET>' -d @update.json
+
+
+def update_user_id(update):
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from'].get('id')
+    return None
+
+
+class UserOrderedLimiter:
+    # Не больше concurrency обработок одновременно, а обработки одного пользователя
+    # строго по очереди. Используется вебхуком и процессами-воркерами (workers.py).
+    def __init__(self, concurrency):
+        self._slots = asyncio.Semaphore(concurrency)
+        self._user_locks = {}
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        if user_id is None:
+            async with self._slots:
+                yield
+            return
+        # Задачи стартуют в порядке приема, а asyncio.Lock выдается по очереди (FIFO)
+        lock, waiters = self._user_locks.get(user_id, (asyncio.Lock(), 0))
+        self._user_locks[user_id] = (lock, waiters + 1)
+        try:
+            async with lock:
+                async with self._slots:
+                    yield
+        finally:
+            lock, waiters = self._user_locks[user_id]
+            if waiters == 1:
+                del self._user_locks[user_id]
+            else:
+                self._user_locks[user_id] = (lock, waiters - 1)
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    def __init__(self, dispatcher, bot, concurrency, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._limiter = UserOrderedLimiter(concurrency)
+
+    @property
+    def pending(self):
+        return len(self._background_feed_update_tasks)
+
+    async def _background_feed_update(self, bot, update):
+        async with self._limiter.slot(update_user_id(update)):
+            await super()._background_feed_update(bot, update)
+
+    async def close(self):
+        # Дожидаемся уже принятых обновлений (и их записей в базу), затем закрываем сессию бота
+        if self._background_feed_update_tasks:
+            logging.info(f"Ожидание обработки принятых обновлений: {self.pending}")
+            await asyncio.gather(*self._background_feed_update_tasks, return_exceptions=True)
+        await super().close()
+
+
+def build_app(dispatcher, bot, path='/webhook', secret=None, concurrency=64, health=None):
+    app = web.Application()
+    handler = BoundedRequestHandler(dispatcher, bot, concurrency, secret_token=secret)
+    handler.register(app, path=path)
+    setup_application(app, dispatcher, bot=bot)
+
+    async def health_check(request):
+        info = {'status': 'ok', 'pending_updates': handler.pending}
+        if health is not None:
+            info.update(health())
+        return web.json_response(info)
+
+    app.router.add_get('/health', health_check)
+    return app
+
+
+async def run_webhook(dispatcher, bot, host='0.0.0.0', port=8080, path='/webhook', url=None, secret=None,
+                      concurrency=64, health=None):
+    app = build_app(dispatcher, bot, path=path, secret=secret, concurrency=concurrency, health=health)
+    logging.info(f"Параллельно обрабатывается не больше {concurrency} обновлений")
+    await serve_app(app, bot, host=host, port=port, path=path, url=url, secret=secret,
+                    allowed_updates=dispatcher.resolve_used_update_types())
+
+
+async def serve_app(app, bot, host='0.0.0.0', port=8080, path='/webhook', url=None, secret=None,
+                    allowed_updates=None):
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logging.info(f"Вебхук слушает {host}:{port}{path}")
+
+    if url:
+        await bot.set_webhook(url.rstrip('/') + path, secret_token=secret, allowed_updates=allowed_updates)
+        logging.info(f"Вебхук зарегистрирован в Telegram: {url.rstrip('/') + path}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        logging.info("Остановка вебхука")
+        # cleanup останавливает прием, вызывает on_shutdown (ожидание фоновых обновлений) и закрывает сессию
+        await runner.cleanup()
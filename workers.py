@@ -0,0 +1,282 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+
+from aiohttp import web
+
+import webhook
+
+# Многопроцессный режим (BOT_WORKERS > 1). Фронт-процесс принимает обновления
+# (long polling или вебхук) и по from_user.id отправляет каждое одному из N
+# процессов-воркеров: строкой JSON в stdin. Воркер — обычный бот со своей шардой
+# базы, кэшами и состояниями FSM; обновления одного пользователя всегда попадают
+# в один воркер и обрабатываются там по очереди. Воркеры раз в несколько секунд
+# пишут в stdout свою сводку health, фронт собирает их в общий вид.
+# Существующую базу раскладывает по шардам reshard.py.
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+HEALTH_INTERVAL = 5
+POLL_TIMEOUT = 30
+RESTART_DELAY = 1
+STOP_TIMEOUT = 30
+READ_LIMIT = 2 ** 24
+
+
+def shard_of(telegram_id, count):
+    # Обновления без пользователя (их бот не обрабатывает) уходят в первый воркер
+    return telegram_id % count if telegram_id is not None else 0
+
+
+def shard_path(db_path, index, count):
+    root, ext = os.path.splitext(db_path)
+    return f'{root}.shard-{index}-of-{count}{ext or ".db"}'
+
+
+def merge_health(infos):
+    # Сумма счетчиков по воркерам; средние и доли усредняются, максимумы берутся максимумом
+    merged = {}
+    keys = []
+    for info in infos:
+        keys.extend(key for key in info if key not in keys)
+    for key in keys:
+        values = [info[key] for info in infos if key in info]
+        if all(isinstance(value, dict) for value in values):
+            merged[key] = merge_health(values)
+        elif all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+            if key.startswith('max'):
+                merged[key] = max(values)
+            elif key.startswith('avg') or key.endswith('rate'):
+                merged[key] = sum(values) / len(values)
+            else:
+                merged[key] = sum(values)
+    return merged
+
+
+class WorkerProcess:
+    def __init__(self, index, count, db_path):
+        self.index = index
+        self.db_path = shard_path(db_path, index, count)
+        self.process = None
+        self.health = {}
+        self.reported_at = None
+        self.forwarded = 0
+        self.restarts = 0
+        self._ready = asyncio.Event()
+        self._stopping = False
+        self._monitor = None
+
+    async def start(self):
+        env = dict(os.environ, BOT_MODE='worker', DB_PATH=self.db_path, WORKER_INDEX=str(self.index))
+        # Своя группа процессов: Ctrl+C получает только фронт, а воркеры
+        # останавливаются по закрытию stdin, дообработав принятое
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, BOT_SCRIPT, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            env=env, start_new_session=True, limit=READ_LIMIT)
+        self._monitor = asyncio.create_task(self._read_reports(self.process))
+        self._ready.set()
+        logging.info(f"Воркер {self.index} запущен (pid {self.process.pid}, база {self.db_path})")
+
+    async def send(self, update):
+        data = json.dumps(update, ensure_ascii=False).encode() + b'\n'
+        while True:
+            # Пока воркер перезапускается, отправители ждут его по очереди (FIFO)
+            await self._ready.wait()
+            try:
+                self.process.stdin.write(data)
+                await self.process.stdin.drain()
+                break
+            except (BrokenPipeError, ConnectionResetError):
+                if self._stopping:
+                    raise
+                await asyncio.sleep(RESTART_DELAY)
+        self.forwarded += 1
+
+    async def _read_reports(self, process):
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            try:
+                self.health = json.loads(line)['health']
+                self.reported_at = time.monotonic()
+            except (ValueError, KeyError) as e:
+                logging.error(f"Воркер {self.index}: непонятная строка в stdout: {e}")
+        self._ready.clear()
+        code = await process.wait()
+        if self._stopping:
+            return
+        # Воркер упал: принятые им, но не обработанные обновления потеряны
+        self.restarts += 1
+        logging.error(f"Воркер {self.index} завершился с кодом {code}, перезапуск через {RESTART_DELAY} с")
+        await asyncio.sleep(RESTART_DELAY)
+        if not self._stopping:
+            await self.start()
+
+    async def stop(self):
+        self._stopping = True
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.error(f"Воркер {self.index} не остановился за {STOP_TIMEOUT} с, завершаем принудительно")
+            self.process.kill()
+            await self.process.wait()
+        await self._monitor
+        logging.info(f"Воркер {self.index} остановлен, передано обновлений: {self.forwarded}")
+
+    def describe(self):
+        return {
+            'pid': self.process.pid if self.process else None,
+            'alive': self.process is not None and self.process.returncode is None,
+            'db_path': self.db_path,
+            'forwarded': self.forwarded,
+            'restarts': self.restarts,
+            'reported_seconds_ago': round(time.monotonic() - self.reported_at, 1) if self.reported_at else None,
+            'health': self.health,
+        }
+
+
+def aggregate_health(workers):
+    return {
+        'workers': {str(worker.index): worker.describe() for worker in workers},
+        'total': merge_health([worker.health for worker in workers]),
+    }
+
+
+async def poll_updates(bot, route, allowed_updates):
+    try:
+        await bot.delete_webhook()
+    except Exception as e:
+        logging.error(f"Не удалось снять вебхук: {e}")
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=allowed_updates,
+                                            request_timeout=POLL_TIMEOUT + 10)
+        except Exception as e:
+            logging.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await route(update.model_dump(mode='json', exclude_unset=True, by_alias=True))
+            offset = update.update_id + 1
+
+
+def build_front_app(route, path='/webhook', secret=None, health=None):
+    app = web.Application()
+
+    async def handle_update(request):
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=401, text='Unauthorized')
+        await route(await request.json())
+        return web.Response()
+
+    async def health_check(request):
+        return web.json_response({'status': 'ok', **health()})
+
+    if route is not None:
+        app.router.add_post(path, handle_update)
+    app.router.add_get('/health', health_check)
+    return app
+
+
+async def run_front(dispatcher, bot, count, db_path, mode='polling', host='0.0.0.0', port=8080, path='/webhook',
+                    url=None, secret=None, health_port=None):
+    workers = [WorkerProcess(index, count, db_path) for index in range(count)]
+    for worker in workers:
+        await worker.start()
+
+    async def route(update):
+        await workers[shard_of(webhook.update_user_id(update), count)].send(update)
+
+    def health():
+        return aggregate_health(workers)
+
+    allowed_updates = dispatcher.resolve_used_update_types()
+    logging.info(f"Фронт: {count} воркеров, режим {mode}")
+    try:
+        if mode == 'webhook':
+            app = build_front_app(route, path=path, secret=secret, health=health)
+            await webhook.serve_app(app, bot, host=host, port=port, path=path, url=url, secret=secret,
+                                    allowed_updates=allowed_updates)
+            return
+        runner = None
+        if health_port:
+            runner = web.AppRunner(build_front_app(None, health=health), handle_signals=False)
+            await runner.setup()
+            await web.TCPSite(runner, host, health_port).start()
+            logging.info(f"Сводка воркеров: http://{host}:{health_port}/health")
+        poller = asyncio.create_task(poll_updates(bot, route, allowed_updates))
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, poller.cancel)
+        try:
+            await poller
+        except asyncio.CancelledError:
+            logging.info("Остановка приема обновлений")
+        finally:
+            if runner is not None:
+                await runner.cleanup()
+    finally:
+        for worker in workers:
+            await worker.stop()
+        logging.info(f"Итог по воркерам: {health()['total']}")
+        await bot.session.close()
+
+
+async def run_worker(dispatcher, bot, concurrency=64, health=None):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=READ_LIMIT)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    limiter = webhook.UserOrderedLimiter(concurrency)
+    tasks = set()
+
+    def report():
+        if health is not None:
+            sys.stdout.write(json.dumps({'health': health()}, default=str) + '\n')
+            sys.stdout.flush()
+
+    async def report_periodically():
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            report()
+
+    async def feed(update):
+        try:
+            async with limiter.slot(webhook.update_user_id(update)):
+                await dispatcher.feed_raw_update(bot, update)
+        except Exception as e:
+            logging.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+
+    async def read_updates():
+        while line := await reader.readline():
+            # Ограничиваем число принятых задач: дальше пайп заполняется и фронт ждет
+            if len(tasks) >= concurrency * 4:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            task = asyncio.create_task(feed(json.loads(line)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    workflow_data = {'dispatcher': dispatcher, 'bot': bot, **dispatcher.workflow_data}
+    await dispatcher.emit_startup(**workflow_data)
+    report()
+    reporter = asyncio.create_task(report_periodically())
+    reading = asyncio.create_task(read_updates())
+    loop.add_signal_handler(signal.SIGTERM, reading.cancel)
+    try:
+        await reading
+    except asyncio.CancelledError:
+        pass
+    finally:
+        if tasks:
+            logging.info(f"Ожидание обработки принятых обновлений: {len(tasks)}")
+            await asyncio.gather(*tasks, return_exceptions=True)
+        reporter.cancel()
+        await dispatcher.emit_shutdown(**workflow_data)
+        report()
+        await bot.session.close()